@@ -0,0 +1,264 @@
+import ctypes
+import sys
+import threading
+
+import sounddevice as sd
+
+from audio_processor import SAMPLE_RATE, CHANNELS
+from config import app_config
+
+# 入力デバイスの一覧とマイク入力ストリームの管理。
+# DeviceRegistryは入力デバイスの列挙と設定の確認（check_input_settings）をバックグラウンドで行って結果をキャッシュし、
+# デバイスの抜き差しを検知したらPortAudioを再初期化して列挙し直す。
+# MicStreamはsd.InputStreamを保持し、デバイスの切り替えや再初期化のときにその場で開き直す。
+# 録音スレッドはキャプチャ用のリングバッファから読むため、開き直しても録音・ホットキーの流れは止まらない。
+
+# --- 定数 ---
+HOTPLUG_POLL_INTERVAL_S = 2.0 # デバイス数の変化を確認する間隔
+MAX_CAPTURE_CHANNELS = 2 # ネイティブ形式で取り込むチャンネル数の上限（多チャンネルの機器で無音のチャンネルを平均しないため）
+
+
+def system_input_device_count():
+    """
+    OSが認識している録音デバイスの数を返す（PortAudioを再初期化せずに調べられる安価な方法）。
+    調べられない環境ではNone（抜き差しはストリームのエラーと手動の再検索で検知する）。
+    """
+    if sys.platform != "win32":
+        return None
+    try:
+        return ctypes.windll.winmm.waveInGetNumDevs()
+    except OSError:
+        return None
+
+
+def device_label(device, hostapi_name):
+    return f"{device['name']} ({hostapi_name})"
+
+
+def native_input_format(device):
+    """デバイスのネイティブのサンプリングレートと、取り込むチャンネル数を返す。"""
+    return device['default_samplerate'], max(1, min(device['max_input_channels'], MAX_CAPTURE_CHANNELS))
+
+
+class DeviceRegistry:
+    """入力デバイスの一覧をバックグラウンドで調べてキャッシュする。"""
+
+    def __init__(self):
+        self.portaudio_lock = threading.RLock() # PortAudioの再初期化・デバイスの列挙・ストリームの開閉を直列化する
+        self.on_change = None # 一覧が更新されたときに呼ばれる（トレイメニューの更新など）
+        self._devices = None # 入力デバイスのリスト（調べ終わるまではNone）
+        self._probing = False
+        self._lock = threading.Lock()
+        self._streams = []
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """最初の列挙とデバイスの抜き差しの監視をバックグラウンドで開始する。"""
+        self.refresh()
+        threading.Thread(target=self._watch_hotplug, daemon=True).start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def attach(self, stream):
+        """PortAudioの再初期化のときに開き直すストリームを登録する。"""
+        self._streams.append(stream)
+
+    def devices(self):
+        """キャッシュしている入力デバイスのリストを返す。まだ調べ終わっていなければNone。"""
+        with self._lock:
+            return self._devices
+
+    def find(self, label):
+        """表示名が一致する入力デバイスの番号を返す（見つからなければNone）。"""
+        for device in self.devices() or []:
+            if device["label"] == label:
+                return device["index"]
+        return None
+
+    def refresh(self, reinitialize=False):
+        """
+        入力デバイスをバックグラウンドで調べ直す。reinitializeがTrueの場合は、新しく接続されたデバイスを
+        認識させるためPortAudioを再初期化する（開いているストリームは一度閉じて開き直す）。
+        """
+        with self._lock:
+            if self._probing:
+                return
+            self._probing = True
+            if reinitialize:
+                self._devices = None
+        threading.Thread(target=self._probe, args=(reinitialize,), daemon=True).start()
+
+    def _probe(self, reinitialize):
+        try:
+            with self.portaudio_lock:
+                if reinitialize:
+                    # 開いているストリームは再初期化で無効になるため、閉じてから再初期化し、列挙し直した後に開き直す
+                    for stream in self._streams:
+                        stream.suspend()
+                try:
+                    if reinitialize:
+                        sd._terminate()
+                        sd._initialize()
+                    devices = self._enumerate()
+                    with self._lock:
+                        self._devices = devices
+                    print(f"入力デバイスを{len(devices)}個検出しました。")
+                finally:
+                    if reinitialize:
+                        for stream in self._streams:
+                            stream.resume()
+        except Exception as e:
+            print(f"エラー: 入力デバイスの一覧を取得できませんでした。 {e}")
+        finally:
+            with self._lock:
+                self._probing = False
+        for stream in self._streams:
+            stream.on_devices_changed()
+        if self.on_change:
+            self.on_change()
+
+    def _enumerate(self):
+        devices = sd.query_devices()
+        unique_input_devices = {}
+        for i, device in enumerate(devices):
+            if device['max_input_channels'] <= 0:
+                continue
+            # ネイティブ形式で取り込めるデバイスは、16kHzに対応していなくても使える
+            sample_rate, channels = native_input_format(device)
+            if not app_config.get("capture_native_rate", True):
+                sample_rate, channels = SAMPLE_RATE, CHANNELS
+            try:
+                sd.check_input_settings(device=i, samplerate=sample_rate, channels=channels, dtype='int16')
+            except Exception:
+                continue
+            hostapi_name = sd.query_hostapis(device['hostapi']).get('name', 'Unknown API')
+            label = device_label(device, hostapi_name)
+            if label not in unique_input_devices:
+                unique_input_devices[label] = {"index": i, "name": device['name'], "hostapi_name": hostapi_name, "label": label}
+        return sorted(unique_input_devices.values(), key=lambda d: d['name'])
+
+    def _watch_hotplug(self):
+        """OSのデバイス数が変わったら、PortAudioを再初期化して列挙し直す。"""
+        last_count = system_input_device_count()
+        if last_count is None:
+            return
+        while not self._stop_event.wait(HOTPLUG_POLL_INTERVAL_S):
+            count = system_input_device_count()
+            if count != last_count:
+                print("入力デバイスの接続・切断を検出しました。デバイスを再検索します。")
+                last_count = count
+                self.refresh(reinitialize=True)
+
+
+class MicStream:
+    """
+    マイク入力ストリーム。デバイスの切り替えやPortAudioの再初期化のときにその場で開き直す。
+    capture_native_rateが有効な場合はデバイスのネイティブ形式で開き、変換はconfigure_input(レート, チャンネル数)で
+    用意させる（configure_inputは入力ストリームのブロック長を返す）。
+    """
+
+    def __init__(self, registry, callback, configure_input):
+        self.registry = registry
+        self.callback = callback
+        self.configure_input = configure_input
+        self.device_index = None # 現在開いているデバイス（Noneはデフォルト）
+        self.device_label = "" # 選択されたデバイスの表示名（空文字はデフォルトまたは番号で指定）
+        self._stream = None
+        self._closing = False
+        self._suspended = False
+        registry.attach(self)
+
+    def open(self, device_index=None, device_label=""):
+        with self.registry.portaudio_lock:
+            self.device_label = device_label
+            self._open(device_index)
+
+    def switch(self, device_index, device_label=""):
+        """デバイスを切り替える。開けなかった場合はデフォルトのデバイスで開き直す。"""
+        with self.registry.portaudio_lock:
+            self.device_label = device_label
+            self._close()
+            try:
+                self._open(device_index)
+            except Exception as e:
+                print(f"エラー: マイクデバイスを開けませんでした ({e})。デフォルトのデバイスを使用します。")
+                self._open(None)
+        print(f"マイクデバイスを切り替えました: {device_label or 'デフォルト'}")
+
+    def close(self):
+        with self.registry.portaudio_lock:
+            self._close()
+
+    def suspend(self):
+        """PortAudioの再初期化の前にストリームを閉じる（portaudio_lockを保持して呼ばれる）。"""
+        self._suspended = self._stream is not None
+        self._close()
+
+    def resume(self):
+        """再初期化の後にストリームを開き直す。デバイス番号が変わりうるため、表示名から探し直す。"""
+        if not self._suspended:
+            return
+        self._suspended = False
+        device_index = self.device_index
+        if self.device_label:
+            device_index = self.registry.find(self.device_label) # 見つからなければデフォルトのデバイス
+        try:
+            self._open(device_index)
+        except Exception as e:
+            print(f"警告: マイクデバイスを開き直せませんでした ({e})。デフォルトのデバイスを使用します。")
+            self._open(None)
+
+    def on_devices_changed(self):
+        """一覧の更新後、選択されたデバイスが別の番号で見つかれば（または再接続されれば）そのデバイスに切り替える。"""
+        if not self.device_label:
+            return
+        device_index = self.registry.find(self.device_label)
+        if device_index is not None and device_index != self.device_index:
+            self.switch(device_index, self.device_label)
+
+    def _open(self, device_index):
+        if app_config.get("capture_native_rate", True):
+            try:
+                sample_rate, channels = native_input_format(sd.query_devices(device_index, 'input'))
+                self._start(device_index, sample_rate, channels)
+                return
+            except Exception as e:
+                print(f"警告: マイクをネイティブ形式で開けませんでした ({e})。{SAMPLE_RATE}Hz・モノラルで開きます。")
+        self._start(device_index, SAMPLE_RATE, CHANNELS)
+
+    def _start(self, device_index, sample_rate, channels):
+        blocksize = self.configure_input(sample_rate, channels)
+        stream = sd.InputStream(
+            samplerate=sample_rate,
+            channels=channels,
+            dtype='int16',
+            blocksize=blocksize,
+            callback=self.callback,
+            device=device_index,
+            finished_callback=self._on_finished,
+        )
+        stream.start()
+        self._stream = stream
+        self.device_index = device_index
+
+    def _close(self):
+        if self._stream is None:
+            return
+        self._closing = True
+        try:
+            self._stream.stop()
+            self._stream.close()
+        except Exception as e:
+            print(f"警告: マイク入力ストリームを閉じる際にエラーが発生しました: {e}")
+        finally:
+            self._stream = None
+            self._closing = False
+
+    def _on_finished(self):
+        """ストリームがこちらから閉じる以外の理由（デバイスの切断など）で止まった場合に呼ばれる。"""
+        if self._closing:
+            return
+        print("警告: マイク入力ストリームが停止しました。デバイスを再検索して開き直します。")
+        # PortAudioのスレッドから呼ばれるため、再初期化は別スレッドで行う
+        self.registry.refresh(reinitialize=True)
@@ -1,12 +1,14 @@
-import sounddevice as sd
 import numpy as np
-import queue
-import time
 import re
 import os
-import torch
-from faster_whisper import WhisperModel
+import threading
+import time
+from dataclasses import dataclass
 from config import app_config, update_config
+from vad import create_vad, speech_regions, frame_energy_db
+from filler_filter import FillerFilter
+from capture_ring import CaptureRing, UtteranceBuffer, FrameRing
+from resampler import StreamingResampler
 
 # --- 定数 ---
 SAMPLE_RATE = 16000
@@ -14,24 +16,49 @@ CHANNELS = 1
 DTYPE = 'int16'
 BLOCK_DURATION_MS = 100
 BLOCKSIZE = int(SAMPLE_RATE * BLOCK_DURATION_MS / 1000)
-SILENCE_THRESHOLD = 300
+CAPTURE_BLOCK_MS = 20 # ネイティブ形式で取り込む場合の、コールバック1回あたりのおおよその長さ（ミリ秒）
+SILENCE_THRESHOLD = 300 # vad_modeが"energy"の場合のRMS閾値
+CAPTURE_BUFFER_S = 60.0 # マイク入力のリングバッファの長さ（秒）。文字起こしの投入待ちの間もここに溜まる
+MAX_READ_SAMPLES = int(SAMPLE_RATE * BLOCK_DURATION_MS / 1000) # 録音スレッドが1回に処理する最大のサンプル数（停止要求を確認する間隔）
+
 
-MODEL_SIZE = "small"
-COMPUTE_TYPE = "int8"
+@dataclass
+class AudioChunk:
+    """
+    RecordingSessionがon_chunkに渡す音声チャンク。
+    audioは録音バッファのビューで、on_chunkから戻るまでしか有効でない（保持する場合はコピーする）。
+    """
+    audio: np.ndarray
+    is_final: bool = True # Falseの場合は発話途中の途中認識用チャンク
+    speech_regions: list = None # VADが検出した音声区間 [(開始秒, 終了秒), ...]（チャンク先頭基準）
+    voiced_s: float = 0.0 # VADが音声と判定したフレームの長さの合計（秒、余白を含まない）
+    speech_start_at: float = None # 発話開始と判定されたフレームの先頭の時刻（clock基準）
+    speech_end_at: float = None # 最後に音声と判定されたフレームの終端の時刻（clock基準）
+    decided_at: float = None # このチャンクを区切ると判定した時点の音声の時刻（clock基準）
+    continues: bool = False # Trueの場合は発話の途中で強制的に区切ったチャンク（続きがある）
+    overlap_s: float = 0.0 # 先頭のこの秒数は、前のチャンクの末尾と重なっている
 
 
 # --- グローバル変数 ---
-audio_queue = queue.Queue()
-model = None
+capture_ring = CaptureRing(int(CAPTURE_BUFFER_S * SAMPLE_RATE), SAMPLE_RATE) # マイク入力のリングバッファ
+_capture_reader_lock = threading.Lock() # capture_ringを読み出す録音セッションは同時に1つだけ
+input_overflows = 0 # PortAudioが報告した入力のオーバーフローの回数
+input_resampler = None # マイクのネイティブ形式からSAMPLE_RATEのモノラルへの変換（16kHzモノラルで取り込む場合はNone）
+clock = time.monotonic # 音声ブロックの取り込み時刻に使う時計（ワーカーの時刻と比べるためmonotonic。ベンチマークでは差し替える）
 FILLER_WORDS = []
+_filler_filter = None # フィラー語リストと置換辞書のマッチャー（load_filler_wordsで作成）
+_REPEATED_DELIMITER_PATTERN = re.compile(r"([、。,\s])\1+")
+_LEADING_DELIMITER_PATTERN = re.compile(r"^[、。,\s]+")
 
 def load_filler_words():
-    global FILLER_WORDS
+    """
+    フィラー語リストと置換辞書を読み込む（ファイルがなければ既定の内容で作成する）。
+    以降はremove_filler_wordsの呼び出し時にファイルの更新を検知して自動で再読み込みする。
+    """
+    global FILLER_WORDS, _filler_filter
     filler_file = app_config["filler_words_file"]
-    if os.path.exists(filler_file):
-        with open(filler_file, "r", encoding="utf-8") as f:
-            FILLER_WORDS = [line.strip() for line in f if line.strip()]
-    else:
+    replacement_file = app_config.get("replacement_words_file", "replacement_words.txt")
+    if not os.path.exists(filler_file):
         default_filler_words = [
             "えーっと", "えーと", "えっと", "えー", "ええ",
             "あー", "あーあ", "ああ",
@@ -44,162 +71,256 @@ def load_filler_words():
         with open(filler_file, "w", encoding="utf-8") as f:
             for word in default_filler_words:
                 f.write(word + "\n")
-        FILLER_WORDS = default_filler_words
+    if replacement_file and not os.path.exists(replacement_file):
+        with open(replacement_file, "w", encoding="utf-8") as f:
+            f.write("# 置換辞書: 「元の語句=>置換後の語句」を1行に1組ずつ記述します。\n")
+            f.write("# 例: ウィスパー=>Whisper\n")
+    _filler_filter = FillerFilter(filler_file, replacement_file)
+    _filler_filter.get_matcher()
+    FILLER_WORDS = _filler_filter.filler_words
+
+def set_clock(new_clock):
+    """取り込み時刻に使う時計を差し替える（リプレイ用の疑似時計など）。"""
+    global clock
+    clock = new_clock
+
+def set_input_format(sample_rate, channels):
+    """
+    マイク入力の形式を設定し、入力ストリームのブロック長（0はPortAudioに任せる）を返す。
+    16kHzモノラル以外の場合は、SAMPLE_RATEのモノラルに変換するリサンプラーを用意する（ストリームを開く前に呼ぶ）。
+    """
+    global input_resampler
+    if int(round(sample_rate)) == SAMPLE_RATE and channels == CHANNELS:
+        input_resampler = None
+        return 0
+    input_resampler = StreamingResampler(sample_rate, SAMPLE_RATE, channels)
+    print(f"マイク入力を{sample_rate:g}Hz・{channels}chで取り込み、{SAMPLE_RATE}Hz・モノラルに変換します。")
+    return input_resampler.preferred_block_frames(CAPTURE_BLOCK_MS)
 
 def audio_callback(indata, frames, time, status):
-    if status:
-        print(status, flush=True)
-    audio_queue.put(indata.copy())
-
-
-
-recorded_frames = []
-is_speaking = False
-silence_start_time = None
-waiting_start_time = None
-
-def reset_recording_state():
-    """録音状態をリセットする"""
-    global recorded_frames, is_speaking, silence_start_time, waiting_start_time
-    recorded_frames = []
-    is_speaking = False
-    silence_start_time = None
-    waiting_start_time = None
-    # キューをクリアする
-    while not audio_queue.empty():
-        try:
-            audio_queue.get_nowait()
-        except queue.Empty:
-            break
-
-def audio_stream_generator(is_recording):
+    # リアルタイムで呼ばれるため、表示はせず、変換とリングバッファへのコピーだけを行う
+    # （リサンプラーは同じ長さのブロックが続く限りメモリを確保しない）
+    global input_overflows
+    if status and status.input_overflow:
+        input_overflows += 1
+    samples = indata[:, 0] if input_resampler is None else input_resampler.process(indata)
+    capture_ring.write(samples, clock())
+
+
+
+class RecordingSession:
     """
-    音声入力ストリームを管理し、無音区間で区切られた音声チャンクを生成するジェネレータ。
-    `is_recording`がFalseになるか、一定時間（long_silence_duration_s）待機状態が続いた場合に停止する。
+    1回の録音（ホットキーで開始してから停止・自動停止するまで）を処理し、無音区間で区切った音声チャンク(AudioChunk)を
+    on_chunk(chunk)で渡す。発話の状態はすべてセッションが持ち、録音スレッドもセッションごとに起動する。
+    録音スレッドはポーリングせず、マイク入力の書き込み・停止要求・自動停止の期限のいずれかが起きるまで待つため、
+    停止や区切りの判定は音声ブロック1つ分の遅れで行われる。
+    マイク入力はcapture_ringから読み出し、発話はあらかじめ確保したUtteranceBufferに蓄える。
+    音声区間はVAD（vad_mode）がフレーム単位で判定し、無音の長さはサンプル数で数える。
+    発話開始時には直前のvad_preroll_ms分の音声を先頭に付け加える。
+    各チャンクにはVADが検出した音声区間(speech_regions)を添え、ワーカー側のVADを省略できるようにする。
+    `streaming_partial_enabled`が有効な場合、発話中も`partial_interval_s`秒分の音声が増えるごとに
+    発話開始からの音声全体を途中認識用チャンク(is_final=False)として渡す。
+    stop()が呼ばれるか、一定時間（long_silence_duration_s）待機状態が続いた場合に終了し、on_stopped(session, reason)を呼ぶ
+    （reasonは"stopped"または"auto"）。flush_on_stopがTrueの場合は、停止時に発話途中の音声も最終チャンクとして渡す。
+    capture_ringを読むセッションは同時に1つだけで、停止したセッションの処理が終わってから次のセッションが読み始める。
     """
-    global recorded_frames, is_speaking, silence_start_time, waiting_start_time
-
-    reset_recording_state() # 開始時に状態をリセット
-    waiting_start_time = time.time()
-    long_silence_duration = app_config.get("long_silence_duration_s", 10.0)
-    print("\nマイクに向かって話してください。待機中...")
-
-    while is_recording.is_set():
-        # --- 1. 長い無音による自動停止をチェック (ループの最優先事項) ---
-        if waiting_start_time:
-            elapsed_time = time.time() - waiting_start_time
-            if elapsed_time > long_silence_duration:
-                print(f"{long_silence_duration}秒間待機状態が続いたため、録音を自動停止します。")
-                is_recording.clear()
-                break
-
-        # --- 2. キューから音声データを取得 ---
-        try:
-            audio_chunk = audio_queue.get(timeout=0.1) # タイムアウト付きで待機
-        except queue.Empty:
-            continue # タイムアウトした場合はループの先頭に戻り、is_recordingを再チェック
-
-        # --- 3. 音声データを処理 ---
-        rms = np.sqrt(np.mean(audio_chunk.astype(np.float32)**2))
-
-        if rms > SILENCE_THRESHOLD:
-            if not is_speaking:
-                print("音声検知...")
-                is_speaking = True
-                if waiting_start_time:
-                    waiting_start_time = None
-            
-            recorded_frames.append(audio_chunk)
-            silence_start_time = None
-
-        elif is_speaking:
-            recorded_frames.append(audio_chunk)
-            if silence_start_time is None:
-                silence_start_time = time.time()
-
-            if time.time() - silence_start_time > app_config.get("silence_duration_s", 2.0):
-                print(f"{app_config.get('silence_duration_s', 2.0)}秒間の無音を検出。音声チャンクを処理します。")
-                if recorded_frames:
-                    audio_data = np.concatenate(recorded_frames, axis=0)
-                    yield audio_data
-
-                is_speaking = False
-                silence_start_time = None
-                recorded_frames = []
-                if waiting_start_time is None:
-                    waiting_start_time = time.time()
-                print("\nマイクに向かって話してください。待機中...")
-
-    if recorded_frames:
-        print("録音終了。残りの音声チャンクを処理します。")
-        audio_data = np.concatenate(recorded_frames, axis=0)
-        yield audio_data
-    
-    reset_recording_state() # 終了時にも状態をリセット
 
+    def __init__(self, on_chunk, on_stopped=None, flush_on_stop=False):
+        self.on_chunk = on_chunk
+        self.on_stopped = on_stopped
+        self.flush_on_stop = flush_on_stop
+        self.vad = create_vad(app_config, SAMPLE_RATE, SILENCE_THRESHOLD)
+        self.frame_length = frame_length = self.vad.frame_length
+        self.silence_duration = app_config.get("silence_duration_s", 2.0)
+        self.silence_frames_limit = max(1, int(np.ceil(self.silence_duration * SAMPLE_RATE / frame_length)))
+        self.long_silence_duration = app_config.get("long_silence_duration_s", 10.0)
+        self.preroll = FrameRing(int(app_config.get("vad_preroll_ms", 200) * SAMPLE_RATE / 1000 / frame_length), frame_length)
+        self.streaming_partial = app_config.get("streaming_partial_enabled", False)
+        self.partial_interval_samples = int(app_config.get("partial_interval_s", 1.0) * SAMPLE_RATE)
+        self.region_padding_s = app_config.get("speech_region_padding_s", 0.2)
+        self.region_merge_gap_s = app_config.get("speech_region_merge_gap_s", 0.5)
+        self.lookback_frames = max(1, int(app_config.get("forced_cut_lookback_s", 2.0) * SAMPLE_RATE / frame_length))
+        self.overlap_frames = int(app_config.get("forced_cut_overlap_s", 0.5) * SAMPLE_RATE / frame_length)
+        self.max_utterance_frames = int(app_config.get("max_utterance_s", 0) * SAMPLE_RATE / frame_length)
+        if self.max_utterance_frames:
+            self.max_utterance_frames = max(self.max_utterance_frames, self.overlap_frames + 2)
+        # 強制的に区切る長さ（無効な場合は30秒）を初期サイズとして確保し、発話ごとに再利用する
+        self.recorded = UtteranceBuffer(
+            frame_length, (self.max_utterance_frames or int(30 * SAMPLE_RATE / frame_length)) + self.preroll.max_frames
+        )
+        self.is_speaking = False
+        self.chunk_overlap_s = 0.0 # recordedの先頭のうち、前のチャンクと重なっている秒数
+        self.samples_since_partial = 0
+        self.waiting_samples = 0 # 待機状態（発話していない状態）が続いているサンプル数
+        self.silent_frames = 0 # 発話中に無音フレームが続いている数
+        self.speech_start_at = None
+        self.speech_end_at = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def stop_requested(self):
+        return self._stop_event.is_set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止を要求する（待たない）。録音スレッドはすぐに起こされ、処理中の音声ブロックの後で終了する。"""
+        self._stop_event.set()
+        capture_ring.wakeup.set()
+
+    def join(self, timeout=None):
+        """録音スレッドの終了を待ち、終了していればTrueを返す。"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+            return not self._thread.is_alive()
+        return True
+
+    def _run(self):
+        with _capture_reader_lock:
+            overruns_at_start = capture_ring.overruns
+            overflows_at_start = input_overflows
+            capture_ring.start()
+            print("\nマイクに向かって話してください。待機中...")
+            try:
+                reason = self._capture()
+            finally:
+                capture_ring.stop()
+        if self.flush_on_stop and self.is_speaking and self.recorded.frame_count:
+            print("録音終了。残りの音声チャンクを処理します。")
+            self._emit(is_final=True, decided_at=clock())
+
+        overruns = capture_ring.overruns - overruns_at_start
+        overflows = input_overflows - overflows_at_start
+        if overruns or overflows:
+            print(f"警告: 録音中に音声の取りこぼしがありました (バッファの溢れ: {overruns}回, "
+                  f"合計{capture_ring.dropped_samples / SAMPLE_RATE:.1f}秒, 入力のオーバーフロー: {overflows}回)")
+        if self.on_stopped:
+            self.on_stopped(self, reason)
+
+    def _capture(self):
+        """停止するまで音声ブロックを処理し、停止の理由を返す。"""
+        idle_deadline = time.monotonic() + self.long_silence_duration
+        while True:
+            capture_ring.wakeup.clear()
+            if self._stop_event.is_set():
+                return "stopped"
+            block = capture_ring.read(MAX_READ_SAMPLES)
+            if block is None:
+                # マイク入力・停止要求・自動停止の期限のいずれかを待つ（音声が届かなくなった場合も期限で止まる）
+                if self.is_speaking:
+                    capture_ring.wakeup.wait()
+                    continue
+                remaining = idle_deadline - time.monotonic()
+                if remaining <= 0 or not capture_ring.wakeup.wait(min(remaining, threading.TIMEOUT_MAX)):
+                    print(f"{self.long_silence_duration}秒間待機状態が続いたため、録音を自動停止します。")
+                    return "auto"
+                continue
+            samples, captured_at = block
+            self._process_block(samples, captured_at)
+            # 待機状態の長さは音声のサンプル数で数え、音声が届かない間は同じ残り時間を実時間で待つ
+            remaining_s = self.long_silence_duration - self.waiting_samples / SAMPLE_RATE
+            if not self.is_speaking and remaining_s < 0:
+                print(f"{self.long_silence_duration}秒間待機状態が続いたため、録音を自動停止します。")
+                return "auto"
+            idle_deadline = time.monotonic() + remaining_s
+
+    def _emit(self, is_final, decided_at, frame_count=None, continues=False):
+        if self._stop_event.is_set() and not self.flush_on_stop:
+            return # 停止を要求された後に区切ったチャンクは渡さない
+        flags = self.recorded.speech_flags(frame_count)
+        regions = speech_regions(flags, self.frame_length, SAMPLE_RATE, self.region_padding_s, self.region_merge_gap_s)
+        self.on_chunk(AudioChunk(
+            self.recorded.audio(frame_count),
+            is_final=is_final,
+            speech_regions=regions,
+            voiced_s=np.count_nonzero(flags) * self.frame_length / SAMPLE_RATE,
+            speech_start_at=self.speech_start_at,
+            speech_end_at=self.speech_end_at,
+            decided_at=decided_at,
+            continues=continues,
+            overlap_s=self.chunk_overlap_s,
+        ))
+
+    def _find_cut_frame(self):
+        """直近lookback_framesのうち、最もエネルギーの小さいフレームの位置（その直後で区切る）を返す。"""
+        start = max(self.overlap_frames + 1, self.recorded.frame_count - self.lookback_frames)
+        energies = frame_energy_db(self.recorded.frames(start))
+        return start + int(np.argmin(energies))
+
+    def _process_block(self, samples, captured_at):
+        """音声ブロックをフレーム単位でVADにかけ、発話の区切り・強制的な区切り・途中認識を判定する。"""
+        frame_length = self.frame_length
+        recorded = self.recorded
+        # framesはリングバッファのビューのため、発話バッファとプリロールにコピーし終えてからconsumeする
+        frames, speech_flags = self.vad.process(samples)
+        for index, (frame, is_speech) in enumerate(zip(frames, speech_flags)):
+            # 読み出した範囲の取り込み時刻から、このフレームの終端の時刻を求める
+            frame_end_at = captured_at - (len(frames) - 1 - index) * frame_length / SAMPLE_RATE
+            if is_speech:
+                if not self.is_speaking:
+                    print("音声検知...")
+                    self.is_speaking = True
+                    recorded.clear()
+                    recorded.append(self.preroll.ordered(), False)
+                    self.preroll.clear()
+                    self.samples_since_partial = 0
+                    self.speech_start_at = frame_end_at - frame_length / SAMPLE_RATE
+                    self.chunk_overlap_s = 0.0
+                recorded.append(frame[np.newaxis], True)
+                self.samples_since_partial += frame_length
+                self.silent_frames = 0
+                self.speech_end_at = frame_end_at
+
+            elif self.is_speaking:
+                recorded.append(frame[np.newaxis], False)
+                self.samples_since_partial += frame_length
+                self.silent_frames += 1
+
+                if self.silent_frames >= self.silence_frames_limit:
+                    print(f"{self.silence_duration}秒間の無音を検出。音声チャンクを処理します。")
+                    self._emit(is_final=True, decided_at=frame_end_at)
+
+                    self.is_speaking = False
+                    self.silent_frames = 0
+                    recorded.clear()
+                    self.waiting_samples = 0
+                    print("\nマイクに向かって話してください。待機中...")
 
+            else:
+                self.preroll.append(frame)
+                self.waiting_samples += frame_length
 
-def remove_filler_words(text):
+            # 発話が長すぎる場合は、直近で最も静かな位置で強制的に区切る
+            if self.is_speaking and self.max_utterance_frames and recorded.frame_count >= self.max_utterance_frames:
+                cut_frame = self._find_cut_frame()
+                print(f"発話が{app_config['max_utterance_s']}秒を超えたため、音声チャンクを区切って処理します。")
+                self._emit(is_final=True, decided_at=frame_end_at, frame_count=cut_frame + 1, continues=True)
+                # 区切り位置の前後で語が欠けないよう、末尾overlap_frames分を次のチャンクの先頭に重ねる
+                recorded.drop_front(cut_frame + 1 - self.overlap_frames)
+                self.chunk_overlap_s = self.overlap_frames * frame_length / SAMPLE_RATE
+                self.samples_since_partial = 0
 
-    filler_pattern = "|".join(FILLER_WORDS)
-    cleaned_text = re.sub(filler_pattern, "", text)
-    cleaned_text = re.sub(r"([、。,\s])\1+", r"\1", cleaned_text).strip()
-    cleaned_text = re.sub(r"^[、。,\s]+", "", cleaned_text)
-    return cleaned_text
+            # 発話中の途中認識用チャンクを生成
+            if self.streaming_partial and self.is_speaking and self.samples_since_partial >= self.partial_interval_samples:
+                self.samples_since_partial = 0
+                self._emit(is_final=False, decided_at=frame_end_at)
 
-def transcribe_audio(audio_data, current_prompt=""):
-    global model
-    if model is None:
-        device = "cpu"
-        compute_type = app_config.get("compute_type", "int8")
+        capture_ring.consume(len(samples))
 
-        if app_config.get("use_gpu", False):
-            if torch.cuda.is_available():
-                device = "cuda"
-                print(f"CUDA (GPU) が利用可能です。device='{device}', compute_type='{compute_type}' でモデルをロードします。")
-            else:
-                print("警告: 'use_gpu'がTrueですが、CUDAが利用できません。CPUにフォールバックします。")
-                # use_gpu設定は変更せず、このセッションのみCPUを使用する
-        else:
-            print(f"CPUを使用します。device='{device}', compute_type='{compute_type}' でモデルをロードします。")
-
-        print(f"Whisperモデル({MODEL_SIZE})をロードしています...")
-        try:
-            model = WhisperModel(MODEL_SIZE, device=device, compute_type=compute_type)
-            print("モデルのロードが完了しました。")
-        except Exception as e:
-            print(f"エラー: モデルのロードに失敗しました。 {e}")
-            if device == "cuda":
-                print("CUDAでのモデルロードに失敗したため、CPUにフォールバックして再試行します。")
-                device = "cpu"
-                model = WhisperModel(MODEL_SIZE, device=device, compute_type=compute_type)
-                print("CPUでのモデルロードが完了しました。")
-            else:
-                raise e
-
-    if audio_data is None:
-        return ""
-
-    audio_flat = audio_data.flatten()
-    audio_float32 = audio_flat.astype(np.float32) / 32768.0
-
-    print("文字起こしを開始します...")
-    start_time = time.time()
-    segments, info = model.transcribe(
-        audio_float32,
-        beam_size=5,
-        language=app_config["language"],
-        vad_filter=True,
-        initial_prompt=current_prompt
-    )
-
-    print(f"[DEBUG] Detected language: '{info.language}' with probability {info.language_probability:.2f}")
-    transcribed_text = "".join(segment.text for segment in segments)
-    end_time = time.time()
-    processing_time = end_time - start_time
-    print(f"文字起こし完了 (処理時間: {processing_time:.2f}秒)")
-
-    return transcribed_text
+
+
+def remove_filler_words(text):
+    """フィラー語を除去し、置換辞書の語句を置き換えたうえで、余分な区切り文字を整理する。"""
+    global FILLER_WORDS
+    matcher = _filler_filter.get_matcher()
+    FILLER_WORDS = _filler_filter.filler_words
+    cleaned_text = matcher.apply(text)
+    cleaned_text = _REPEATED_DELIMITER_PATTERN.sub(r"\1", cleaned_text).strip()
+    cleaned_text = _LEADING_DELIMITER_PATTERN.sub("", cleaned_text)
+    return cleaned_text
 
 # --- 初期化 ---
 load_filler_words()
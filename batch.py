@@ -0,0 +1,402 @@
+import json
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+
+from config import app_config
+from audio_processor import SAMPLE_RATE, SILENCE_THRESHOLD, remove_filler_words
+from vad import create_vad, speech_regions
+from shared_audio import SharedAudioRing
+from worker_pool import TranscriptionWorkerPool, wait_for_workers
+from transcription_server import RemoteWorkerPool
+
+# トレイアプリを使わずに、音声ファイルをまとめて文字起こしするバッチ処理（python main.py batch）。
+# 音声はPyAVで少しずつデコードし、VADで無音の位置を探して区切ったチャンクを文字起こしプロセスのプールに送る。
+# 結果はチャンクの順にJSONL/SRTへ追記し、チャンクごとの進捗をマニフェストに記録する。
+# 途中で中断した場合は、マニフェストから続きのチャンクだけを処理する。
+
+# --- 定数 ---
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".m4a", ".aac", ".flac", ".ogg", ".opus", ".wma", ".mp4", ".mkv", ".webm")
+OUTPUT_FORMATS = ("jsonl", "srt")
+MANIFEST_FILE = "manifest.jsonl"
+CUT_SILENCE_S = 0.3 # チャンクの区切りに使う無音の最短の長さ（秒）
+
+
+def find_audio_files(paths):
+    """ファイルとディレクトリ（再帰的に探索）から音声ファイルを探し、(パス, 出力名) のリストを返す。"""
+    jobs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(AUDIO_EXTENSIONS):
+                        file_path = os.path.join(root, name)
+                        jobs.append((file_path, os.path.relpath(file_path, path)))
+        elif os.path.isfile(path):
+            jobs.append((path, os.path.basename(path)))
+        else:
+            print(f"警告: '{path}' が見つかりません。")
+    return jobs
+
+def decode_audio_blocks(path):
+    """
+    音声ファイルをPyAVで少しずつデコードし、16kHz・モノラルのint16ブロックを順に返す。
+    ファイル全体をメモリに読み込まないため、数時間の録音でも使用メモリは一定。
+    """
+    import av
+
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLE_RATE)
+    with av.open(path) as container:
+        stream = container.streams.audio[0]
+        for frame in container.decode(stream):
+            for resampled in resampler.resample(frame):
+                yield resampled.to_ndarray().reshape(-1)
+        for resampled in resampler.resample(None):
+            yield resampled.to_ndarray().reshape(-1)
+
+def segment_audio(blocks, segment_s, max_segment_s):
+    """
+    音声ブロックをVADで判定し、segment_s秒を超えたあとの最初の無音（CUT_SILENCE_S秒以上）で区切る。
+    無音が見つからない場合はmax_segment_s秒で区切る。
+    (チャンク先頭のサンプル位置, 音声, 音声区間) を順に返す。音声区間が空のチャンクも返す。
+    """
+    vad = create_vad(app_config, SAMPLE_RATE, SILENCE_THRESHOLD)
+    frame_length = vad.frame_length
+    segment_frames = int(segment_s * SAMPLE_RATE / frame_length)
+    max_segment_frames = max(segment_frames, int(max_segment_s * SAMPLE_RATE / frame_length))
+    cut_silence_frames = max(1, int(CUT_SILENCE_S * SAMPLE_RATE / frame_length))
+    padding_s = app_config.get("speech_region_padding_s", 0.2)
+    merge_gap_s = app_config.get("speech_region_merge_gap_s", 0.5)
+
+    frames = []
+    flags = []
+    start_sample = 0
+    silent_frames = 0
+
+    def make_chunk():
+        regions = speech_regions(flags, frame_length, SAMPLE_RATE, padding_s, merge_gap_s)
+        return start_sample, np.concatenate(frames), regions
+
+    for block in blocks:
+        block_frames, block_flags = vad.process(block)
+        for frame, is_speech in zip(block_frames, block_flags):
+            frames.append(frame)
+            flags.append(bool(is_speech))
+            silent_frames = 0 if is_speech else silent_frames + 1
+            if (len(frames) >= segment_frames and silent_frames >= cut_silence_frames) \
+                    or len(frames) >= max_segment_frames:
+                yield make_chunk()
+                start_sample += len(frames) * frame_length
+                frames = []
+                flags = []
+                silent_frames = 0
+    if frames:
+        yield make_chunk()
+
+def format_srt_time(seconds):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600 * 1000)
+    minutes, milliseconds = divmod(milliseconds, 60 * 1000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+
+def file_identity(path):
+    """ファイルが変更されていないかを確認するための (サイズ, 更新時刻) を返す。"""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class Manifest:
+    """
+    チャンクごとの進捗を追記するマニフェスト（JSONL）。
+    各行には、そのチャンクまでを書き込んだ時点の出力ファイルのサイズを記録する。
+    再開時は出力ファイルをそのサイズに切り詰めてから、続きのチャンクを処理する。
+    """
+
+    def __init__(self, path, overwrite=False):
+        self.path = path
+        self.entries = {} # ファイルのパス -> 最後の記録
+        if overwrite and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # 書き込み途中で中断した行
+                    self.entries[entry["file"]] = entry
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def state(self, path):
+        """ファイルの続きの処理状態を返す。ファイルが変更されている場合は最初からやり直す。"""
+        entry = self.entries.get(os.path.abspath(path))
+        if entry is None or tuple(entry["identity"]) != file_identity(path):
+            return None
+        return entry
+
+    def append(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class OutputWriter:
+    """1つの音声ファイルの文字起こし結果を、JSONL/SRTファイルに追記する。"""
+
+    def __init__(self, path, output_base, formats, state):
+        self.path = path
+        self.abspath = os.path.abspath(path)
+        self.identity = file_identity(path)
+        output_paths = {output_format: f"{output_base}.{output_format}" for output_format in formats}
+        if state is not None and not self._outputs_match(output_paths, state["outputs"]):
+            state = None # 出力ファイルが記録と一致しないため、最初からやり直す
+        self.next_chunk = state["chunk"] + 1 if state else 0
+        self.failed = False # 文字起こしできなかったチャンクがあれば、それ以降は出力もマニフェストも更新しない
+        self.srt_index = state["srt_index"] if state else 0
+        os.makedirs(os.path.dirname(output_base) or ".", exist_ok=True)
+        self.files = {}
+        for output_format, output_path in output_paths.items():
+            if state:
+                # 最後に記録したチャンクより後に書き込まれた部分を切り詰める
+                output_file = open(output_path, "r+b")
+                output_file.truncate(state["outputs"][output_format])
+                output_file.seek(0, os.SEEK_END)
+            else:
+                output_file = open(output_path, "wb")
+            self.files[output_format] = output_file
+
+    @staticmethod
+    def _outputs_match(output_paths, sizes):
+        for output_format, output_path in output_paths.items():
+            if output_format not in sizes or not os.path.exists(output_path):
+                return False
+            if os.path.getsize(output_path) < sizes[output_format]:
+                return False
+        return True
+
+    def write_segments(self, offset_s, segments):
+        """チャンク内のセグメント（チャンク先頭基準の秒）を、ファイル先頭基準の時刻で書き込む。"""
+        for start, end, text in segments:
+            cleaned_text = remove_filler_words(text)
+            if not cleaned_text:
+                continue
+            start += offset_s
+            end += offset_s
+            if "jsonl" in self.files:
+                line = json.dumps(
+                    {"start": round(start, 3), "end": round(end, 3), "text": cleaned_text, "original_text": text.strip()},
+                    ensure_ascii=False,
+                )
+                self.files["jsonl"].write((line + "\n").encode("utf-8"))
+            if "srt" in self.files:
+                self.srt_index += 1
+                block = f"{self.srt_index}\n{format_srt_time(start)} --> {format_srt_time(end)}\n{cleaned_text}\n\n"
+                self.files["srt"].write(block.encode("utf-8"))
+        for output_file in self.files.values():
+            output_file.flush()
+
+    def sizes(self):
+        return {output_format: output_file.tell() for output_format, output_file in self.files.items()}
+
+    def close(self):
+        for output_file in self.files.values():
+            output_file.close()
+
+
+class BatchTranscriber:
+    """
+    音声ファイルのチャンクを文字起こしプロセスのプールに投入し、結果をチャンクの順に書き込む。
+    処理中のチャンク数を制限し、デコード済みの音声が溜まりすぎないようにする。
+    """
+
+    def __init__(self, output_dir, formats, worker_count, engine="whisper", config_overrides=None, overwrite=False,
+                 server_address=None):
+        self.output_dir = output_dir
+        self.formats = formats
+        self.segment_s = app_config.get("batch_segment_s", 30.0)
+        self.max_segment_s = self.segment_s * 2
+        self.max_inflight = max(2, worker_count * 2)
+        os.makedirs(output_dir, exist_ok=True)
+        self.manifest = Manifest(os.path.join(output_dir, MANIFEST_FILE), overwrite)
+        self.output_queue = multiprocessing.Queue()
+        self.control_queue = multiprocessing.Queue()
+        self.ring = SharedAudioRing.create(int(self.max_segment_s * SAMPLE_RATE) * self.max_inflight)
+        if server_address:
+            # 文字起こしサーバーのモデルを使う（ワーカーの数はサーバーのもの）
+            self.pool = RemoteWorkerPool.connect(
+                server_address, self.output_queue, self.control_queue, self.ring, name="batch"
+            )
+            if self.pool is None:
+                self.ring.close()
+                raise RuntimeError(f"文字起こしサーバー({server_address})に接続できませんでした。")
+        else:
+            self.pool = TranscriptionWorkerPool(
+                worker_count, self.output_queue, self.control_queue, self.ring, engine, config_overrides
+            )
+        self.inflight_slots = threading.BoundedSemaphore(self.max_inflight)
+        self.lock = threading.Lock()
+        self.requests = {} # seq -> 書き込み先と位置
+        self.next_seq = 0
+
+    def start(self):
+        """文字起こしプロセスを起動し、すべてのモデルの準備ができるまで待つ。"""
+        self.pool.start()
+        self.pool.start_supervisor(app_config.get("worker_heartbeat_timeout_s", 10.0))
+        if not wait_for_workers(self.pool, self.control_queue):
+            raise RuntimeError("文字起こしプロセスを起動できませんでした。")
+
+    def _register(self, request):
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.requests[seq] = request
+        return seq
+
+    def submit_chunk(self, writer, chunk_index, start_sample, audio, regions):
+        offset_s = start_sample / SAMPLE_RATE
+        request = {"kind": "chunk", "writer": writer, "chunk": chunk_index, "offset_s": offset_s,
+                   "end_s": offset_s + len(audio) / SAMPLE_RATE}
+        if not regions:
+            # 音声区間のないチャンクはワーカーに送らず、そのまま進捗だけを記録する
+            seq = self._register(request)
+            self.output_queue.put({"seq": seq, "segments": []})
+            return
+        self.inflight_slots.acquire()
+        location = self.ring.write(audio)
+        request["location"] = location
+        seq = self._register(request)
+        message = {"seq": seq, "prompt": app_config.get("default_initial_prompt", ""), "speech_regions": regions}
+        if location is None:
+            message["audio"] = audio
+        else:
+            message["offset"], message["length"] = location
+        self.pool.submit(message)
+
+    def submit_marker(self, writer, kind):
+        """ファイルの終了（"done"）または失敗（"error"）を、チャンクと同じ順序で書き込み側に伝える。"""
+        seq = self._register({"kind": kind, "writer": writer})
+        self.output_queue.put({"seq": seq, "segments": []})
+
+    def collect_results(self):
+        """結果を連番順に並べ替え、出力ファイルとマニフェストに書き込む。"""
+        reorder_buffer = {}
+        next_delivery_seq = 0
+        while True:
+            result = self.output_queue.get()
+            if result is None:
+                break
+            if "worker_id" in result:
+                if not self.pool.complete(result):
+                    # 失敗として扱った依頼の結果が、あとから届いた
+                    continue
+                with self.lock:
+                    location = self.requests[result["seq"]].get("location")
+                if location is not None:
+                    self.ring.release(location[0])
+                self.inflight_slots.release()
+            reorder_buffer[result["seq"]] = result
+            while next_delivery_seq in reorder_buffer:
+                result = reorder_buffer.pop(next_delivery_seq)
+                with self.lock:
+                    request = self.requests.pop(next_delivery_seq)
+                next_delivery_seq += 1
+                self.deliver(request, result)
+
+    def deliver(self, request, result):
+        writer = request["writer"]
+        if request["kind"] == "chunk":
+            if writer.failed:
+                return
+            status = result.get("status", "ok")
+            if status != "ok":
+                # 空の結果を完了として記録すると再開時にこのチャンクが飛ばされるため、ファイルを失敗として扱う
+                writer.failed = True
+                print(f"エラー: {writer.path}: {request['offset_s']:.1f}秒からのチャンクを文字起こしできませんでした "
+                      f"(status: {status})。次回の実行でこのチャンクから処理し直します。")
+                return
+            writer.write_segments(request["offset_s"], result["segments"])
+            self.manifest.append({
+                "file": writer.abspath,
+                "identity": writer.identity,
+                "chunk": request["chunk"],
+                "end_s": round(request["end_s"], 3),
+                "srt_index": writer.srt_index,
+                "outputs": writer.sizes(),
+            })
+            print(f"[バッチ] {writer.path}: {request['end_s']:.1f}秒まで完了")
+        elif request["kind"] == "done" and not writer.failed:
+            writer.close()
+            self.manifest.append({"file": writer.abspath, "identity": writer.identity, "done": True})
+            print(f"[バッチ] {writer.path}: 完了しました。")
+        else:
+            writer.close()
+
+    def transcribe_file(self, path, output_name):
+        state = self.manifest.state(path)
+        if state is not None and state.get("done"):
+            print(f"[バッチ] {path}: 処理済みのためスキップします。")
+            return
+        output_base = os.path.join(self.output_dir, os.path.splitext(output_name)[0])
+        writer = OutputWriter(path, output_base, self.formats, state)
+        if writer.next_chunk:
+            print(f"[バッチ] {path}: チャンク{writer.next_chunk}から再開します。")
+        try:
+            chunks = segment_audio(decode_audio_blocks(path), self.segment_s, self.max_segment_s)
+            for chunk_index, (start_sample, audio, regions) in enumerate(chunks):
+                if chunk_index < writer.next_chunk:
+                    continue # 処理済みのチャンク（区切り位置を再現するためデコードとVADだけ行う）
+                self.submit_chunk(writer, chunk_index, start_sample, audio, regions)
+        except Exception as e:
+            print(f"エラー: {path} の処理中にエラーが発生しました。 {e}")
+            self.submit_marker(writer, "error")
+            return
+        self.submit_marker(writer, "done")
+
+    def run(self, jobs):
+        result_thread = threading.Thread(target=self.collect_results)
+        result_thread.start()
+        try:
+            for index, (path, output_name) in enumerate(jobs, 1):
+                print(f"[バッチ] ({index}/{len(jobs)}) {path}")
+                self.transcribe_file(path, output_name)
+        finally:
+            # 投入済みのチャンクがすべて書き込まれてから終了する
+            self.pool.stop()
+            self.output_queue.put(None)
+            result_thread.join()
+            self.ring.close()
+            self.manifest.close()
+        for line in self.pool.stats_lines():
+            print(f"[統計] {line}")
+
+
+def run_batch(args):
+    """python main.py batch の処理を実行する。"""
+    jobs = find_audio_files(args.inputs)
+    if not jobs:
+        print("文字起こしする音声ファイルがありません。")
+        return
+    formats = OUTPUT_FORMATS if args.format == "both" else (args.format,)
+    worker_count = args.workers or app_config["num_transcription_workers"]
+    config_overrides = {"num_transcription_workers": worker_count}
+    if args.model:
+        config_overrides["model_size"] = args.model
+    server_address = app_config.get("transcription_server_address") if args.server else None
+    if args.server and not server_address:
+        print("エラー: --server を使うには、設定ファイルのtranscription_server_addressにサーバーのアドレスを指定してください。")
+        return
+    transcriber = BatchTranscriber(
+        args.output_dir, formats, worker_count, args.engine, config_overrides, overwrite=args.overwrite,
+        server_address=server_address,
+    )
+    transcriber.start()
+    transcriber.run(jobs)
@@ -0,0 +1,295 @@
+import argparse
+import dataclasses
+import json
+import multiprocessing
+import threading
+import time
+import tracemalloc
+import wave
+
+import numpy as np
+
+import audio_processor
+from audio_processor import (
+    SAMPLE_RATE,
+    BLOCKSIZE,
+    audio_callback,
+    RecordingSession,
+    set_input_format,
+)
+import main as app # アプリのパイプライン（投入・結果の並べ替え・挿入）
+import metrics
+import text_inserter
+from config import app_config
+from shared_audio import SharedAudioRing
+from startup_profile import get_rss_mb
+from worker_pool import TranscriptionWorkerPool, wait_for_workers
+
+# WAVファイルを audio_callback → RecordingSession → main.pyのパイプライン（投入・ワーカー・並べ替え・フィラー除去・
+# テキストの挿入（キー入力の代わりに記録するrecording方式））の実際の経路に実時間より速く流し込み、区切り判定の遅延・RTF・発話終了から挿入までの遅延・
+# ピークメモリをJSONで出力するベンチマーク。
+#
+#   python benchmark.py recordings/*.wav --engine stub
+#   python benchmark.py recordings/*.wav --engine whisper --model-dir models/small
+
+# --- 定数 ---
+RSS_UNAVAILABLE = "unavailable" # 常駐メモリを取得できない環境でのpeak_memory_mbの値
+
+
+class ReplayClock:
+    """リプレイ用の疑似時計。流し込んだ音声の長さだけ進む。"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def __call__(self):
+        return self.now
+
+
+def load_wav(path):
+    """
+    16bitのWAVファイルを読み込み、(int16配列 (フレーム数, チャンネル数), サンプリングレート) を返す。
+    16kHzモノラル以外のファイルは、マイクをネイティブ形式で取り込む場合と同じくaudio_callbackで変換される。
+    """
+    with wave.open(path, "rb") as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f"{path}: 16bit PCMのWAVファイルのみ対応しています。")
+        sample_rate = f.getframerate()
+        channels = f.getnchannels()
+        samples = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+    return samples.reshape(-1, channels), sample_rate
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+def summarize(values):
+    return {
+        "mean": float(np.mean(values)) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "max": float(np.max(values)) if values else None,
+    }
+
+
+def utterance_result(entry):
+    """metricsが記録した1発話分の計測結果を、レポートの形式にする。"""
+    stages = entry["stages"]
+    return {
+        "seq": entry["seq"],
+        "worker_id": entry["worker_id"],
+        "profile": entry["profile"],
+        "audio_s": entry["audio_s"],
+        "segmentation_latency_s": stages["segmentation"],
+        "processing_s": stages["decode"],
+        "rtf": stages["decode"] / entry["audio_s"] if entry["audio_s"] else None,
+        "insert_s": stages["insert"],
+        "end_of_speech_to_insert_s": stages["total"],
+        "worker_rss_mb": entry["worker_rss_mb"],
+        "chars": entry["chars"],
+    }
+
+
+class ReplayRun:
+    """
+    1つのWAVファイルを実際の経路に流し込み、発話ごとの計測結果を集める。
+    区切った発話はmain.submit_chunkに渡し、結果はmain.collect_resultsが挿入する（ゲート・デコード設定の選択・
+    継ぎ目の重なりの除去・破棄の判定もアプリと同じ）。発話ごとの計測結果はmetricsの記録から受け取る。
+    """
+
+    def __init__(self, samples, sample_rate, clock, speed, trailing_silence_s):
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.clock = clock
+        self.speed = speed
+        self.trailing_silence_s = trailing_silence_s
+        self.session = RecordingSession(self.submit, flush_on_stop=True)
+        self.peak_main_rss_mb = 0.0
+
+    def feed(self):
+        """音声をブロックごとにaudio_callbackへ渡す。speed倍速で流し、疑似時計を音声の長さだけ進める。"""
+        # 録音セッションがリングバッファへの書き込みを開始するまで待つ
+        while not audio_processor.capture_ring.enabled:
+            time.sleep(0.01)
+        channels = self.samples.shape[1]
+        silence = np.zeros((int(self.trailing_silence_s * self.sample_rate), channels), dtype=np.int16)
+        audio = np.concatenate((self.samples, silence))
+        blocksize = set_input_format(self.sample_rate, channels) or BLOCKSIZE
+        block_s = blocksize / self.sample_rate
+        for start in range(0, len(audio), blocksize):
+            block = audio[start:start + blocksize]
+            self.clock.advance(len(block) / self.sample_rate)
+            audio_callback(block, len(block), None, None)
+            rss_mb = get_rss_mb()
+            if rss_mb is not None:
+                self.peak_main_rss_mb = max(self.peak_main_rss_mb, rss_mb)
+            if self.speed > 0:
+                time.sleep(block_s / self.speed)
+        # 最後のブロックが処理されるまで待ってから録音を止める
+        while audio_processor.capture_ring.available():
+            time.sleep(0.01)
+        self.session.stop()
+        self.session.join()
+
+    def submit(self, chunk):
+        """
+        録音セッションが区切ったチャンクをアプリと同じくmain.submit_chunkに渡す（録音スレッドから呼ばれる）。
+        チャンクの時刻は疑似時計（音声の時刻）のため、区切りを判定した時点を現在の実時間に合わせて置き換え、
+        発話の開始・終了はそこから音声の長さだけさかのぼった時刻にする（以降の区間はアプリと同じ時計で計測される）。
+        """
+        decided_wall = time.monotonic()
+
+        def to_wall(at):
+            return None if at is None else decided_wall - (chunk.decided_at - at)
+
+        app.submit_chunk(dataclasses.replace(
+            chunk,
+            speech_start_at=to_wall(chunk.speech_start_at),
+            speech_end_at=to_wall(chunk.speech_end_at),
+            decided_at=decided_wall,
+        ))
+
+    def wait_delivered(self):
+        """投入したすべての依頼の結果が挿入（または破棄）されるまで待つ。"""
+        while True:
+            with app.pipeline_lock:
+                if not app.pending_requests and not app.reorder_buffer:
+                    return
+            time.sleep(0.01)
+
+    def run(self):
+        self.session.start()
+        self.feed()
+        self.wait_delivered()
+
+
+def run_benchmark(paths, engine, model_dir, stub_rtf, speed, workers):
+    # ベンチマーク中は自動停止と途中認識を無効にし、発話の区切りだけを計測する
+    app_config["long_silence_duration_s"] = 1e9
+    app_config["streaming_partial_enabled"] = False
+    app_config["insertion_backend"] = "recording" # 実際のキー入力の代わりに挿入結果を記録する
+    clock = ReplayClock()
+    audio_processor.set_clock(clock)
+    recorder = text_inserter.get_backend("recording")
+    entries = []
+    metrics.add_listener(entries.append)
+
+    config_overrides = {"stub_rtf": stub_rtf}
+    if model_dir:
+        config_overrides["model_size"] = model_dir
+    control_queue = multiprocessing.Queue()
+    ring = SharedAudioRing.create(int(app_config["shared_audio_buffer_s"] * SAMPLE_RATE))
+    pool = TranscriptionWorkerPool(workers, app.transcription_output_queue, control_queue, ring, engine, config_overrides)
+    app.shared_audio_ring = ring
+    app.worker_pool = pool
+
+    start_time = time.perf_counter()
+    pool.start()
+    pool.start_supervisor(app_config.get("worker_heartbeat_timeout_s", 10.0))
+    ready = wait_for_workers(pool, control_queue)
+    if len(ready) < pool.worker_count:
+        raise RuntimeError("初期化に失敗したワーカーがあります。")
+    app.worker_ready.set()
+    startup_s = time.perf_counter() - start_time
+
+    trailing_silence_s = app_config.get("silence_duration_s", 1.0) + 0.5
+    files = []
+    audio_total_s = 0.0
+    peak_main_rss_mb = 0.0
+    rss_available = get_rss_mb() is not None
+    if not rss_available:
+        print(f"警告: この環境では常駐メモリを取得できないため、ピークメモリのmain_rssは"
+              f"\"{RSS_UNAVAILABLE}\"になります（psutilをインストールしてください）。")
+    result_thread = threading.Thread(target=app.collect_results)
+    result_thread.start()
+    tracemalloc.start()
+    replay_start = time.perf_counter()
+    try:
+        for path in paths:
+            samples, sample_rate = load_wav(path)
+            file_start = time.perf_counter()
+            first_entry = len(entries)
+            text_start = len(recorder.text)
+            run = ReplayRun(samples, sample_rate, clock, speed, trailing_silence_s)
+            run.run()
+            audio_s = len(samples) / sample_rate
+            audio_total_s += audio_s
+            peak_main_rss_mb = max(peak_main_rss_mb, run.peak_main_rss_mb)
+            files.append({
+                "path": path,
+                "audio_s": audio_s,
+                "replay_wall_s": time.perf_counter() - file_start,
+                "utterances": [utterance_result(entry) for entry in entries[first_entry:]],
+                "text": recorder.text[text_start:],
+            })
+        replay_wall_s = time.perf_counter() - replay_start
+        _, peak_traced = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        app.transcription_output_queue.put(None)
+        result_thread.join()
+        pool.stop()
+        ring.close()
+
+    utterances = [utterance for file in files for utterance in file["utterances"]]
+    speech_audio_s = sum(u["audio_s"] for u in utterances)
+    processing_s = sum(u["processing_s"] for u in utterances)
+    # ワーカーの常駐メモリは、準備完了時（モデルのロード後）と各発話の推論後の値のうち最大のもの
+    worker_rss = [
+        rss_mb for rss_mb in [message["rss_mb"] for message in ready] + [u["worker_rss_mb"] for u in utterances]
+        if rss_mb is not None
+    ]
+    return {
+        "engine": engine,
+        "model_dir": model_dir,
+        "workers": pool.worker_count,
+        "speed": speed,
+        "worker_startup_s": startup_s,
+        "worker_ready": ready,
+        "files": files,
+        "summary": {
+            "files": len(files),
+            "utterances": len(utterances),
+            # 挿入せずに破棄した発話（ゲートで捨てたもの・失敗・期限切れ）。推論時間やRTFには含めない
+            "discarded": dict(app.discarded_results),
+            "audio_s": audio_total_s,
+            "replay_wall_s": replay_wall_s,
+            "replay_speed": audio_total_s / replay_wall_s if replay_wall_s else None,
+            "speech_audio_s": speech_audio_s,
+            "processing_s": processing_s,
+            "rtf": processing_s / speech_audio_s if speech_audio_s else None,
+            "segmentation_latency_s": summarize([u["segmentation_latency_s"] for u in utterances]),
+            "insert_s": summarize([u["insert_s"] for u in utterances]),
+            "end_of_speech_to_insert_s": summarize([u["end_of_speech_to_insert_s"] for u in utterances]),
+            "peak_memory_mb": {
+                "main_traced": peak_traced / (1024 * 1024),
+                "main_rss": peak_main_rss_mb if rss_available else RSS_UNAVAILABLE,
+                "worker_rss": max(worker_rss) if worker_rss else RSS_UNAVAILABLE,
+            },
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="WhispTypeのリプレイベンチマーク")
+    parser.add_argument("wav_files", nargs="+", help="16bitのWAVファイル（16kHzモノラル以外はアプリ内で変換する）")
+    parser.add_argument("--engine", choices=["stub", "whisper"], default="stub", help="文字起こしエンジン")
+    parser.add_argument("--model-dir", help="whisperエンジンで使うローカルのモデルディレクトリ")
+    parser.add_argument("--stub-rtf", type=float, default=0.1, help="stubエンジンの処理時間（音声長に対する比）")
+    parser.add_argument("--speed", type=float, default=20.0, help="実時間に対する流し込みの速さ（0は待たずに流す）")
+    parser.add_argument("--workers", type=int, default=1, help="文字起こしプロセスの数")
+    parser.add_argument("--output", help="結果のJSONを書き出すファイル（省略時は標準出力）")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.wav_files, args.engine, args.model_dir, args.stub_rtf, args.speed, args.workers)
+    report_json = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report_json)
+        print(f"ベンチマーク結果を {args.output} に書き出しました。")
+    else:
+        print(report_json)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import threading
+
+import numpy as np
+
+# 録音用のバッファ。
+# CaptureRingはPortAudioのコールバック（書き込み側）と録音スレッド（読み出し側）が1つずつの
+# リングバッファで、コールバック内ではメモリを確保せず、あらかじめ確保した配列にコピーするだけにする。
+# 書き込み位置と読み出し位置はそれぞれ片側だけが更新するため、ロックを使わない。
+# 書き込むたびにwakeupをセットし、読み出し側はポーリングせずにそれを待つ。
+# UtteranceBufferとFrameRingは録音スレッド側で発話とプリロールを保持する、再利用される配列。
+
+
+class CaptureRing:
+    """単一の書き込み側と単一の読み出し側で使う、int16音声の固定長リングバッファ。"""
+
+    def __init__(self, capacity, sample_rate):
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+        self._scratch = np.zeros(capacity, dtype=np.int16) # 折り返した範囲を連続した配列として返すための領域
+        self._head = (0, 0.0) # (これまでに書き込んだサンプル数, 最後のサンプルの取り込み時刻)。書き込み側だけが更新する
+        self._tail = 0 # これまでに読み出したサンプル数。読み出し側だけが更新する
+        self.enabled = False # Falseの間は書き込まない（録音していない間にバッファが溢れるのを防ぐ）
+        self.wakeup = threading.Event() # 書き込むたびにセットされる（読み出し側の停止要求などでもセットしてよい）
+        self.overruns = 0 # 空きが足りずにブロックを捨てた回数
+        self.dropped_samples = 0
+
+    def write(self, samples, captured_at):
+        """
+        ブロックを書き込む（コールバックから呼ぶ）。空きが足りない場合はブロックを捨ててFalseを返す。
+        samplesの最後のサンプルの取り込み時刻をcaptured_atで渡す。
+        """
+        if not self.enabled:
+            return True
+        head, _ = self._head
+        length = len(samples)
+        if head + length - self._tail > self.capacity:
+            self.overruns += 1
+            self.dropped_samples += length
+            self.wakeup.set()
+            return False
+        start = head % self.capacity
+        first = min(length, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        if first < length:
+            self.buffer[:length - first] = samples[first:]
+        self._head = (head + length, captured_at)
+        self.wakeup.set()
+        return True
+
+    def available(self):
+        return self._head[0] - self._tail
+
+    def read(self, max_length):
+        """
+        未読のサンプルを古い順に最大max_length個、(ビュー, 最後のサンプルの取り込み時刻) で返す。なければNone（待たない）。
+        ビューはconsume()を呼ぶまで有効で、折り返していない限りコピーしない。
+        未読がmax_lengthより多い場合の取り込み時刻は、最新のサンプルの時刻からサンプル数で逆算する。
+        """
+        head, captured_at = self._head
+        if head == self._tail:
+            return None
+        length = head - self._tail
+        if length > max_length:
+            captured_at -= (length - max_length) / self.sample_rate
+            length = max_length
+        start = self._tail % self.capacity
+        if start + length <= self.capacity:
+            return self.buffer[start:start + length], captured_at
+        first = self.capacity - start
+        self._scratch[:first] = self.buffer[start:]
+        self._scratch[first:length] = self.buffer[:length - first]
+        return self._scratch[:length], captured_at
+
+    def consume(self, length):
+        """読み出したサンプルを解放し、書き込み側が再利用できるようにする。"""
+        self._tail += length
+
+    def start(self):
+        """未読のサンプルを捨てて書き込みを開始する（読み出し側から呼ぶ）。"""
+        self._tail = self._head[0]
+        self.wakeup.clear()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+
+class UtteranceBuffer:
+    """発話中のフレームと、各フレームがVADで音声と判定されたかどうかを保持する。配列は再利用する。"""
+
+    def __init__(self, frame_length, initial_frames):
+        self.frame_length = frame_length
+        self.samples = np.zeros(max(1, initial_frames) * frame_length, dtype=np.int16)
+        self.flags = np.zeros(max(1, initial_frames), dtype=bool)
+        self.frame_count = 0
+
+    def _reserve(self, frame_count):
+        if frame_count <= len(self.flags):
+            return
+        # 想定より長い発話（max_utterance_sが0の場合など）では倍の大きさに拡張する
+        new_frames = max(frame_count, 2 * len(self.flags))
+        samples = np.zeros(new_frames * self.frame_length, dtype=np.int16)
+        samples[:self.frame_count * self.frame_length] = self.samples[:self.frame_count * self.frame_length]
+        flags = np.zeros(new_frames, dtype=bool)
+        flags[:self.frame_count] = self.flags[:self.frame_count]
+        self.samples = samples
+        self.flags = flags
+
+    def append(self, frames, is_speech):
+        """フレーム (n, frame_length) を末尾に追加する。is_speechはboolまたはフレームごとの配列。"""
+        count = len(frames)
+        self._reserve(self.frame_count + count)
+        start = self.frame_count * self.frame_length
+        self.samples[start:start + count * self.frame_length] = frames.reshape(-1)
+        self.flags[self.frame_count:self.frame_count + count] = is_speech
+        self.frame_count += count
+
+    def audio(self, frame_count=None):
+        """先頭からframe_count個のフレームの音声をビューで返す（次にバッファを変更するまで有効）。"""
+        frame_count = self.frame_count if frame_count is None else frame_count
+        return self.samples[:frame_count * self.frame_length]
+
+    def speech_flags(self, frame_count=None):
+        frame_count = self.frame_count if frame_count is None else frame_count
+        return self.flags[:frame_count]
+
+    def frames(self, start, end=None):
+        """start番目からend番目までのフレームを (n, frame_length) のビューで返す。"""
+        end = self.frame_count if end is None else end
+        return self.samples[start * self.frame_length:end * self.frame_length].reshape(-1, self.frame_length)
+
+    def drop_front(self, frame_count):
+        """先頭のframe_count個のフレームを取り除き、残りを先頭に詰める。"""
+        remaining = self.frame_count - frame_count
+        self.samples[:remaining * self.frame_length] = \
+            self.samples[frame_count * self.frame_length:self.frame_count * self.frame_length].copy()
+        self.flags[:remaining] = self.flags[frame_count:self.frame_count].copy()
+        self.frame_count = remaining
+
+    def clear(self):
+        self.frame_count = 0
+
+
+class FrameRing:
+    """直近max_frames個のフレームを保持する（発話開始前のプリロール用）。"""
+
+    def __init__(self, max_frames, frame_length):
+        self.frames = np.zeros((max_frames, frame_length), dtype=np.int16)
+        self.max_frames = max_frames
+        self.count = 0
+        self._next = 0
+
+    def append(self, frame):
+        if not self.max_frames:
+            return
+        self.frames[self._next] = frame
+        self._next = (self._next + 1) % self.max_frames
+        self.count = min(self.count + 1, self.max_frames)
+
+    def ordered(self):
+        """保持しているフレームを古い順に返す。"""
+        if self.count < self.max_frames:
+            return self.frames[:self.count]
+        return np.roll(self.frames, -self._next, axis=0)
+
+    def clear(self):
+        self.count = 0
+        self._next = 0
@@ -8,13 +8,71 @@ CONFIG_FILE = "config.json"
 DEFAULT_CONFIG = {
     "language": "ja",
     "mic_device_index": None, # Noneはデフォルトのマイクを使用
+    "mic_device_name": "", # 選択したマイクの表示名（デバイスの抜き差しで番号が変わっても同じマイクを探す）
+    "capture_native_rate": True, # マイクをネイティブのサンプリングレート・チャンネル数で開き、アプリ内で16kHzモノラルに変換するかどうか
     "filler_words_file": "filler_words.txt", # フィラー語リストのファイル名
+    "replacement_words_file": "replacement_words.txt", # 置換辞書のファイル名
     "use_gpu": True, # GPUを使用するかどうか
     "compute_type": "int8", # "int8" or "float16"
+    "model_size": "small", # Whisperモデルのサイズ（"tiny", "base", "small", "medium", "large-v3"など）またはモデルのディレクトリ
+    "max_resident_models": 2, # 1プロセスに常駐させるモデルの最大数（超えた場合は最も長く使われていないモデルを解放）
+    "model_memory_budget_mb": 0, # 常駐させるモデルのメモリの上限（MB、0は無制限）
+    "model_idle_unload_s": 0, # この秒数だけ文字起こしが行われなければモデルを解放する（0は解放しない）
+    "routing_fast_model": "", # 短い発話に使う軽いモデル（"tiny"など、空文字で無効）
+    "routing_short_s": 3.0, # この秒数以下の発話を軽いモデルの対象にする
+    "routing_latency_target_s": 0.5, # 既定のモデルの計測RTFでこの秒数を超えそうな短い発話だけ軽いモデルで処理する
+    "num_transcription_workers": 1, # 文字起こしプロセスの数
+    "cpu_threads": 0, # 1プロセスあたりのCTranslate2の計算スレッド数（0は自動）
+    "num_inter_workers": 1, # 1プロセス内で並列に推論できる数（CTranslate2のnum_workers）
+    "batched_min_duration_s": 0.0, # この秒数以上の発話はバッチ推論で処理する（0は無効）
+    "batch_size": 8, # バッチ推論のバッチサイズ
+    "batch_segment_s": 30.0, # バッチ文字起こし（main.py batch）で音声を区切るおおよその長さ（秒）
     "long_silence_duration_s": 3.0, # 長い沈黙の閾値（秒）
     "default_initial_prompt": "以下の内容について、実装を行います。", # 初期プロンプト
-    "clear_clipboard_after_insert": False, # 挿入後にクリップボードをクリアするかどうか
-    "silence_duration_s": 1.0 # 沈黙の閾値（秒）
+    "insertion_backend": "auto", # テキストの挿入方式（"auto", "unicode", "clipboard", "null", "recording"）
+    "insertion_window_backends": {}, # ウィンドウクラス名ごとに使う挿入方式（autoの場合のみ。例: {"TscShellContainerClass": "clipboard"}）
+    "clipboard_restore": True, # クリップボード経由で挿入した後、元のクリップボードの内容（テキスト）を復元するかどうか
+    "clear_clipboard_after_insert": False, # 挿入後にクリップボードをクリアするかどうか（復元する内容がない場合）
+    "max_inflight_requests": 3, # 結果を待たずにワーカーへ投入できる文字起こし依頼の最大数
+    "decoding_profile": "accuracy", # デコード設定（"latency", "balanced", "accuracy", "auto"）
+    "decoding_auto_rtf_target": 0.5, # autoの場合、計測したRTFがこれを超えたら軽い設定に下げる
+    "decoding_auto_max_queue": 1, # autoの場合、結果待ちの依頼がこの数を超えたら軽い設定に下げる
+    "request_deadline_s": 20.0, # 文字起こし依頼の期限（投入からの秒数。これに音声の長さ×request_deadline_rtfを足す。0で無効）
+    "request_deadline_rtf": 2.0, # 期限に加える、音声1秒あたりの秒数
+    "worker_heartbeat_timeout_s": 10.0, # 文字起こしプロセスの応答がこの秒数途絶えたら再起動する（0で無効）
+    "worker_stall_timeout_s": 120.0, # 推論がこの秒数進まなければ（セグメントが1つもデコードされなければ）再起動する（0で無効）
+    "shutdown_timeout_s": 5.0, # 終了時に文字起こしプロセスの終了を待つ最大の秒数（超えた場合は強制終了する）
+    "transcription_server_address": "", # 文字起こしサーバーのアドレス（host:port または unix:パス。空文字の場合は接続せず、自身で文字起こしプロセスを起動する）
+    "metrics_window": 200, # 処理時間の統計に使う直近の発話数
+    "metrics_log_file": "metrics.jsonl", # 発話ごとの処理時間を記録するログファイル（空文字で無効）
+    "metrics_log_max_bytes": 1048576, # ログファイルをローテーションするサイズ（バイト）
+    "metrics_log_backup_count": 3, # ローテーションで残す古いログファイルの数
+    "metrics_port": 0, # 処理時間の統計を http://127.0.0.1:<port>/metrics で公開するポート（0で無効）
+    "journal_enabled": False, # 発話ごとの音声（FLAC）と文字起こし結果・処理時間を記録するかどうか（python main.py replay で再生できる）
+    "journal_dir": "journal", # 発話の記録を保存するディレクトリ
+    "journal_segment_max_bytes": 16777216, # 記録のセグメントファイル1つあたりの最大サイズ（バイト）
+    "journal_max_segments": 8, # 残すセグメントファイルの数（超えた場合は古いものから削除）
+    "silence_duration_s": 1.0, # 沈黙の閾値（秒）
+    "max_utterance_s": 20.0, # 発話がこの秒数を超えたら、無音を待たずに区切って文字起こしする（0で無効）
+    "forced_cut_lookback_s": 2.0, # 強制的に区切るとき、直近この秒数の中で最も静かな位置を探す
+    "forced_cut_overlap_s": 0.5, # 強制的に区切ったチャンクの末尾を、次のチャンクの先頭にこの秒数だけ重ねる
+    "streaming_partial_enabled": False, # 発話中に途中認識を行い、確定した部分から挿入するかどうか
+    "partial_interval_s": 1.0, # 途中認識を行う間隔（音声の秒数）
+    "shared_audio_buffer_s": 120.0, # ワーカーと共有する音声バッファの長さ（秒）
+    "vad_mode": "adaptive", # "adaptive"(適応ノイズフロア) or "energy"(固定閾値)
+    "vad_frame_ms": 20, # VADのフレーム長（10〜30ミリ秒）
+    "vad_start_margin_db": 12.0, # ノイズフロアからこれだけ大きいと発話開始とみなす(dB)
+    "vad_stop_margin_db": 6.0, # 発話中、ノイズフロアからこれだけ大きい間は発話継続とみなす(dB)
+    "vad_preroll_ms": 200, # 発話開始の直前に付け加える音声の長さ（ミリ秒）
+    "use_frontend_vad": True, # 録音側のVADの音声区間を使い、ワーカーでのSilero VADを省略するかどうか
+    "speech_region_padding_s": 0.2, # 音声区間の前後に付け加える余白（秒）
+    "speech_region_merge_gap_s": 0.5, # 間隔がこれより短い音声区間は1つにまとめる（秒）
+    "speech_gate_enabled": True, # 咳や打鍵音など、発話でないチャンクを推論の前後で捨てるかどうか
+    "speech_gate_min_voiced_s": 0.3, # VADが音声と判定した長さがこれより短いチャンクは推論しない（秒）
+    "speech_gate_max_flatness": 0.45, # スペクトル平坦度がこれより大きい（雑音に近い）チャンクは推論しない
+    "speech_gate_min_band_ratio": 0.3, # 音声帯域(200〜4000Hz)のエネルギーの割合がこれより小さいチャンクは推論しない
+    "speech_gate_max_no_speech_prob": 0.6, # 推論後、no_speech_probがこれより大きく、かつ
+    "speech_gate_min_avg_logprob": -1.0 # avg_logprobがこれより小さいセグメントは除外する
 }
 
 # --- グローバル変数 ---
@@ -0,0 +1,101 @@
+import threading
+import time
+
+from config import app_config
+
+# Whisperのデコード設定（プロファイル）の定義と、負荷に応じた自動切り替え。
+# プロファイルはdecoding_profileで固定するか、"auto"で処理待ちの件数と計測したRTFから選ぶ。
+# 自動の場合は、依頼を投入するたびにselect_profileで使うプロファイルを決め、依頼とともにワーカーへ送る。
+# 処理待ちが多い・RTFが目標を超えた場合は1段階安い設定に下げ、ワーカーが空いていれば1段階上げる。
+# このモジュールは推論ライブラリを読み込まないため、UIプロセスからも文字起こしプロセスからも使える。
+
+# --- 定数 ---
+PROFILES = {
+    # 貪欲法、温度フォールバックなし、タイムスタンプなし
+    "latency": {"beam_size": 1, "best_of": 1, "temperature": 0.0, "without_timestamps": True},
+    "balanced": {"beam_size": 3, "best_of": 3, "temperature": (0.0, 0.4, 0.8), "without_timestamps": False},
+    # faster-whisperの既定値（ビームサーチ5、温度フォールバックあり）
+    "accuracy": {"beam_size": 5, "best_of": 5, "temperature": (0.0, 0.2, 0.4, 0.6, 0.8, 1.0), "without_timestamps": False},
+}
+PROFILE_ORDER = ["latency", "balanced", "accuracy"] # 処理の軽い順
+PROFILE_LABELS = {
+    "latency": "速度優先",
+    "balanced": "バランス",
+    "accuracy": "精度優先",
+}
+DEFAULT_PROFILE = "accuracy" # 自動の初期値、および不明な名前が指定された場合のプロファイル
+RTF_SMOOTHING = 0.3 # 計測した音声長・処理時間の指数移動平均の重み
+UPGRADE_MARGIN = 0.8 # 1段階上のプロファイルのRTFが目標のこの割合以下なら上げる
+RTF_STALE_S = 300.0 # この秒数より前に計測したRTFは、上げるかどうかの判断に使わない
+
+# --- グローバル変数 ---
+current_profile = DEFAULT_PROFILE # 自動の場合に現在選んでいるプロファイル
+_measurements = {} # プロファイル -> [音声長の移動平均, 処理時間の移動平均, 計測時刻]
+_lock = threading.Lock()
+
+
+def resolve(name):
+    """プロファイル名を検証し、不明な名前（"auto"を含む）はDEFAULT_PROFILEにする。"""
+    return name if name in PROFILES else DEFAULT_PROFILE
+
+def decode_options(name):
+    """プロファイルに対応するtranscribeの引数を返す。"""
+    return dict(PROFILES[resolve(name)])
+
+def measured_rtf(name):
+    """プロファイルで計測したRTF（音声長で重み付け）を返す。計測していなければNone。"""
+    measurement = _measurements.get(name)
+    if measurement is None:
+        return None
+    audio_s, processing_s, _ = measurement
+    return processing_s / audio_s if audio_s > 0 else None
+
+def record_result(name, audio_s, processing_s):
+    """プロファイルで文字起こしした1件の音声長と処理時間を記録する。"""
+    if name not in PROFILES or audio_s <= 0:
+        return
+    with _lock:
+        measurement = _measurements.get(name)
+        if measurement is None:
+            _measurements[name] = [audio_s, processing_s, time.monotonic()]
+            return
+        measurement[0] += (audio_s - measurement[0]) * RTF_SMOOTHING
+        measurement[1] += (processing_s - measurement[1]) * RTF_SMOOTHING
+        measurement[2] = time.monotonic()
+
+def select_profile(queue_depth, adapt=True):
+    """
+    次の依頼に使うプロファイル名を返す。decoding_profileが"auto"の場合は、queue_depth（結果待ちの依頼の数）と
+    計測したRTFから現在のプロファイルを上げ下げする。adaptがFalseの場合（モデルの準備中など）は切り替えない。
+    """
+    mode = app_config.get("decoding_profile", DEFAULT_PROFILE)
+    if mode != "auto":
+        return resolve(mode)
+    if not adapt:
+        return current_profile
+    target = app_config.get("decoding_auto_rtf_target", 0.5)
+    max_queue = app_config.get("decoding_auto_max_queue", 1)
+    with _lock:
+        index = PROFILE_ORDER.index(current_profile)
+        rtf = measured_rtf(current_profile)
+        if index > 0 and (queue_depth > max_queue or (rtf is not None and rtf > target)):
+            reason = f"処理待ち {queue_depth}件" if queue_depth > max_queue else f"RTF {rtf:.2f} > 目標 {target:.2f}"
+            _switch(PROFILE_ORDER[index - 1], reason)
+        elif index < len(PROFILE_ORDER) - 1 and queue_depth == 0:
+            upper = PROFILE_ORDER[index + 1]
+            upper_rtf = measured_rtf(upper)
+            stale = upper_rtf is None or time.monotonic() - _measurements[upper][2] > RTF_STALE_S
+            if stale or upper_rtf <= target * UPGRADE_MARGIN:
+                _switch(upper, "ワーカーが空いています")
+        return current_profile
+
+def _switch(name, reason):
+    global current_profile
+    print(f"[デコード設定] {PROFILE_LABELS[current_profile]} → {PROFILE_LABELS[name]} ({reason})")
+    current_profile = name
+
+def status_line():
+    """トレイ表示用に、自動で選んでいるプロファイルと計測したRTFを返す。"""
+    rtf = measured_rtf(current_profile)
+    rtf_text = f", RTF {rtf:.2f}" if rtf is not None else ""
+    return f"現在: {PROFILE_LABELS[current_profile]}{rtf_text}"
@@ -0,0 +1,145 @@
+import os
+
+# フィラー語の除去と語句の置換を行うマッチャー。
+# すべての語句を1つのトライ木にまとめ、各位置で最長一致した語句を置き換える。
+# 結果は語句の並び順に依存せず、処理時間は語句の数ではなく最長の語句の長さに比例する。
+#
+# フィラー語ファイルの書式（1行1語）:
+#   えーと      どこにあっても除去する
+#   ^その       節の先頭（文頭や「、」「。」の直後）にある場合だけ除去する
+#   # ...       コメント
+# 置換辞書ファイルの書式（1行1組）:
+#   ウィスパー=>Whisper
+
+# --- 定数 ---
+CLAUSE_START_MARK = "^"
+REPLACEMENT_SEPARATOR = "=>"
+CLAUSE_DELIMITERS = frozenset("、。，．,.!?！？　 \n")
+_TERMINAL = "" # トライ木のノードで語句の終端情報を保持するキー
+
+
+def parse_filler_lines(lines):
+    """フィラー語ファイルの各行を (語句, 節の先頭のみか) のリストに変換する。"""
+    entries = []
+    for line in lines:
+        word = line.strip()
+        if not word or word.startswith("#"):
+            continue
+        clause_start_only = word.startswith(CLAUSE_START_MARK)
+        if clause_start_only:
+            word = word[len(CLAUSE_START_MARK):].strip()
+        if word:
+            entries.append((word, clause_start_only))
+    return entries
+
+def parse_replacement_lines(lines):
+    """置換辞書ファイルの各行を {元の語句: 置換後の語句} に変換する。"""
+    replacements = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#") or REPLACEMENT_SEPARATOR not in line:
+            continue
+        source, target = line.split(REPLACEMENT_SEPARATOR, 1)
+        if source.strip():
+            replacements[source.strip()] = target.strip()
+    return replacements
+
+
+class FillerMatcher:
+    """フィラー語（空文字への置換）と置換辞書をまとめたトライ木による最長一致置換。"""
+
+    def __init__(self, filler_entries, replacements):
+        self.root = {}
+        self.entry_count = 0
+        for word, clause_start_only in filler_entries:
+            self._add(word, "", clause_start_only)
+        # 同じ語句がフィラー語と置換辞書の両方にある場合は置換辞書を優先する
+        for source, target in replacements.items():
+            self._add(source, target, False)
+
+    def _add(self, word, replacement, clause_start_only):
+        node = self.root
+        for char in word:
+            node = node.setdefault(char, {})
+        if _TERMINAL not in node:
+            self.entry_count += 1
+        node[_TERMINAL] = (replacement, clause_start_only)
+
+    @staticmethod
+    def _is_clause_start(output):
+        """これまでの出力の直後が節の先頭かどうか。"""
+        for piece in reversed(output):
+            if piece:
+                return piece[-1] in CLAUSE_DELIMITERS
+        return True
+
+    def apply(self, text):
+        output = []
+        i = 0
+        length = len(text)
+        while i < length:
+            node = self.root
+            match_end = -1
+            match_replacement = None
+            clause_start = None
+            j = i
+            while j < length:
+                node = node.get(text[j])
+                if node is None:
+                    break
+                j += 1
+                terminal = node.get(_TERMINAL)
+                if terminal is None:
+                    continue
+                replacement, clause_start_only = terminal
+                if clause_start_only:
+                    if clause_start is None:
+                        clause_start = self._is_clause_start(output)
+                    if not clause_start:
+                        continue
+                match_end = j
+                match_replacement = replacement
+            if match_end < 0:
+                output.append(text[i])
+                i += 1
+            else:
+                output.append(match_replacement)
+                i = match_end
+        return "".join(output)
+
+
+class FillerFilter:
+    """ファイルの更新時刻を確認し、変更があった場合だけマッチャーを作り直す。"""
+
+    def __init__(self, filler_file, replacement_file):
+        self.filler_file = filler_file
+        self.replacement_file = replacement_file
+        self.matcher = None
+        self.filler_words = []
+        self._mtimes = None
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    @staticmethod
+    def _read_lines(path):
+        if not path or not os.path.exists(path):
+            return []
+        with open(path, "r", encoding="utf-8") as f:
+            return f.readlines()
+
+    def get_matcher(self):
+        mtimes = (self._mtime(self.filler_file), self._mtime(self.replacement_file))
+        if self.matcher is None or mtimes != self._mtimes:
+            filler_entries = parse_filler_lines(self._read_lines(self.filler_file))
+            replacements = parse_replacement_lines(self._read_lines(self.replacement_file))
+            self.matcher = FillerMatcher(filler_entries, replacements)
+            self.filler_words = [word for word, _ in filler_entries]
+            if self._mtimes is not None:
+                print(f"フィラー語リスト/置換辞書を再読み込みしました ({self.matcher.entry_count}語)。")
+            self._mtimes = mtimes
+        return self.matcher
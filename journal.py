@@ -0,0 +1,331 @@
+import io
+import json
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+import wave
+
+import numpy as np
+
+from config import app_config
+from audio_processor import SAMPLE_RATE
+from shared_audio import SharedAudioRing
+from worker_pool import TranscriptionWorkerPool, wait_for_workers
+
+# 発話ごとの音声と文字起こし結果を記録するジャーナル（journal_enabledで有効）と、その再生（python main.py replay）。
+# 音声はFLACに圧縮し、プロンプト・文字起こし結果（元のテキストとフィラー除去後）・処理段階ごとの所要時間とともに
+# セグメントファイルへ追記する。セグメントは「segment-<番号>.audio」（FLACを連結したもの）と
+# 「segment-<番号>.jsonl」（1発話1行の索引。音声の位置と付加情報）の組で、サイズの上限を超えると次の番号に切り替え、
+# 古いセグメントから削除する。
+# 書き込みは専用のスレッドで行い、録音・推論の経路からはキューに入れるだけにする（キューが一杯なら記録を捨てる）。
+
+# --- 定数 ---
+SEGMENT_PATTERN = re.compile(r"^segment-(\d+)\.jsonl$")
+AUDIO_SUFFIX = ".audio"
+INDEX_SUFFIX = ".jsonl"
+QUEUE_MAX_ENTRIES = 64 # 書き込み待ちの記録の最大数
+
+
+def segment_numbers(directory):
+    """ディレクトリにあるセグメントの番号を昇順で返す。"""
+    if not os.path.isdir(directory):
+        return []
+    numbers = []
+    for name in os.listdir(directory):
+        match = SEGMENT_PATTERN.match(name)
+        if match:
+            numbers.append(int(match.group(1)))
+    return sorted(numbers)
+
+def segment_path(directory, number, suffix):
+    return os.path.join(directory, f"segment-{number:06d}{suffix}")
+
+def encode_flac(audio):
+    import soundfile as sf
+
+    buffer = io.BytesIO()
+    sf.write(buffer, audio, SAMPLE_RATE, format="FLAC", subtype="PCM_16")
+    return buffer.getvalue()
+
+def decode_flac(data):
+    import soundfile as sf
+
+    audio, _ = sf.read(io.BytesIO(data), dtype="int16")
+    return audio
+
+
+class JournalWriter:
+    """発話の記録をバックグラウンドのスレッドでセグメントファイルに書き込む。"""
+
+    def __init__(self, directory, segment_max_bytes, max_segments):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.max_segments = max(1, max_segments)
+        self.started_at = time.monotonic() # 記録する時刻の基準（発話の区切りを判定した時刻と同じ時計）
+        self.recorded = 0
+        self.dropped = 0 # キューが一杯で捨てた記録の数
+        self._queue = queue.Queue(maxsize=QUEUE_MAX_ENTRIES)
+        self._thread = None
+        self._number = None
+        self._audio_file = None
+        self._index_file = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get("journal_dir", "journal"),
+            config.get("journal_segment_max_bytes", 16 * 1024 * 1024),
+            config.get("journal_max_segments", 8),
+        )
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        print(f"発話の記録を {self.directory} に保存します。")
+
+    def record(self, audio, entry):
+        """
+        発話の音声（コピー済みのint16配列）と付加情報を書き込みキューに入れる。ブロックせず、
+        キューが一杯の場合は記録を捨ててFalseを返す。
+        """
+        try:
+            self._queue.put_nowait((audio, entry))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self):
+        """キューに残っている記録を書き込んでから終了する。"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self.dropped:
+            print(f"警告: 書き込みが追いつかず、発話の記録を{self.dropped}件捨てました。")
+
+    def _run(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                try:
+                    self._write(*item)
+                except Exception as e:
+                    print(f"エラー: 発話の記録を書き込めませんでした。 {e}")
+        finally:
+            self._close_segment()
+
+    def _write(self, audio, entry):
+        data = encode_flac(audio)
+        if self._audio_file is None or (
+            self._audio_file.tell() and self._audio_file.tell() + len(data) > self.segment_max_bytes
+        ):
+            self._rotate()
+        offset = self._audio_file.tell()
+        self._audio_file.write(data)
+        self._audio_file.flush()
+        entry = {**entry, "offset": offset, "length": len(data), "samples": len(audio), "sample_rate": SAMPLE_RATE}
+        self._index_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._index_file.flush()
+        self.recorded += 1
+
+    def _rotate(self):
+        """次の番号のセグメントを開き、max_segmentsを超えた古いセグメントを削除する。"""
+        self._close_segment()
+        numbers = segment_numbers(self.directory)
+        self._number = (numbers[-1] + 1) if numbers else 1
+        self._audio_file = open(segment_path(self.directory, self._number, AUDIO_SUFFIX), "wb")
+        self._index_file = open(segment_path(self.directory, self._number, INDEX_SUFFIX), "w", encoding="utf-8")
+        numbers.append(self._number)
+        for number in numbers[:-self.max_segments]:
+            for suffix in (AUDIO_SUFFIX, INDEX_SUFFIX):
+                path = segment_path(self.directory, number, suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _close_segment(self):
+        for f in (self._audio_file, self._index_file):
+            if f is not None:
+                f.close()
+        self._audio_file = self._index_file = None
+
+
+def read_journal(directory):
+    """ジャーナルの記録を古い順に (付加情報, int16音声) で返す。"""
+    for number in segment_numbers(directory):
+        audio_path = segment_path(directory, number, AUDIO_SUFFIX)
+        with open(segment_path(directory, number, INDEX_SUFFIX), "r", encoding="utf-8") as index_file, \
+                open(audio_path, "rb") as audio_file:
+            for line in index_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # 書き込み途中で終了した行
+                audio_file.seek(entry["offset"])
+                data = audio_file.read(entry["length"])
+                if len(data) < entry["length"]:
+                    continue
+                yield entry, decode_flac(data)
+
+def write_wav(path, audio):
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(audio.tobytes())
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+class JournalReplay:
+    """
+    ジャーナルの発話を、記録したプロンプトと音声区間のまま文字起こしプロセスのプールに投入し直す。
+    speedが0より大きい場合は、記録した発話の間隔をspeed倍速で再現して投入する（待ち行列による遅延も再現する）。
+    """
+
+    def __init__(self, worker_count, engine, config_overrides, speed):
+        self.speed = speed
+        self.output_queue = multiprocessing.Queue()
+        self.control_queue = multiprocessing.Queue()
+        self.ring = SharedAudioRing.create(int(app_config["shared_audio_buffer_s"] * SAMPLE_RATE))
+        self.pool = TranscriptionWorkerPool(
+            worker_count, self.output_queue, self.control_queue, self.ring, engine, config_overrides
+        )
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.results = []
+
+    def start(self):
+        """文字起こしプロセスを起動し、すべてのモデルの準備ができるまで待つ。"""
+        self.pool.start()
+        self.pool.start_supervisor(app_config.get("worker_heartbeat_timeout_s", 10.0))
+        if not wait_for_workers(self.pool, self.control_queue):
+            raise RuntimeError("文字起こしプロセスを起動できませんでした。")
+
+    def collect_results(self):
+        while True:
+            result = self.output_queue.get()
+            if result is None:
+                break
+            if not self.pool.complete(result):
+                continue # 失敗として知らせた後に届いた結果
+            with self.lock:
+                replayed = self.pending.pop(result["seq"])
+            if replayed["location"] is not None:
+                self.ring.release(replayed["location"][0])
+            entry = replayed["entry"]
+            recorded_decode_s = entry.get("stages", {}).get("decode")
+            self.results.append({
+                "index": result["seq"],
+                "seq": entry.get("seq"),
+                "time": entry.get("time"),
+                "status": result.get("status", "ok"),
+                "audio_s": entry.get("audio_s"),
+                "recorded_decode_s": recorded_decode_s,
+                "replayed_decode_s": result["processing_s"],
+                "replayed_latency_s": time.perf_counter() - replayed["submitted_at"],
+                "recorded_text": entry.get("worker_text"),
+                "replayed_text": result["text"],
+                "text_matches": result["text"] == entry.get("worker_text"),
+            })
+
+    def run(self, directory):
+        result_thread = threading.Thread(target=self.collect_results)
+        result_thread.start()
+        replay_start = time.perf_counter()
+        first_decided_s = None
+        try:
+            for seq, (entry, audio) in enumerate(read_journal(directory)):
+                decided_s = entry.get("decided_s")
+                if self.speed > 0 and decided_s is not None:
+                    # 記録した発話の間隔を再現する
+                    first_decided_s = decided_s if first_decided_s is None else first_decided_s
+                    wait_s = (decided_s - first_decided_s) / self.speed - (time.perf_counter() - replay_start)
+                    if wait_s > 0:
+                        time.sleep(wait_s)
+                location = self.ring.write(audio)
+                with self.lock:
+                    self.pending[seq] = {"entry": entry, "location": location, "submitted_at": time.perf_counter()}
+                message = {
+                    "seq": seq,
+                    "prompt": entry.get("prompt", ""),
+                    # 記録時と同じデコード設定で比べる（プロファイルを記録していない発話は設定のdecoding_profile）
+                    "profile": entry.get("profile"),
+                    "speech_regions": entry.get("speech_regions"),
+                    "overlap_s": entry.get("overlap_s", 0.0),
+                }
+                if location is None:
+                    message["audio"] = audio
+                else:
+                    message["offset"], message["length"] = location
+                self.pool.submit(message)
+        finally:
+            self.pool.stop()
+            self.output_queue.put(None)
+            result_thread.join()
+            self.ring.close()
+        self.results.sort(key=lambda result: result["index"])
+        return self.results
+
+
+def summarize_replay(results):
+    recorded = [r["recorded_decode_s"] for r in results if r["recorded_decode_s"] is not None]
+    # 失敗した発話は推論の時間に数えない
+    replayed = [r["replayed_decode_s"] for r in results if r["status"] == "ok"]
+    return {
+        "utterances": len(results),
+        "failed": sum(r["status"] != "ok" for r in results),
+        "text_matches": sum(r["text_matches"] for r in results),
+        "recorded_decode_p50_s": percentile(recorded, 50),
+        "recorded_decode_p95_s": percentile(recorded, 95),
+        "replayed_decode_p50_s": percentile(replayed, 50),
+        "replayed_decode_p95_s": percentile(replayed, 95),
+        "replayed_latency_p95_s": percentile([r["replayed_latency_s"] for r in results], 95),
+    }
+
+def run_replay(args):
+    """python main.py replay の処理を実行する。"""
+    directory = args.journal_dir or app_config.get("journal_dir", "journal")
+    if not segment_numbers(directory):
+        print(f"{directory} に発話の記録がありません。")
+        return
+    if args.export_wav:
+        os.makedirs(args.export_wav, exist_ok=True)
+        count = 0
+        for entry, audio in read_journal(directory):
+            write_wav(os.path.join(args.export_wav, f"{count:06d}.wav"), audio)
+            count += 1
+        print(f"{count}件の発話をWAVファイルとして {args.export_wav} に書き出しました。")
+        return
+
+    worker_count = args.workers or app_config["num_transcription_workers"]
+    config_overrides = {"num_transcription_workers": worker_count}
+    if args.model:
+        config_overrides["model_size"] = args.model
+    replay = JournalReplay(worker_count, args.engine, config_overrides, args.speed)
+    replay.start()
+    results = replay.run(directory)
+    for result in results:
+        mark = "" if result["text_matches"] else " [差分あり]"
+        if result["status"] != "ok":
+            mark = f" [失敗 (status: {result['status']})]"
+        recorded_s = result["recorded_decode_s"]
+        recorded_text = f"{recorded_s:.2f}秒" if recorded_s is not None else "-"
+        print(f"[再生] #{result['seq']} 推論 {recorded_text} → {result['replayed_decode_s']:.2f}秒{mark}")
+        if not result["text_matches"]:
+            print(f"    記録: {result['recorded_text']}")
+            print(f"    再生: {result['replayed_text']}")
+    report = {"summary": summarize_replay(results), "utterances": results}
+    print(json.dumps(report["summary"], ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"再生結果を {args.output} に書き出しました。")
@@ -7,35 +7,41 @@ os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 # ctranslate2から出るUserWarningを非表示にする
 warnings.filterwarnings("ignore", category=UserWarning, module="ctranslate2")
 
-import pyautogui
-from pynput import keyboard
+import startup_profile
+import metrics
+import text_inserter
+import decoding_profile
+import speech_gate
+import argparse
 import threading
-import pyperclip
 import time
 import multiprocessing # Add this import
-import sounddevice as sd
 
-from config import app_config, load_config
+# GUI関連（pyautogui, pynput, pyperclip, pystray）とsounddeviceは、spawn方式で
+# 文字起こしプロセスに読み込まれないよう、使用する関数の中でインポートする。
+from config import app_config, load_config, update_config
 from audio_processor import (
-    audio_stream_generator,
-    transcribe_audio,
+    RecordingSession,
     remove_filler_words,
     load_filler_words,
     SAMPLE_RATE,
     audio_callback,
-    reset_recording_state, # reset_recording_state をインポート
+    set_input_format,
 )
-from tray_menu import create_tray_icon
+from streaming import LocalAgreement, plan_text_update, trim_seam_overlap
+from shared_audio import SharedAudioRing
+from worker_pool import TranscriptionWorkerPool
+from transcription_server import RemoteWorkerPool, empty_result
 
 # --- グローバル変数 ---
 last_transcribed_text = ""
-_last_copied_text_by_app = None # アプリが最後にクリップボードにコピーしたテキスト
-is_recording = threading.Event() # is_recordingをthreading.Eventに変更
-transcription_thread = None
+recording_session = None # 録音中のRecordingSession（録音していない場合はNone）
+session_lock = threading.Lock() # recording_sessionの開始・停止を直列化する
 current_keys = set()
-HOTKEY_COMBINATION = {keyboard.Key.ctrl_l, keyboard.Key.alt_l, keyboard.Key.space}
+HOTKEY_COMBINATION = set() # main()でpynputを読み込んだ後に設定する
 transcription_history = [] 
 MAX_PROMPT_CHARS = 200
+SEAM_CHARS_PER_S = 16 # 強制的に区切ったチャンクの継ぎ目で、重なり1秒あたりに探す最大の文字数
 
 
 
@@ -55,112 +61,474 @@ def generate_initial_prompt():
             break
     return prompt_text
 
-audio_input_queue = multiprocessing.Queue()
 transcription_output_queue = multiprocessing.Queue()
+worker_control_queue = multiprocessing.Queue() # ワーカーからの状態通知（ready/error）
+worker_ready = threading.Event() # いずれかのワーカーの準備が完了したらセットされる
+worker_pool = None # 文字起こしプロセスのプール、または文字起こしサーバーへの接続（main()で作成）
+retired_pool = None # 止まった文字起こしサーバーへの接続（自身のプールに切り替えた後、失敗として返した結果を受け付ける）
+device_registry = None # 入力デバイスの一覧（main()で作成）
+mic_stream = None # マイク入力ストリーム（main()で作成）
+journal_writer = None # 発話の記録（journal_enabledの場合にmain()で作成）
+shared_audio_ring = None # ワーカーと共有する音声リングバッファ（main()で作成）
+
+# --- パイプライン（投入と結果の並べ替え） ---
+pipeline_lock = threading.Lock()
+inflight_slots = threading.BoundedSemaphore(max(1, app_config.get("max_inflight_requests", 3)))
+next_request_seq = 0
+next_delivery_seq = 0
+pending_requests = {} # 結果待ちの依頼 (seq -> 依頼情報)
+reorder_buffer = {} # 結果が届いたが、前の連番の結果を待っている依頼 (seq -> 依頼情報)
+delivery_agreement = LocalAgreement()
+delivery_inserted_text = "" # 現在の発話でカーソル位置に挿入済みのテキスト
+seam_text = "" # 発話の途中で区切った直前のチャンクの文字起こし結果（継ぎ目の重なりの除去用）
+session_generation = 0 # 録音セッションの世代（録音を止めるたびに増やし、それより前の依頼の結果は破棄する）
+delivery_generation = 0 # 最後に結果を反映した依頼の世代
+discarded_results = {} # 挿入せずに破棄した結果の数 (status -> 件数、録音を止めた後の結果は"cancelled")
+
+def watch_worker_control(icon):
+    """ワーカーからの状態通知を受け取り、準備完了状態とトレイ表示を更新する"""
+    from tray_menu import set_tray_status
+    startup_reported = False
+    while True:
+        message = worker_control_queue.get()
+        if message is None:
+            break
+        worker_id = message["worker_id"]
+        if message["type"] == "ready":
+            print(f"文字起こしプロセス{worker_id}の準備が完了しました (モデルロード: {message['load_s']:.2f}秒, ウォームアップ: {message['warmup_s']:.2f}秒)")
+            worker_pool.mark_ready(worker_id)
+            if not worker_ready.is_set():
+                worker_ready.set()
+                set_tray_status(icon, "ready")
+            if not startup_reported:
+                startup_reported = True
+                startup_profile.record("ワーカー: 推論モジュールのインポート", message["import_s"], message["rss_mb"])
+                startup_profile.record("ワーカー: モデルのロード", message["load_s"], message["rss_mb"])
+                startup_profile.record("ワーカー: ウォームアップ", message["warmup_s"], message["rss_mb"])
+                startup_profile.print_report()
+        elif message["type"] == "model_loaded":
+            memory = f"{message['memory_mb']:.0f}MB" if message["memory_mb"] is not None else "不明"
+            resident = ", ".join(
+                model["model"][0] + ("*" if model["active"] else "") for model in message["resident_models"]
+            )
+            print(f"文字起こしプロセス{worker_id}でモデル{message['model'][0]}の読み込みが完了しました "
+                  f"({message['load_s']:.2f}秒, メモリ: {memory}, 常駐: {resident})")
+        elif message["type"] == "model_unloaded":
+            memory = f"{message['memory_mb']:.0f}MB" if message["memory_mb"] is not None else "不明"
+            print(f"文字起こしプロセス{worker_id}は{message['idle_s']:.0f}秒間使われなかったため、"
+                  f"モデル({', '.join(message['models'])})を解放しました (解放したメモリ: {memory}, "
+                  f"モデルの読み込み時に計測: {message['model_memory_mb']:.0f}MB)")
+        elif message["type"] == "model_reloaded":
+            if message["trigger"] == "preload":
+                print(f"文字起こしプロセス{worker_id}で録音の開始と並行してモデルを読み込み直しました ({message['load_s']:.2f}秒)")
+            else:
+                print(f"文字起こしプロセス{worker_id}でモデルを読み込み直しました ({message['load_s']:.2f}秒、この分だけ文字起こしが遅れました)")
+        elif message["type"] in ("restarted", "disconnected"):
+            if message["type"] == "restarted":
+                print(f"文字起こしプロセス{worker_id}を再起動しました。処理中だった{message['failed']}件の依頼は破棄します。")
+            else:
+                print(f"警告: {message['reason']}。処理中だった{message['failed']}件の依頼は破棄し、再接続を試みます。")
+            if not worker_pool.ready_workers:
+                # 準備完了のワーカーがなくなった場合は、再起動したワーカーの準備完了までトレイ表示を戻す
+                worker_ready.clear()
+                set_tray_status(icon, "loading")
+        elif message["type"] == "server_lost":
+            print(f"警告: {message['reason']}。自身で文字起こしプロセスを起動して続行します。")
+            worker_ready.clear()
+            set_tray_status(icon, "loading")
+            fall_back_to_embedded_pool()
+        elif message["type"] == "error":
+            print(f"エラー: 文字起こしプロセス{worker_id}の初期化に失敗しました。 {message['message']}")
+            if not worker_ready.is_set():
+                set_tray_status(icon, "error")
+
+def start_embedded_pool():
+    """このプロセスで文字起こしプロセスのプールを起動し、監視を開始して返す。"""
+    pool = TranscriptionWorkerPool(
+        app_config["num_transcription_workers"],
+        transcription_output_queue,
+        worker_control_queue,
+        shared_audio_ring,
+    )
+    pool.start()
+    pool.start_supervisor(app_config.get("worker_heartbeat_timeout_s", 10.0))
+    return pool
+
+def fall_back_to_embedded_pool():
+    """文字起こしサーバーが止まった場合に、自身の文字起こしプロセスに切り替える（以降の依頼はそちらに送る）。"""
+    global worker_pool, retired_pool
+    pool = start_embedded_pool()
+    with pipeline_lock:
+        pool.set_generation(session_generation)
+        retired_pool, worker_pool = worker_pool, pool
+    retired_pool.stop(timeout=0)
+
+def complete_request(result):
+    """結果を受け取ったことをプールに伝える。どの依頼にも対応しない（遅れて届いた）結果ならFalseを返す。"""
+    if worker_pool.complete(result):
+        return True
+    # サーバーから切り替えた直後は、切り替え前の接続が失敗として返した結果が届く
+    return retired_pool is not None and retired_pool.complete(result)
+
+def change_model_setting(key, value):
+    """
+    トレイからモデルの設定（model_size, compute_type, use_gpu）を変更する。
+    録音と処理中の依頼はそのまま続け、各ワーカーは新しいモデルの読み込みが終わった時点で切り替える。
+    """
+    update_config(key, value)
+    worker_pool.broadcast({"type": "configure", "config": {key: value}})
 
-def transcription_worker(input_queue, output_queue):
+def change_mic_device(device):
     """
-    Whisperモデルをロードし、音声データを文字起こしするプロセス
+    トレイからマイクデバイスを変更する（deviceはDeviceRegistryのデバイス情報、Noneはデフォルト）。
+    入力ストリームをその場で開き直すため、再起動は不要で、録音中でもそのまま続けられる。
+    """
+    device_index = device["index"] if device else None
+    device_label = device["label"] if device else ""
+    update_config("mic_device_index", device_index)
+    update_config("mic_device_name", device_label)
+    mic_stream.switch(device_index, device_label)
+
+def submit_transcription(chunk, current_prompt, rejected=False):
+    """
+    音声を共有バッファに書き込み、連番(seq)を付けてワーカーに文字起こしを依頼する（結果は待たない）。
+    処理中の件数がmax_inflight_requestsに達している場合は空きができるまで待つ。
+    rejectedがTrueの場合（推論前の判定で発話でないとしたチャンク）はワーカーに送らず、
+    status="rejected"の空の結果だけを入れて、ほかの依頼と同じく連番順に破棄させる。
+    """
+    global next_request_seq
+    if not worker_ready.is_set() and not rejected:
+        print("モデルを準備中です。音声はキューに保持され、準備完了後に文字起こしされます。")
+    if not rejected:
+        inflight_slots.acquire()
+    location = None if rejected else shared_audio_ring.write(chunk.audio)
+    submitted_at = time.monotonic()
+    audio_s = len(chunk.audio) / SAMPLE_RATE
+    deadline = None
+    if worker_ready.is_set() and app_config.get("request_deadline_s", 0) > 0:
+        # モデルの準備中に溜まった依頼には期限を付けない（準備完了までの待ち時間は期限に含めない）
+        deadline = submitted_at + app_config["request_deadline_s"] + audio_s * app_config.get("request_deadline_rtf", 0.0)
+    with pipeline_lock:
+        seq = next_request_seq
+        next_request_seq += 1
+        # 結果待ちの依頼の数からデコード設定を選ぶ（モデルの準備中に溜まった依頼では切り替えない）
+        profile = None if rejected else decoding_profile.select_profile(len(pending_requests), adapt=worker_ready.is_set())
+        pending_requests[seq] = {
+            "seq": seq,
+            "generation": session_generation,
+            "profile": profile,
+            "is_final": chunk.is_final,
+            "location": location,
+            "audio_s": audio_s,
+            "speech_start_at": chunk.speech_start_at,
+            "speech_end_at": chunk.speech_end_at,
+            "decided_at": chunk.decided_at,
+            "continues": chunk.continues,
+            "overlap_s": chunk.overlap_s,
+            "submitted_at": submitted_at,
+        }
+        if journal_writer is not None and chunk.is_final and not rejected:
+            # chunk.audioは録音バッファのビューのため、記録用にコピーしておく
+            pending_requests[seq].update({
+                "journal_audio": chunk.audio.copy(),
+                "prompt": current_prompt,
+                "speech_regions": chunk.speech_regions,
+            })
+        inflight = len(pending_requests)
+    if rejected:
+        transcription_output_queue.put(empty_result(seq, "rejected"))
+        return seq
+    message = {
+        "seq": seq,
+        "generation": session_generation,
+        "deadline": deadline,
+        "profile": profile,
+        "prompt": current_prompt,
+        "speech_regions": chunk.speech_regions,
+        "overlap_s": chunk.overlap_s,
+    }
+    if location is None:
+        print("警告: 共有音声バッファに空きがないため、音声をキュー経由で送信します。")
+        message["audio"] = chunk.audio.copy() # chunk.audioは録音バッファのビューのため、送信前にコピーする
+    else:
+        message["offset"], message["length"] = location
+    worker_id = worker_pool.submit(message)
+    if worker_id is None:
+        print(f"[パイプライン] #{seq} を投入できるワーカーがありません（すべての文字起こしプロセスの起動に失敗しました）")
+        return seq
+    print(f"[パイプライン] #{seq} をワーカー{worker_id}に投入しました (処理中: {inflight}件, デコード: {profile})")
+    return seq
+
+def collect_results():
     """
-    print("Transcription worker process started.")
+    ワーカーからの結果を受け取り、連番順に並べ替えてから挿入する。
+    結果が届いた順ではなく発話の順にテキストが挿入されるよう、先に届いた結果は並べ替えバッファで待たせる。
+    """
+    global next_delivery_seq
     while True:
-        data = input_queue.get()
-        if data is None:
+        result = transcription_output_queue.get()
+        if result is None:
             break
-        audio_data, current_prompt = data
-        
-        original_text = transcribe_audio(audio_data, current_prompt=current_prompt)
-        output_queue.put(original_text)
-    print("Transcription worker process stopped.")
+        rejected = result["status"] == "rejected"
+        if not rejected and not complete_request(result):
+            # 再起動で失敗として扱った依頼の結果が、あとから届いた
+            continue
+        with pipeline_lock:
+            request = pending_requests.pop(result["seq"])
+            request.update(result)
+            request["received_at"] = time.monotonic()
+            reorder_buffer[result["seq"]] = request
+        if request["location"] is not None:
+            shared_audio_ring.release(request["location"][0])
+        if not rejected:
+            inflight_slots.release()
+        if result["status"] == "ok":
+            decoding_profile.record_result(request["profile"], result["audio_s"], result["processing_s"])
+            speech_gate.record_post_decode(result.get("rejected_segments", 0), not result["text"])
+
+        while True:
+            with pipeline_lock:
+                request = reorder_buffer.pop(next_delivery_seq, None)
+                if request is None:
+                    break
+                next_delivery_seq += 1
+            request["delivered_at"] = time.monotonic()
+            if discard_stale_result(request):
+                continue
+            deliver_result(request)
+
+def discard_stale_result(request):
+    """
+    止めた録音セッションの依頼や、期限切れ・ワーカーの再起動・文字起こしのエラーで失敗した依頼の結果なら、挿入せずに破棄してTrueを返す。
+    録音セッションが変わった場合と最終認識を破棄した場合は、発話の途中状態（確定済みのテキストなど）も捨てる。
+    """
+    global delivery_generation
+    if request["generation"] != delivery_generation:
+        delivery_generation = request["generation"]
+        reset_delivery_state()
+    reason = None
+    if request["generation"] != session_generation:
+        reason = "録音を停止したため"
+    elif request["status"] == "expired":
+        reason = "期限を過ぎたため"
+    elif request["status"] == "failed":
+        reason = "文字起こしプロセスが再起動されたため"
+    elif request["status"] == "error":
+        reason = "文字起こしに失敗したため"
+    elif request["status"] == "cancelled":
+        reason = "録音を停止したため"
+    elif request["status"] == "rejected":
+        reason = "発話でないと判定したため"
+    if reason is None:
+        return False
+    status = request["status"] if request["generation"] == session_generation else "cancelled"
+    discarded_results[status] = discarded_results.get(status, 0) + 1
+    print(f"[パイプライン] #{request['seq']} の結果を破棄しました ({reason})")
+    if request["is_final"]:
+        reset_delivery_state()
+    return True
+
+def reset_delivery_state():
+    """発話の途中状態を捨てる（挿入済みのテキストはそのまま残す）"""
+    global delivery_inserted_text, seam_text
+    delivery_agreement.reset()
+    delivery_inserted_text = ""
+    seam_text = ""
+
+def deliver_result(request):
+    """
+    連番順に届いた文字起こし結果をカーソル位置に反映する。
+    途中認識の結果では、LocalAgreementで確定した部分の差分だけを先行して挿入し、
+    発話終了時の最終認識で末尾を確定・補正する。
+    """
+    global last_transcribed_text, delivery_inserted_text, seam_text
+    request["worker_text"] = request["text"]
+    if request["overlap_s"]:
+        # 強制的に区切った発話の継ぎ目で、前のチャンクと重なって文字起こしされた部分を取り除く
+        max_chars = max(1, int(request["overlap_s"] * SEAM_CHARS_PER_S))
+        request["text"] = trim_seam_overlap(seam_text, request["text"], max_chars)
+    if not request["is_final"]:
+        committed_text = delivery_agreement.update(request["text"])
+        print(f"[途中認識] {request['text']} (確定: {committed_text})")
+        delivery_inserted_text = apply_text_update(
+            delivery_inserted_text, remove_filler_words(committed_text), allow_correction=False
+        )
+        return
+
+    original_text = request["text"]
+    seam_text = original_text if request["continues"] else ""
+    filler_start = time.perf_counter()
+    cleaned_text = remove_filler_words(original_text)
+    filler_s = time.perf_counter() - filler_start
+
+    transcription_history.append(cleaned_text)
+    if len(transcription_history) > 5:
+        transcription_history.pop(0)
+
+    last_transcribed_text = cleaned_text
+
+    print("----------------------------------------")
+    print(f"[元テキスト]    : {original_text}")
+    print(f"[フィラー除去後]: {cleaned_text}")
+    print("----------------------------------------")
+
+    insert_start = time.perf_counter()
+    if delivery_inserted_text:
+        # 途中挿入済みのテキストを最終結果で確定・補正する
+        apply_text_update(delivery_inserted_text, last_transcribed_text, allow_correction=True)
+    else:
+        insert_text_at_cursor(last_transcribed_text)
+    insert_s = time.perf_counter() - insert_start
+    inserted_at = time.monotonic()
+    delivery_agreement.reset()
+    delivery_inserted_text = ""
+    record_latency(request, filler_s, insert_s, inserted_at)
+
+def record_latency(request, filler_s, insert_s, inserted_at):
+    """1発話の処理段階ごとの所要時間を計測結果として記録する（ジャーナルが有効なら発話の音声とともに記録する）。"""
+    def interval(start, end):
+        if start is None or end is None:
+            return None
+        return max(0.0, end - start)
+
+    stages = {
+        "segmentation": interval(request["speech_end_at"], request["decided_at"]),
+        "enqueue": interval(request["decided_at"], request["submitted_at"]),
+        "queue": interval(request["submitted_at"], request["dequeued_at"]),
+        "decode": request["processing_s"],
+        "return": interval(request["finished_at"], request["received_at"]),
+        "reorder": interval(request["received_at"], request["delivered_at"]),
+        "filler": filler_s,
+        "insert": insert_s,
+        "total": interval(request["speech_end_at"], inserted_at),
+    }
+    metrics.record_utterance(
+        request["seq"],
+        stages,
+        worker_id=request["worker_id"],
+        audio_s=request["audio_s"],
+        speech_s=interval(request["speech_start_at"], request["speech_end_at"]),
+        chars=len(last_transcribed_text),
+        insert_backend=text_inserter.last_backend,
+        profile=request["profile"],
+        worker_rss_mb=request.get("rss_mb"),
+    )
+    if journal_writer is not None and "journal_audio" in request:
+        journal_writer.record(request.pop("journal_audio"), {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seq": request["seq"],
+            "decided_s": interval(journal_writer.started_at, request["decided_at"]),
+            "audio_s": request["audio_s"],
+            "prompt": request["prompt"],
+            "profile": request["profile"],
+            "speech_regions": request["speech_regions"],
+            "overlap_s": request["overlap_s"],
+            "continues": request["continues"],
+            "worker_text": request["worker_text"],
+            "text": request["text"],
+            "cleaned_text": last_transcribed_text,
+            "worker_id": request["worker_id"],
+            "stages": stages,
+        })
 
 
 def insert_text_at_cursor(text):
-    """現在のカーソル位置にテキストを挿入する"""
-    global _last_copied_text_by_app
-    print(f"Attempting to insert text: '{text}'")
+    """現在のカーソル位置にテキストを挿入する（挿入方式はtext_inserterが選ぶ）"""
     if text:
-        _last_copied_text_by_app = text # アプリがコピーしたテキストを記録
-        pyperclip.copy(text)
-        time.sleep(0.1)
-        pyautogui.hotkey('ctrl', 'v')
-        print(f"テキストを挿入しました: \"{text}\"")
-        # 設定がTrueの場合のみクリップボードをクリア
-        if app_config.get("clear_clipboard_after_insert", True):
-            clear_clipboard_if_ours() 
+        backend = text_inserter.insert_text(text)
+        if backend:
+            print(f"テキストを挿入しました ({backend}): \"{text}\"")
     else:
         print("挿入するテキストがありません。")
 
-def clear_clipboard_if_ours():
-    """最後にアプリがコピーしたテキストであればクリップボードをクリアする"""
-    global _last_copied_text_by_app
-    try:
-        current_clipboard_content = pyperclip.paste()
-        if _last_copied_text_by_app and current_clipboard_content == _last_copied_text_by_app:
-            pyperclip.copy("") # クリップボードを空にする
-            print("クリップボードをクリアしました。")
-        _last_copied_text_by_app = None # クリアしたかどうかにかかわらずリセット
-    except pyperclip.PyperclipException as e:
-        print(f"クリップボードの操作中にエラーが発生しました: {e}")
-
-def transcription_loop():
-    """
-    音声ストリームを継続的に処理し、文字起こしとテキスト挿入を行うループ。
-    is_recordingイベントがセットされている間、実行される。
-    """
-    global last_transcribed_text
-    
-    # audio_stream_generatorを開始
-    stream = audio_stream_generator(is_recording)
-    
-    for audio_data in stream:
-        if not is_recording.is_set():
-            break
-
-        duration_s = len(audio_data) / SAMPLE_RATE
+def delete_chars_before_cursor(count):
+    """カーソル直前の文字を削除する（途中挿入したテキストの補正用）"""
+    if count > 0:
+        text_inserter.delete_chars(count)
+        print(f"{count}文字を削除しました。")
+
+def apply_text_update(inserted_text, target_text, allow_correction):
+    """挿入済みテキストとの差分だけを反映し、反映後の挿入済みテキストを返す"""
+    delete_count, append_text = plan_text_update(inserted_text, target_text, allow_correction)
+    if not delete_count and not append_text:
+        return inserted_text
+    delete_chars_before_cursor(delete_count)
+    if append_text:
+        insert_text_at_cursor(append_text)
+    return inserted_text[:len(inserted_text) - delete_count] + append_text
+
+def submit_chunk(chunk):
+    """
+    録音セッションが区切った音声チャンクを文字起こしに投入する（録音スレッドから呼ばれる）。
+    結果は待たずに次の音声ブロックの処理に戻り、挿入はcollect_resultsスレッドが発話順に行う。
+    """
+    with pipeline_lock:
+        inflight = len(pending_requests)
+    if not chunk.is_final and inflight > 0:
+        # 推論が追いついていない間は途中認識を省略し、最終認識を優先する
+        return
+
+    if app_config.get("speech_gate_enabled", True) and not chunk.overlap_s:
+        # 咳や打鍵音などのチャンクは推論せずに捨てる（強制的に区切った発話の続きは長い発話の一部のため判定しない）
+        reason, features = speech_gate.check_chunk(chunk.audio, chunk.speech_regions, chunk.voiced_s, SAMPLE_RATE)
+        speech_gate.record_check(reason, len(chunk.audio) / SAMPLE_RATE)
+        if reason is not None:
+            details = ", ".join(f"{name} {value:.2f}" for name, value in features.items() if value is not None)
+            print(f"[ゲート] 発話でないと判定したため、文字起こしを省略します ({speech_gate.REJECTION_LABELS[reason]}: {details})")
+            if chunk.is_final:
+                # 途中認識で挿入したテキストがあれば、連番順の受け渡しで発話の途中状態を片付ける
+                submit_transcription(chunk, "", rejected=True)
+            return
+
+    # プロンプトには投入時点までに確定した履歴を使う
+    current_prompt = generate_initial_prompt()
+
+    if chunk.is_final:
+        duration_s = len(chunk.audio) / SAMPLE_RATE
         print(f"録音完了: {duration_s:.2f}秒間の音声データをキャプチャしました。")
-
-        current_prompt = generate_initial_prompt()
         print(f"[DEBUG] Initial Prompt used: '{current_prompt}'")
+        print(f"[DEBUG] Speech regions: {chunk.speech_regions}")
 
-        audio_input_queue.put((audio_data, current_prompt))
-        original_text = transcription_output_queue.get()
+    submit_transcription(chunk, current_prompt)
 
-        cleaned_text = remove_filler_words(original_text)
-
-        transcription_history.append(cleaned_text)
-        if len(transcription_history) > 5:
-            transcription_history.pop(0)
-
-        last_transcribed_text = cleaned_text
-
-        print("----------------------------------------")
-        print(f"[元テキスト]    : {original_text}")
-        print(f"[フィラー除去後]: {cleaned_text}")
-        print("----------------------------------------")
-
-        insert_text_at_cursor(last_transcribed_text)
-
-    print("文字起こしループを終了しました。")
+def on_session_stopped(session, reason):
+    """録音セッションが終了したときの処理（録音スレッドから呼ばれる）。"""
+    global recording_session
+    with session_lock:
+        if recording_session is session:
+            recording_session = None
+    for line in worker_pool.stats_lines() + speech_gate.stats_lines():
+        print(f"[統計] {line}")
+    print("録音セッションを終了しました。")
 
 
 def toggle_recording():
     """
     ホットキーによって呼び出され、録音の開始と停止を切り替える。
+    停止は録音スレッドの終了を待たない（録音スレッドは停止の要求ですぐに起こされ、自分で後始末をする）。
     """
-    global transcription_thread
-    if not is_recording.is_set():
-        print("録音を開始します...")
-        is_recording.set()
-        transcription_thread = threading.Thread(target=transcription_loop, daemon=True)
-        transcription_thread.start()
-    else:
+    global recording_session
+    with session_lock:
+        if recording_session is None:
+            print("録音を開始します...")
+            recording_session = RecordingSession(submit_chunk, on_stopped=on_session_stopped)
+            recording_session.start()
+            # アイドル時にモデルを解放したワーカーは、最初の発話を録音している間に読み込み直す
+            worker_pool.broadcast({"type": "preload"})
+            return
         print("録音を手動で停止します...")
-        is_recording.clear()
-        reset_recording_state() # 録音状態をリセット
-        if transcription_thread:
-            transcription_thread.join(timeout=2.0)
-        transcription_thread = None
-        print("録音を停止しました。")
+        recording_session.stop()
+        recording_session = None
+    cancel_session()
+    print("録音を停止しました。")
+
+
+def cancel_session():
+    """録音セッションの世代を進め、処理中・待ち行列の依頼を取り消す（ワーカーはデコードを省略・中断する）"""
+    global session_generation
+    with pipeline_lock:
+        session_generation += 1
+    worker_pool.set_generation(session_generation)
 
 
 def on_press(key):
@@ -180,35 +548,123 @@ def on_release(key):
     except KeyError:
         pass
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="WhispType: 常駐型の音声入力アプリケーション")
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="起動処理のフェーズごとの所要時間と常駐メモリを、準備完了時に表示する"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    batch_parser = subparsers.add_parser("batch", help="トレイアプリを起動せずに、音声ファイルをまとめて文字起こしする")
+    batch_parser.add_argument("inputs", nargs="+", help="音声ファイルまたはディレクトリ（再帰的に探索する）")
+    batch_parser.add_argument("-o", "--output-dir", default="transcripts", help="結果とマニフェストを書き出すディレクトリ")
+    batch_parser.add_argument("--format", choices=["jsonl", "srt", "both"], default="both", help="出力形式")
+    batch_parser.add_argument("--workers", type=int, default=0, help="文字起こしプロセスの数（0は設定ファイルの値）")
+    batch_parser.add_argument("--model", help="使用するモデル（省略時は設定ファイルのmodel_size）")
+    batch_parser.add_argument("--engine", choices=["whisper", "stub"], default="whisper", help="文字起こしエンジン（stubはモデルを使わない動作確認用）")
+    batch_parser.add_argument("--overwrite", action="store_true", help="マニフェストを無視して最初から処理し直す")
+    batch_parser.add_argument("--server", action="store_true", help="文字起こしプロセスを起動せずに、文字起こしサーバー（transcription_server_address）のモデルを使う")
+    serve_parser = subparsers.add_parser("serve", help="文字起こしプロセスを起動し、複数のクライアントで共有する文字起こしサーバーとして待ち受ける")
+    serve_parser.add_argument("--address", help="待ち受けるアドレス（host:port または unix:パス、省略時は設定ファイルのtranscription_server_address）")
+    serve_parser.add_argument("--workers", type=int, default=0, help="文字起こしプロセスの数（0は設定ファイルの値）")
+    serve_parser.add_argument("--model", help="使用するモデル（省略時は設定ファイルのmodel_size）")
+    serve_parser.add_argument("--engine", choices=["whisper", "stub"], default="whisper", help="文字起こしエンジン（stubはモデルを使わない動作確認用）")
+    client_parser = subparsers.add_parser("client", help="WAVファイルを文字起こしサーバーに送り、結果と応答時間を表示する（動作確認用）")
+    client_parser.add_argument("wav_files", nargs="+", help="16bitのWAVファイル")
+    client_parser.add_argument("--address", help="サーバーのアドレス（省略時は設定ファイルのtranscription_server_address）")
+    client_parser.add_argument("--clients", type=int, default=1, help="同時に接続するクライアントの数（振り分けの確認用）")
+    client_parser.add_argument("--chunk-s", type=float, default=5.0, help="音声を区切って送る長さ（秒）")
+    replay_parser = subparsers.add_parser("replay", help="記録した発話（journal_dir）を文字起こしプロセスに投入し直し、結果と処理時間を比較する")
+    replay_parser.add_argument("journal_dir", nargs="?", help="記録のディレクトリ（省略時は設定ファイルのjournal_dir）")
+    replay_parser.add_argument("--speed", type=float, default=0.0, help="記録した発話の間隔を何倍速で再現するか（0は待たずに投入する）")
+    replay_parser.add_argument("--workers", type=int, default=0, help="文字起こしプロセスの数（0は設定ファイルの値）")
+    replay_parser.add_argument("--model", help="使用するモデル（省略時は設定ファイルのmodel_size）")
+    replay_parser.add_argument("--engine", choices=["whisper", "stub"], default="whisper", help="文字起こしエンジン（stubはモデルを使わない動作確認用）")
+    replay_parser.add_argument("--output", help="発話ごとの比較結果をJSONで書き出すファイル")
+    replay_parser.add_argument("--export-wav", help="文字起こしせずに、記録した発話をWAVファイルとしてこのディレクトリに書き出す")
+    return parser.parse_args()
+
 def main():
     """アプリケーションのメイン関数"""
+    global shared_audio_ring, worker_pool, device_registry, mic_stream, journal_writer, HOTKEY_COMBINATION
+    args = parse_args()
+    startup_profile.enabled = args.profile_startup
+    startup_profile.record("インポート: 基本モジュール", time.perf_counter() - startup_profile.PROCESS_START)
+
     # 設定とフィラー語をロード
-    load_config()
-    load_filler_words()
-
-    # 文字起こしプロセスを開始
-    transcription_process = multiprocessing.Process(target=transcription_worker, args=(audio_input_queue, transcription_output_queue))
-    transcription_process.daemon = True
-    transcription_process.start()
-
-    # 音声入力ストリームを開始
-    stream = sd.InputStream(
-        samplerate=SAMPLE_RATE,
-        channels=1,
-        dtype='int16',
-        callback=audio_callback,
-        device=app_config["mic_device_index"]
-    )
-    stream.start()
+    with startup_profile.phase("設定とフィラー語の読み込み"):
+        load_config()
+        load_filler_words()
+        metrics.configure(app_config)
+    if args.command == "batch":
+        from batch import run_batch
+        run_batch(args)
+        return
+    if args.command == "replay":
+        from journal import run_replay
+        run_replay(args)
+        return
+    if args.command == "serve":
+        from transcription_server import run_server
+        run_server(args)
+        return
+    if args.command == "client":
+        from transcription_server import run_client
+        run_client(args)
+        return
+    if app_config.get("metrics_port"):
+        metrics.start_server(app_config["metrics_port"])
+    if app_config.get("journal_enabled"):
+        from journal import JournalWriter
+        journal_writer = JournalWriter.from_config(app_config)
+        journal_writer.start()
+
+    # ワーカーと共有する音声バッファを作成し、文字起こしプロセスを開始
+    # （モデルのロードはワーカー側で、以降のUI初期化と並行して進む）
+    with startup_profile.phase("文字起こしプロセスの起動"):
+        shared_audio_ring = SharedAudioRing.create(int(app_config["shared_audio_buffer_s"] * SAMPLE_RATE))
+        server_address = app_config.get("transcription_server_address", "")
+        if server_address:
+            # 文字起こしサーバーが起動していれば、そのモデルを共有する
+            worker_pool = RemoteWorkerPool.connect(
+                server_address, transcription_output_queue, worker_control_queue, shared_audio_ring
+            )
+        if worker_pool is not None:
+            print(f"文字起こしサーバー({server_address})に接続しました。")
+            worker_pool.start()
+            worker_pool.start_supervisor(app_config.get("worker_heartbeat_timeout_s", 10.0))
+        else:
+            worker_pool = start_embedded_pool()
+
+    with startup_profile.phase("インポート: GUI・音声ライブラリ"):
+        from audio_devices import DeviceRegistry, MicStream
+        import pyautogui # 初回挿入時の遅延を避けるため先に読み込む
+        from pynput import keyboard
+        from tray_menu import create_tray_icon
+        HOTKEY_COMBINATION = {keyboard.Key.ctrl_l, keyboard.Key.alt_l, keyboard.Key.space}
+
+    # 音声入力ストリームを開始（入力デバイスの一覧はバックグラウンドで調べる）
+    with startup_profile.phase("マイク入力ストリームの開始"):
+        device_registry = DeviceRegistry()
+        mic_stream = MicStream(device_registry, audio_callback, set_input_format)
+        mic_stream.open(app_config["mic_device_index"], app_config.get("mic_device_name", ""))
+        device_registry.start()
     print("マイク入力ストリームを開始しました。")
 
     # ホットキーリスナーを別スレッドで開始
-    listener = keyboard.Listener(on_press=on_press, on_release=on_release, daemon=True)
-    listener.start()
+    with startup_profile.phase("ホットキーリスナーの開始"):
+        listener = keyboard.Listener(on_press=on_press, on_release=on_release, daemon=True)
+        listener.start()
     print("ホットキーリスナーを開始しました (Ctrl+Alt+Space で録音開始/停止)。")
 
     # システムトレイアイコンを作成して実行
-    icon = create_tray_icon(listener)
+    with startup_profile.phase("トレイアイコンの作成"):
+        icon = create_tray_icon(listener, change_model_setting, device_registry, change_mic_device)
+        device_registry.on_change = icon.update_menu
+    threading.Thread(target=watch_worker_control, args=(icon,), daemon=True).start()
+    result_thread = threading.Thread(target=collect_results, daemon=True)
+    result_thread.start()
     try:
         icon.run()
     except KeyboardInterrupt:
@@ -217,13 +673,27 @@ def main():
         print(f"エラーが発生しました: {e}")
     finally:
         # ストリームを停止
-        stream.stop()
-        stream.close()
+        shutdown_timeout = app_config.get("shutdown_timeout_s", 5.0)
+        with session_lock:
+            session = recording_session
+        if session is not None:
+            session.stop()
+            session.join(timeout=shutdown_timeout)
+        device_registry.stop()
+        mic_stream.close()
         print("マイク入力ストリームを停止しました。")
-        # プロセスを終了させるためのシグナルを送信
-        audio_input_queue.put(None)
-        transcription_process.join()
+        # 処理中の依頼を取り消してから、プロセスを終了させるためのシグナルを送信
+        # （時間内に終了しないワーカーは強制終了する）
+        cancel_session()
+        worker_pool.stop(timeout=shutdown_timeout)
+        transcription_output_queue.put(None)
+        result_thread.join(timeout=shutdown_timeout)
+        shared_audio_ring.close()
+        worker_control_queue.put(None)
         listener.stop()
+        metrics.stop_server()
+        if journal_writer is not None:
+            journal_writer.close()
 
 if __name__ == '__main__':
     main()
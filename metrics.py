@@ -0,0 +1,189 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+
+import numpy as np
+
+# 発話ごとの処理段階（区間）の所要時間の計測。
+# 区間ごとに直近の値をヒストグラムとして集計し、1発話ごとの記録をJSONLのログ（ローテーションあり）に書き出す。
+# 集計結果はトレイメニューとローカルのHTTPエンドポイント（/metrics）で確認できる。
+# 区間の端の時刻はすべてtime.monotonic基準（システム全体で共通の時計のため、ワーカープロセスの時刻とも比較できる）。
+# 1つのプロセスの中で測る所要時間（推論・フィラー除去・挿入）は、分解能の高いtime.perf_counterで測る。
+
+# --- 定数 ---
+STAGES = [
+    ("segmentation", "区切り判定"), # 最後の音声フレームの終端 → 発話の区切りを判定
+    ("enqueue", "投入待ち"), # 区切りを判定 → ワーカーへ投入（処理中の件数の上限による待ちを含む）
+    ("queue", "ワーカーの待ち行列"), # ワーカーへ投入 → ワーカーが取り出す
+    ("decode", "推論"), # ワーカーでの文字起こし
+    ("return", "結果の受け渡し"), # 推論の完了 → メインプロセスが受信
+    ("reorder", "並べ替え待ち"), # 受信 → 前の発話の結果がそろって挿入を開始
+    ("filler", "フィラー除去"),
+    ("insert", "テキストの挿入"), # 挿入方式（text_inserter）ごとの内訳はinsert_histogramsに集計する
+    ("total", "発話終了から挿入まで"),
+]
+HISTOGRAM_BUCKETS_S = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SERVER_HOST = "127.0.0.1"
+
+# --- グローバル変数 ---
+histograms = {}
+insert_histograms = {} # 挿入方式ごとの1回の挿入の所要時間 (方式名 -> RollingHistogram)
+_window = 200
+_lock = threading.Lock()
+_logger = None
+_server = None
+_listeners = [] # 1発話の記録を受け取る関数（ベンチマークなど）
+
+
+class RollingHistogram:
+    """直近window件の値を保持し、分位点と累積度数分布を求める。"""
+
+    def __init__(self, window):
+        self.values = deque(maxlen=window)
+        self.total_count = 0
+
+    def add(self, value):
+        self.values.append(value)
+        self.total_count += 1
+
+    def summary(self):
+        if not self.values:
+            return {"count": self.total_count, "window": 0}
+        values = np.fromiter(self.values, dtype=np.float64, count=len(self.values))
+        return {
+            "count": self.total_count,
+            "window": len(values),
+            "mean": float(values.mean()),
+            "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)),
+            "max": float(values.max()),
+            "buckets": {f"{edge:g}": int(np.count_nonzero(values <= edge)) for edge in HISTOGRAM_BUCKETS_S},
+        }
+
+
+def configure(config):
+    """設定に従ってヒストグラムとJSONLログを準備する。"""
+    global _logger, _window
+    window = max(1, config.get("metrics_window", 200))
+    with _lock:
+        _window = window
+        histograms.clear()
+        insert_histograms.clear()
+        for name, _ in STAGES:
+            histograms[name] = RollingHistogram(window)
+
+    log_file = config.get("metrics_log_file", "")
+    if log_file:
+        _logger = logging.getLogger("whisptype.metrics")
+        _logger.setLevel(logging.INFO)
+        _logger.propagate = False
+        for handler in list(_logger.handlers):
+            _logger.removeHandler(handler)
+            handler.close()
+        handler = RotatingFileHandler(
+            log_file,
+            maxBytes=config.get("metrics_log_max_bytes", 1024 * 1024),
+            backupCount=config.get("metrics_log_backup_count", 3),
+            encoding="utf-8",
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _logger.addHandler(handler)
+    else:
+        _logger = None
+
+def record_utterance(seq, stages, **fields):
+    """
+    1発話分の区間ごとの所要時間（秒、計測できなかった区間はNone）を記録する。
+    fieldsはJSONLログにそのまま書き出す付加情報（worker_id, audio_sなど）。
+    """
+    with _lock:
+        for name, value in stages.items():
+            if value is not None and name in histograms:
+                histograms[name].add(value)
+        listeners = list(_listeners)
+    entry = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "seq": seq, **fields, "stages": stages}
+    if _logger is not None:
+        _logger.info(json.dumps(entry, ensure_ascii=False))
+    for listener in listeners:
+        listener(entry)
+    labels = dict(STAGES)
+    parts = [f"{labels[name]} {value:.2f}秒" for name, value in stages.items() if value is not None]
+    print(f"[計測] #{seq} " + " / ".join(parts))
+
+def add_listener(callback):
+    """record_utteranceの記録（JSONLログの1行と同じ内容の辞書）を受け取る関数を登録する。"""
+    with _lock:
+        _listeners.append(callback)
+
+def record_insertion(backend, seconds):
+    """挿入方式ごとに、1回の挿入（または削除）の所要時間を記録する。"""
+    with _lock:
+        if backend not in insert_histograms:
+            insert_histograms[backend] = RollingHistogram(_window)
+        insert_histograms[backend].add(seconds)
+
+def summary():
+    """区間ごとの集計結果を返す。"""
+    with _lock:
+        return {name: histograms[name].summary() for name, _ in STAGES if name in histograms}
+
+def insertion_summary():
+    """挿入方式ごとの集計結果を返す。"""
+    with _lock:
+        return {backend: histogram.summary() for backend, histogram in insert_histograms.items()}
+
+def summary_lines():
+    """区間ごとの集計結果を表示用の文字列で返す（トレイメニュー用）。"""
+    lines = []
+    stages = summary()
+    for name, label in STAGES:
+        stats = stages.get(name)
+        if not stats or not stats["window"]:
+            continue
+        lines.append(f"{label}: p50 {stats['p50']:.2f}秒 / p95 {stats['p95']:.2f}秒 (直近{stats['window']}件)")
+    for backend, stats in insertion_summary().items():
+        if stats["window"]:
+            lines.append(f"挿入 ({backend}): p50 {stats['p50'] * 1000:.1f}ミリ秒 / p95 {stats['p95'] * 1000:.1f}ミリ秒 (直近{stats['window']}回)")
+    return lines
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = json.dumps(
+            {"stages": summary(), "insert_backends": insertion_summary()}, ensure_ascii=False, indent=2
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # アクセスごとのログは表示しない
+
+
+def start_server(port):
+    """集計結果を http://127.0.0.1:<port>/metrics で返すサーバーを別スレッドで開始する。"""
+    global _server
+    try:
+        _server = ThreadingHTTPServer((SERVER_HOST, port), _MetricsRequestHandler)
+    except OSError as e:
+        print(f"警告: 計測結果のエンドポイントを開始できませんでした (ポート{port}): {e}")
+        return
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    print(f"計測結果を http://{SERVER_HOST}:{port}/metrics で公開しています。")
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
@@ -0,0 +1,214 @@
+import gc
+import threading
+import time
+from collections import OrderedDict
+
+from startup_profile import get_rss_mb
+
+# 文字起こしプロセス内で複数のモデルを管理する。
+# モデルは「仕様」(モデルサイズ, デバイス, 計算精度) のタプルで区別し、読み込みはloader(spec)に任せる。
+# 新しいモデルはバックグラウンドで読み込み、読み込みが終わった時点で発話と発話の間に切り替える。
+# 常駐させるモデルの数とメモリの上限を超えた場合は、最も長く使われていないモデルから解放する。
+# 一定時間使われなかった場合はunload_allですべてのモデルを解放し、次に必要になったときにreloadで読み込み直す。
+
+# --- 定数 ---
+RTF_SMOOTHING = 0.3 # 計測したRTFの指数移動平均の重み
+
+
+class ResidentModel:
+    """読み込み済みのモデルと、その読み込み時間・メモリ・計測したRTF。"""
+
+    def __init__(self, spec, model, load_s, memory_mb):
+        self.spec = spec
+        self.model = model
+        self.load_s = load_s
+        self.memory_mb = memory_mb
+        self.rtf = None
+        self.requests = 0
+        self.cache = {} # モデルごとに作るオブジェクト（バッチ推論パイプラインなど）
+
+    def record(self, audio_s, processing_s):
+        if audio_s <= 0:
+            return
+        rtf = processing_s / audio_s
+        self.rtf = rtf if self.rtf is None else self.rtf + (rtf - self.rtf) * RTF_SMOOTHING
+        self.requests += 1
+
+
+class ModelManager:
+    """
+    モデルの読み込み・切り替え・LRUによる解放を行う。
+    active_specは現在文字起こしに使うモデル、fast_specは短い発話に使う軽いモデル（任意）。
+    """
+
+    def __init__(self, loader, max_models=2, memory_budget_mb=0, on_loaded=None):
+        self.loader = loader
+        self.max_models = max(1, max_models)
+        self.memory_budget_mb = memory_budget_mb
+        self.on_loaded = on_loaded # バックグラウンドでの読み込みが終わったときに呼ばれる（ResidentModelを受け取る）
+        self.models = OrderedDict() # spec -> ResidentModel（末尾ほど最近使われた）
+        self.active_spec = None
+        self.requested_spec = None # 読み込みが終わりしだい切り替えるモデル
+        self.fast_spec = None
+        self._loading = set()
+        self._lock = threading.Lock()
+
+    def _load(self, spec):
+        rss_before = get_rss_mb()
+        start_time = time.perf_counter()
+        model = self.loader(spec)
+        load_s = time.perf_counter() - start_time
+        rss_after = get_rss_mb()
+        memory_mb = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+        return ResidentModel(spec, model, load_s, memory_mb)
+
+    def load(self, spec):
+        """モデルを読み込み（読み込み済みならそのまま）、ResidentModelを返す。"""
+        with self._lock:
+            resident = self.models.get(spec)
+        if resident is None:
+            resident = self._load(spec)
+            with self._lock:
+                self.models[spec] = resident
+                self._evict()
+        return resident
+
+    def set_active(self, spec):
+        """
+        文字起こしに使うモデルを切り替える。読み込み済みならすぐに、そうでなければ
+        バックグラウンドで読み込み、読み込みが終わった時点で切り替える（それまでは今のモデルを使う）。
+        """
+        with self._lock:
+            self.requested_spec = spec
+            if spec in self.models:
+                self.active_spec = spec
+                self.models.move_to_end(spec)
+                return True
+            first_model = self.active_spec is None
+        if first_model:
+            self.load(spec)
+            with self._lock:
+                self.active_spec = spec
+            return True
+        self.load_in_background(spec)
+        return False
+
+    def set_fast(self, spec):
+        """短い発話に使う軽いモデルを設定する（Noneで無効）。未読み込みならバックグラウンドで読み込む。"""
+        with self._lock:
+            self.fast_spec = spec
+            loaded = spec is None or spec in self.models
+        if not loaded:
+            self.load_in_background(spec)
+
+    def load_in_background(self, spec):
+        with self._lock:
+            if spec in self._loading or spec in self.models:
+                return
+            self._loading.add(spec)
+        threading.Thread(target=self._background_load, args=(spec,), daemon=True).start()
+
+    def _background_load(self, spec):
+        try:
+            resident = self._load(spec)
+        except Exception as e:
+            print(f"エラー: モデル{spec}の読み込みに失敗しました。 {e}")
+            with self._lock:
+                self._loading.discard(spec)
+            return
+        with self._lock:
+            self._loading.discard(spec)
+            self.models[spec] = resident
+            if spec == self.requested_spec:
+                # 文字起こし中のモデルは呼び出し側が参照を保持しているため、次の発話から切り替わる
+                self.active_spec = spec
+            self._evict()
+        if self.on_loaded:
+            self.on_loaded(resident)
+
+    @property
+    def loaded(self):
+        """文字起こしに使うモデルが読み込まれているかどうか。"""
+        with self._lock:
+            return self.active_spec in self.models
+
+    def unload_all(self):
+        """
+        すべてのモデルを解放し、解放したResidentModelのリストを返す（仕様は残すため、reloadで同じモデルを読み込み直せる）。
+        バックグラウンドで読み込み中のモデルがある場合は、読み込み後に常駐してしまうため何もせず空のリストを返す。
+        """
+        with self._lock:
+            if self._loading:
+                return []
+            residents = list(self.models.values())
+            self.models.clear()
+            if self.requested_spec is not None:
+                self.active_spec = self.requested_spec
+        for resident in residents:
+            resident.model = None
+            resident.cache.clear()
+        gc.collect()
+        return residents
+
+    def reload(self):
+        """unload_allで解放したモデル（文字起こしに使うモデルと短い発話用のモデル）を読み込み直す。"""
+        with self._lock:
+            spec = self.active_spec
+            self.active_spec = None
+        self.set_active(spec)
+        self.set_fast(self.fast_spec)
+
+    def route(self, audio_s, short_s, latency_target_s):
+        """
+        発話に使うモデルを選ぶ。軽いモデルがあり、発話がshort_s秒以下で、既定のモデルの計測RTFでは
+        latency_target_s秒以内に終わらない見込みの場合だけ軽いモデルを使う。
+        """
+        with self._lock:
+            resident = self.models[self.active_spec]
+            fast = self.models.get(self.fast_spec) if self.fast_spec else None
+            if (
+                fast is not None
+                and fast is not resident
+                and audio_s <= short_s
+                and resident.rtf is not None
+                and resident.rtf * audio_s > latency_target_s
+            ):
+                resident = fast
+            self.models.move_to_end(resident.spec)
+            return resident
+
+    def _evict(self):
+        """常駐数とメモリの上限を超えている間、使用中でないモデルを古い順に解放する（_lockを保持して呼ぶ）。"""
+        protected = {self.active_spec, self.requested_spec, self.fast_spec}
+        evicted = False
+        while True:
+            total_mb = sum(r.memory_mb or 0.0 for r in self.models.values())
+            over_budget = self.memory_budget_mb > 0 and total_mb > self.memory_budget_mb
+            if len(self.models) <= self.max_models and not over_budget:
+                break
+            victim = next((spec for spec in self.models if spec not in protected), None)
+            if victim is None:
+                break
+            resident = self.models.pop(victim)
+            print(f"モデル{victim}を解放しました (常駐: {len(self.models)}個)。")
+            resident.model = None
+            resident.cache.clear()
+            evicted = True
+        if evicted:
+            gc.collect()
+
+    def status(self):
+        """常駐しているモデルの状態を返す（古い順）。"""
+        with self._lock:
+            return [
+                {
+                    "model": list(resident.spec),
+                    "active": resident.spec == self.active_spec,
+                    "fast": resident.spec == self.fast_spec,
+                    "load_s": resident.load_s,
+                    "memory_mb": resident.memory_mb,
+                    "rtf": resident.rtf,
+                    "requests": resident.requests,
+                }
+                for resident in self.models.values()
+            ]
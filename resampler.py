@@ -0,0 +1,116 @@
+from math import gcd
+
+import numpy as np
+
+# マイクのネイティブのサンプリングレート・チャンネル数で取り込んだ音声を、
+# 16kHzモノラルのint16に変換するストリーミング用のポリフェーズ・リサンプラー。
+# 出力レート/入力レート = up/down（既約分数）とし、up倍に補間してdown分の1に間引く処理を、
+# 出力サンプルごとに必要な位相の係数だけを掛ける形でまとめて計算する。
+# ブロックの境界をまたぐフィルタの状態（直前の入力サンプル）と出力位置を持ち越すため、
+# 任意の長さのブロックを続けて渡せる。ブロック長と出力位置の組ごとに添字と係数の行列を作って再利用するため、
+# 同じ長さのブロックが続く限り（downの倍数のブロック長では出力位置が毎回同じになる）メモリを確保しない。
+
+# --- 定数 ---
+ZERO_CROSSINGS = 16 # ローパスフィルタの長さ（カットオフ周波数のsincの零点の数）
+ROLLOFF = 0.9 # カットオフ周波数（低い方のナイキスト周波数に対する比）
+KAISER_BETA = 8.6 # カイザー窓のβ（阻止域の減衰はおよそ80dB）
+MAX_CACHED_PLANS = 32 # 保持する添字と係数の行列の組の最大数
+
+
+def design_filter(up, down):
+    """
+    up倍に補間したレートで使うローパスフィルタを設計し、位相ごとの係数 (up, 位相あたりのタップ数) を返す。
+    係数の並びは、位相pのk番目のタップが元のフィルタのp + k*up番目の係数になる。
+    """
+    if up == down:
+        return np.ones((1, 1), dtype=np.float32) # レートが同じ場合はダウンミックスだけを行う
+    cutoff = ROLLOFF * 0.5 / max(up, down) # 補間後のレートに対する正規化周波数
+    taps_per_phase = int(np.ceil(ZERO_CROSSINGS / (2 * cutoff) / up))
+    length = taps_per_phase * up
+    n = np.arange(length) - (length - 1) / 2
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(length, KAISER_BETA)
+    h *= up / h.sum() # 補間で下がる振幅を戻し、直流の利得をupにする
+    return h.reshape(taps_per_phase, up).T.astype(np.float32)
+
+
+class StreamingResampler:
+    """ネイティブ形式の音声ブロック (フレーム数, チャンネル数) を、ダウンミックスしてout_rateのint16に変換する。"""
+
+    def __init__(self, in_rate, out_rate, channels):
+        in_rate = int(round(in_rate))
+        divisor = gcd(in_rate, out_rate)
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.channels = channels
+        self.up = out_rate // divisor
+        self.down = in_rate // divisor
+        self.phases = design_filter(self.up, self.down)
+        self.taps = self.phases.shape[1]
+        self._history = self.taps - 1 # 前のブロックから持ち越す入力サンプル数
+        self._input = np.zeros(self._history, dtype=np.float32) # [持ち越した入力 | 今回のブロック]
+        self._offset = 0 # 次の出力サンプルの位置（今回のブロックの先頭からの、補間後のレートでのサンプル数）
+        self._plans = {}
+
+    def preferred_block_frames(self, duration_ms):
+        """おおよそduration_msで、出力位置が毎回同じになる（downの倍数の）ブロック長を返す。"""
+        frames = self.in_rate * duration_ms / 1000
+        return max(1, int(np.ceil(frames / self.down))) * self.down
+
+    def reset(self):
+        self._input[:self._history] = 0
+        self._offset = 0
+
+    def _plan(self, frames):
+        """ブロック長と出力位置に対する、入力の添字と係数の行列と作業用の配列を返す（作成済みなら再利用する）。"""
+        key = (frames, self._offset)
+        plan = self._plans.get(key)
+        if plan is not None:
+            return plan
+        if len(self._plans) >= MAX_CACHED_PLANS:
+            self._plans.clear()
+        count = max(0, -(-(frames * self.up - self._offset) // self.down))
+        positions = self._offset + np.arange(count, dtype=np.int64) * self.down
+        newest = self._history + positions // self.up # 各出力サンプルに対応する最新の入力サンプル
+        indices = newest[:, None] - np.arange(self.taps)[None, :]
+        coefficients = self.phases[positions % self.up]
+        next_offset = self._offset + count * self.down - frames * self.up
+        plan = (
+            indices,
+            coefficients,
+            np.empty((count, self.taps), dtype=np.float32),
+            np.empty(count, dtype=np.float32),
+            np.empty(count, dtype=np.int16),
+            next_offset,
+        )
+        self._plans[key] = plan
+        return plan
+
+    def process(self, block):
+        """
+        ブロック (フレーム数, チャンネル数) のint16音声を変換し、out_rateのモノラルint16を返す。
+        返す配列は作業用の領域のビューで、次にprocessを呼ぶまで有効。
+        """
+        frames = len(block)
+        needed = self._history + frames
+        if len(self._input) < needed:
+            grown = np.zeros(needed, dtype=np.float32)
+            grown[:self._history] = self._input[:self._history]
+            self._input = grown
+        current = self._input[self._history:needed]
+        # ダウンミックス（チャンネルの平均）
+        np.sum(block, axis=1, dtype=np.float32, out=current)
+        if self.channels > 1:
+            current *= 1.0 / self.channels
+
+        indices, coefficients, gathered, output, output_int16, next_offset = self._plan(frames)
+        np.take(self._input, indices, out=gathered)
+        gathered *= coefficients
+        np.sum(gathered, axis=1, out=output)
+        np.rint(output, out=output)
+        np.clip(output, -32768, 32767, out=output)
+        output_int16[:] = output
+
+        # 次のブロックのために、末尾の入力サンプルを先頭に移す
+        self._input[:self._history] = self._input[frames:needed]
+        self._offset = next_offset
+        return output_int16
@@ -0,0 +1,93 @@
+import threading
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+AUDIO_DTYPE = np.int16
+
+
+class SharedAudioRing:
+    """
+    メインプロセスとワーカープロセスが共有するint16音声のリングバッファ。
+    メインプロセスが書き込み、キューには (offset, length) の記述子だけを流す。
+    領域の割り当てと解放は書き込み側（メインプロセス）だけが管理する。
+    """
+
+    def __init__(self, shm, capacity, owner):
+        self.shm = shm
+        self.capacity = capacity
+        self.owner = owner
+        self.samples = np.ndarray((capacity,), dtype=AUDIO_DTYPE, buffer=shm.buf)
+        self._head = 0
+        self._allocations = deque() # [offset, length, released] を書き込み順に保持
+        self._lock = threading.Lock() # 書き込みと解放は別スレッドから呼ばれる
+
+    @classmethod
+    def create(cls, capacity):
+        shm = shared_memory.SharedMemory(create=True, size=capacity * np.dtype(AUDIO_DTYPE).itemsize)
+        return cls(shm, capacity, owner=True)
+
+    @classmethod
+    def attach(cls, name, capacity):
+        # 子プロセスは親のresource_trackerを共有するため、アタッチ側で登録を解除してはいけない
+        # （解除すると作成側のunlink時に二重解除となる）
+        shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, capacity, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _reserve(self, length):
+        """書き込み可能な連続領域の先頭オフセットを返す。空きがなければNone。"""
+        if length > self.capacity:
+            return None
+        if not self._allocations:
+            self._head = 0
+            return 0
+        tail = self._allocations[0][0]
+        if self._head > tail:
+            # 折り返していない: 末尾側に置けなければ先頭側へ折り返す
+            if self._head + length <= self.capacity:
+                return self._head
+            if length <= tail:
+                return 0
+            return None
+        # 折り返し済み: 最古の割り当ての手前までしか使えない
+        if self._head + length <= tail:
+            return self._head
+        return None
+
+    def write(self, audio_data):
+        """音声を書き込み (offset, length) を返す。空きが足りない場合はNoneを返す。"""
+        samples = audio_data.reshape(-1)
+        length = len(samples)
+        with self._lock:
+            offset = self._reserve(length)
+            if offset is None:
+                return None
+            self._allocations.append([offset, length, False])
+            self._head = offset + length
+        self.samples[offset:offset + length] = samples
+        return offset, length
+
+    def release(self, offset):
+        """ワーカーが読み終えた領域を解放する。解放は書き込み順でなくてもよい。"""
+        with self._lock:
+            for allocation in self._allocations:
+                if allocation[0] == offset and not allocation[2]:
+                    allocation[2] = True
+                    break
+            while self._allocations and self._allocations[0][2]:
+                self._allocations.popleft()
+
+    def read(self, offset, length):
+        """共有メモリ上の音声をコピーせずにビューとして返す。"""
+        return self.samples[offset:offset + length]
+
+    def close(self):
+        self.samples = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
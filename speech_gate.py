@@ -0,0 +1,124 @@
+import threading
+
+import numpy as np
+
+from config import app_config
+import decoding_profile
+
+# 文字起こしの前後で、発話でないチャンクを捨てる判定と、その件数の集計。
+# 推論の前には、VADが音声と判定した長さ・スペクトル平坦度・音声帯域のエネルギーの割合から、
+# 咳・キーボードの打鍵音・ドアの音など明らかに発話でないチャンクを見分け、ワーカーに送らずに捨てる。
+# 特徴量は音声区間内のフレームをまとめてFFTし、NumPyのベクトル演算だけで求める（推論に比べて十分に軽い）。
+# 推論の後の判定（no_speech_probとavg_logprobによるセグメントの除外）はtranscriberで行い、件数だけをここに集計する。
+
+# --- 定数 ---
+FFT_LENGTH = 512 # 特徴量を求めるフレームの長さ（16kHzで32ミリ秒）
+ANALYSIS_BAND_HZ = (60.0, 7800.0) # 平坦度と全体のエネルギーを求める帯域（直流付近とナイキスト付近を除く）
+SPEECH_BAND_HZ = (200.0, 4000.0) # 音声帯域（狭い母音「い」「う」の第1フォルマントを含めるため200Hzから）
+REJECTION_LABELS = {
+    "too_short": "音声が短すぎる",
+    "flat_spectrum": "雑音のようなスペクトル",
+    "out_of_band": "音声帯域のエネルギーが少ない",
+}
+
+# --- グローバル変数 ---
+_stats = {
+    "checked": 0, # 判定したチャンクの数
+    "rejected": {reason: 0 for reason in REJECTION_LABELS}, # 推論の前に捨てたチャンクの数（理由ごと）
+    "rejected_audio_s": 0.0, # 推論の前に捨てたチャンクの音声の長さの合計
+    "saved_s": 0.0, # 捨てたチャンクの推論にかかったはずの時間の見積もり（RTFを計測済みの分だけ）
+    "post_segments": 0, # 推論の後に除外したセグメントの数
+    "post_chunks": 0, # 推論の後にすべてのセグメントを除外したチャンクの数
+}
+_lock = threading.Lock()
+
+
+def spectral_features(audio, speech_regions, sample_rate):
+    """
+    音声区間内の音声から (スペクトル平坦度, 音声帯域のエネルギーの割合) を返す（区間が短すぎる場合は (None, None)）。
+    平坦度はフレームごとの値をエネルギーで重み付けして平均する（大きな音のフレームほど重く数える）。
+    """
+    samples = audio.reshape(-1)
+    frames = []
+    for start_s, end_s in speech_regions:
+        region = samples[int(start_s * sample_rate):int(end_s * sample_rate)]
+        frame_count = len(region) // FFT_LENGTH
+        if frame_count:
+            frames.append(region[:frame_count * FFT_LENGTH].reshape(frame_count, FFT_LENGTH))
+    if not frames:
+        return None, None
+    frames = np.concatenate(frames).astype(np.float32) / 32768.0
+    power = np.abs(np.fft.rfft(frames * np.hanning(FFT_LENGTH).astype(np.float32), axis=1)) ** 2
+    freqs = np.fft.rfftfreq(FFT_LENGTH, 1.0 / sample_rate)
+    analysis = power[:, (freqs >= ANALYSIS_BAND_HZ[0]) & (freqs <= ANALYSIS_BAND_HZ[1])]
+    speech = power[:, (freqs >= SPEECH_BAND_HZ[0]) & (freqs <= SPEECH_BAND_HZ[1])]
+
+    frame_energy = analysis.mean(axis=1) + 1e-12
+    flatness = np.exp(np.mean(np.log(analysis + 1e-12), axis=1)) / frame_energy
+    weighted_flatness = float(np.sum(flatness * frame_energy) / np.sum(frame_energy))
+    band_ratio = float(speech.sum() / (analysis.sum() + 1e-12))
+    return weighted_flatness, band_ratio
+
+def check_chunk(audio, speech_regions, voiced_s, sample_rate):
+    """
+    推論の前の判定。明らかに発話でなければ捨てる理由（REJECTION_LABELSのキー）を、そうでなければNoneを返す。
+    voiced_sはVADが音声と判定したフレームの長さの合計（秒）。2つ目の戻り値は表示用の特徴量。
+    """
+    features = {"voiced_s": voiced_s}
+    if voiced_s < app_config.get("speech_gate_min_voiced_s", 0.3):
+        return "too_short", features
+    flatness, band_ratio = spectral_features(audio, speech_regions or [], sample_rate)
+    features.update({"flatness": flatness, "band_ratio": band_ratio})
+    if flatness is None:
+        return None, features
+    if flatness > app_config.get("speech_gate_max_flatness", 0.45):
+        return "flat_spectrum", features
+    if band_ratio < app_config.get("speech_gate_min_band_ratio", 0.3):
+        return "out_of_band", features
+    return None, features
+
+def _estimated_decode_s(audio_s):
+    """今のデコード設定で計測したRTFから、音声の推論にかかる時間を見積もる（未計測ならNone）。"""
+    mode = app_config.get("decoding_profile", decoding_profile.DEFAULT_PROFILE)
+    profile = decoding_profile.current_profile if mode == "auto" else decoding_profile.resolve(mode)
+    rtf = decoding_profile.measured_rtf(profile)
+    return audio_s * rtf if rtf is not None else None
+
+def record_check(reason, audio_s):
+    """推論の前の判定の結果を集計する（reasonがNoneなら通過）。"""
+    with _lock:
+        _stats["checked"] += 1
+        if reason is None:
+            return
+        _stats["rejected"][reason] += 1
+        _stats["rejected_audio_s"] += audio_s
+        saved_s = _estimated_decode_s(audio_s)
+        if saved_s is not None:
+            _stats["saved_s"] += saved_s
+
+def record_post_decode(rejected_segments, emptied):
+    """推論の後に除外したセグメントの数と、それによってテキストが空になったかどうかを集計する。"""
+    if not rejected_segments:
+        return
+    with _lock:
+        _stats["post_segments"] += rejected_segments
+        if emptied:
+            _stats["post_chunks"] += 1
+
+def stats_lines():
+    """判定の件数と、省略できた推論の時間を表示用の文字列で返す。"""
+    with _lock:
+        rejected_total = sum(_stats["rejected"].values())
+        breakdown = ", ".join(
+            f"{REJECTION_LABELS[reason]} {count}件" for reason, count in _stats["rejected"].items() if count
+        )
+        lines = [
+            f"推論前の判定: {_stats['checked']}件中 {rejected_total}件を破棄"
+            + (f" ({breakdown})" if breakdown else "")
+            + f", 音声 {_stats['rejected_audio_s']:.1f}秒, 省略した推論 約{_stats['saved_s']:.1f}秒"
+        ]
+        if _stats["post_segments"]:
+            lines.append(
+                f"推論後の判定: {_stats['post_segments']}セグメントを除外 (テキストが空になったチャンク {_stats['post_chunks']}件)"
+            )
+    return lines
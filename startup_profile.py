@@ -0,0 +1,108 @@
+import os
+import time
+from contextlib import contextmanager
+
+# 起動時間の計測（--profile-startup）。このモジュールはできるだけ早くインポートすること。
+
+# --- 定数 ---
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000 # ほかのプロセスのメモリ情報を取得するためのアクセス権（Windows）
+PROCESS_VM_READ = 0x0010
+
+# --- グローバル変数 ---
+PROCESS_START = time.perf_counter()
+enabled = False
+phases = [] # (フェーズ名, 所要時間(秒), 終了時点の常駐メモリ(MB))
+
+def get_rss_mb(pid=None):
+    """
+    プロセスの常駐メモリ(MB)を返す（pidを省略した場合は現在のプロセス）。取得できない場合はNone。
+    psutilがない場合は、WindowsではGetProcessMemoryInfo、Linuxでは/proc/<pid>/statmから求める。
+    """
+    pid = pid or os.getpid()
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss / (1024 * 1024)
+        except psutil.Error:
+            return None
+    if os.name == "nt":
+        return _get_working_set_mb(pid)
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+def _get_working_set_mb(pid):
+    """Windowsで、プロセスのワーキングセット(MB)を返す。取得できない場合はNone。"""
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    psapi = ctypes.WinDLL("psapi", use_last_error=True)
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+    psapi.GetProcessMemoryInfo.argtypes = (wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD)
+
+    own_process = pid == os.getpid()
+    if own_process:
+        handle = kernel32.GetCurrentProcess() # 閉じる必要のない疑似ハンドル
+    else:
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION | PROCESS_VM_READ, False, pid)
+        if not handle:
+            return None
+    try:
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if not psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.WorkingSetSize / (1024 * 1024)
+    finally:
+        if not own_process:
+            kernel32.CloseHandle(handle)
+
+@contextmanager
+def phase(name):
+    """with文で囲んだ区間の所要時間を記録する。"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start_time)
+
+def record(name, duration_s, rss_mb=None):
+    """フェーズの所要時間を記録する。rss_mbを省略した場合は現在のプロセスのメモリを記録する。"""
+    if rss_mb is None:
+        rss_mb = get_rss_mb()
+    phases.append((name, duration_s, rss_mb))
+
+def print_report():
+    """記録したフェーズごとの所要時間とメモリを表示する。"""
+    if not enabled:
+        return
+    print("========== 起動プロファイル ==========")
+    for name, duration_s, rss_mb in phases:
+        memory = f"{rss_mb:8.1f} MB" if rss_mb is not None else "       - MB"
+        print(f"{name:<32} {duration_s * 1000:9.1f} ms {memory}")
+    print(f"{'起動から準備完了まで':<32} {(time.perf_counter() - PROCESS_START) * 1000:9.1f} ms")
+    print("======================================")
@@ -0,0 +1,59 @@
+def common_prefix(a, b):
+    """2つの文字列の共通接頭辞を返す。"""
+    length = min(len(a), len(b))
+    i = 0
+    while i < length and a[i] == b[i]:
+        i += 1
+    return a[:i]
+
+
+class LocalAgreement:
+    """
+    発話中の途中認識結果から、安定した接頭辞だけを確定させる（LocalAgreement方式）。
+    直前の仮説と今回の仮説で一致している部分を「確定」とみなし、確定部分は単調に伸びる。
+    """
+
+    def __init__(self):
+        self.previous_hypothesis = ""
+        self.committed = ""
+
+    def update(self, hypothesis):
+        """途中認識結果を取り込み、現在の確定テキストを返す。"""
+        agreed = common_prefix(self.previous_hypothesis, hypothesis)
+        # 確定済みの部分と矛盾する場合は確定を伸ばさない（最終パスで補正する）
+        if len(agreed) > len(self.committed) and agreed.startswith(self.committed):
+            self.committed = agreed
+        self.previous_hypothesis = hypothesis
+        return self.committed
+
+    def reset(self):
+        self.previous_hypothesis = ""
+        self.committed = ""
+
+
+def plan_text_update(inserted_text, target_text, allow_correction):
+    """
+    挿入済みテキストを目標テキストに近づけるための (削除文字数, 追加テキスト) を返す。
+    allow_correctionがFalseの場合は追記のみを許可し、追記できなければ (0, "") を返す。
+    """
+    common = common_prefix(inserted_text, target_text)
+    delete_count = len(inserted_text) - len(common)
+    if delete_count and not allow_correction:
+        return 0, ""
+    return delete_count, target_text[len(common):]
+
+
+SEAM_IGNORED_CHARS = "、。，．,.!?！？ 　" # 継ぎ目の重なりを比較するときに無視する文字
+MIN_SEAM_OVERLAP_CHARS = 2 # これより短い一致は偶然とみなして取り除かない
+
+def trim_seam_overlap(previous_text, text, max_chars):
+    """
+    強制的に区切ったチャンクの継ぎ目で、前のテキストの末尾と重なっているtextの先頭部分を取り除く。
+    句読点と空白は無視して比較し、重なりは最大max_chars文字まで探す。
+    """
+    previous_chars = [c for c in previous_text if c not in SEAM_IGNORED_CHARS][-max_chars:]
+    text_chars = [(i, c) for i, c in enumerate(text) if c not in SEAM_IGNORED_CHARS][:max_chars]
+    for length in range(min(len(previous_chars), len(text_chars)), MIN_SEAM_OVERLAP_CHARS - 1, -1):
+        if previous_chars[-length:] == [c for _, c in text_chars[:length]]:
+            return text[text_chars[length - 1][0] + 1:].lstrip(SEAM_IGNORED_CHARS)
+    return text
@@ -0,0 +1,46 @@
+import time
+import numpy as np
+from config import app_config
+from audio_processor import SAMPLE_RATE
+
+# モデルを使わない文字起こしエンジン（ベンチマークやオフラインでの動作確認用）。
+# transcriberモジュールと同じ関数を提供し、ワーカーのengineに"stub"を指定すると使われる。
+# 音声の長さ×stub_rtf秒だけ待ってから、固定の文を返す。
+
+# --- 定数 ---
+STUB_SENTENCE = "えーと、これはテスト用の文字起こし結果です。"
+
+def load_model():
+    pass
+
+def warm_up_model(duration_s=1.0):
+    pass
+
+def unload_model():
+    return {"models": ["stub"], "model_memory_mb": 0.0, "memory_mb": 0.0}
+
+def set_model_loaded_callback(callback):
+    pass
+
+def configure(changes):
+    app_config.update(changes)
+
+def transcribe_audio(audio_data, current_prompt="", speech_regions=None):
+    segments = transcribe_segments(audio_data, current_prompt, speech_regions)
+    return "".join(text for _, _, text in segments)
+
+def transcribe_segments(audio_data, current_prompt="", speech_regions=None, should_stop=None, profile=None, rejected=None):
+    audio_duration = len(np.asarray(audio_data).reshape(-1)) / SAMPLE_RATE
+    if speech_regions is not None and not speech_regions:
+        return []
+    # 処理時間は区間ごとに分けて待ち、区間の間でshould_stopを確認する（transcriberの逐次デコードと同じ）
+    regions = speech_regions or [(0.0, audio_duration)]
+    region_total_s = sum(end - start for start, end in regions) or 1.0
+    segments = []
+    for start, end in regions:
+        time.sleep(audio_duration * app_config.get("stub_rtf", 0.1) * (end - start) / region_total_s)
+        # 音声が長いほど長い文字列を返し、フィラー除去や挿入の負荷も再現する
+        segments.append((start, end, STUB_SENTENCE * max(1, int((end - start) // 3))))
+        if should_stop is not None and should_stop():
+            break
+    return segments
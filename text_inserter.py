@@ -0,0 +1,376 @@
+import ctypes
+import sys
+import threading
+import time
+
+import metrics
+from config import app_config
+
+# カーソル位置へのテキストの挿入方式（バックエンド）。
+# - unicode: キー入力としてUnicode文字を直接送る（WindowsはSendInputのKEYEVENTF_UNICODE、それ以外はpynput）。
+#   クリップボードを使わないため速く、ユーザーのクリップボードも変更しない。
+# - clipboard: クリップボードに書き込み、書き込みが反映されたのを確認してからCtrl+Vで貼り付ける。
+#   元のクリップボードの内容は貼り付け後に復元する。
+# - null / recording: 何も入力しない（recordingは挿入・削除の結果を記録する）。テストやベンチマーク用。
+# insertion_backendが"auto"の場合は、前面のウィンドウごとにunicodeから使い、unicodeが失敗したか遅い場合にだけclipboardを試す
+# （試しに貼り付けるだけでもユーザーのクリップボードを書き換えるため）。両方を計測したウィンドウでは速い方式を選ぶ。
+# 所要時間はどの方式でも、テキストを送る処理だけを計測する（各方式のinsertが返す。クリップボードの保存・復元は含めない）。
+# GUIライブラリ（pyautogui, pyperclip, pynput）は、spawn方式の文字起こしプロセスに読み込ませないよう使う時点でインポートする。
+
+# --- 定数 ---
+AUTO_BACKENDS = ["unicode", "clipboard"] # autoで候補にする方式（未計測の方式はこの順に試す）
+SLOW_INSERT_S = 0.05 # autoで、計測済みの方式がすべてこの時間より遅い場合に未計測の方式を試す
+TIMING_SMOOTHING = 0.3 # 挿入時間の指数移動平均の重み
+CLIPBOARD_READY_TIMEOUT_S = 0.1 # クリップボードへの書き込みが反映されるのを待つ最大時間
+CLIPBOARD_POLL_INTERVAL_S = 0.002 # Windowsではクリップボードを開かずに更新番号だけを確認する間隔
+CLIPBOARD_PASTE_POLL_INTERVAL_S = 0.01 # Windows以外で、クリップボードの内容を読み直して確認する間隔
+CLIPBOARD_RESTORE_DELAY_S = 0.5 # 貼り付け先のアプリがクリップボードを読み終えるのを待ってから復元する時間
+DEFAULT_WINDOW = "" # 前面のウィンドウを調べられない環境でのウィンドウのキー
+
+# Windows API（SendInput）
+INPUT_KEYBOARD = 1
+KEYEVENTF_KEYUP = 0x0002
+KEYEVENTF_UNICODE = 0x0004
+VK_BACK = 0x08
+VK_RETURN = 0x0D
+
+# --- グローバル変数 ---
+_backends = {} # 方式名 -> バックエンド（初回使用時に作成）
+_timings = {} # (ウィンドウ, 方式名) -> 挿入時間の指数移動平均（秒）
+_failed = {} # ウィンドウ -> そのウィンドウで失敗した方式名の集合
+_window_backends = {} # ウィンドウ -> 直前に挿入した方式名（削除に同じ方式を使う）
+last_backend = None # 直前の挿入に使った方式名
+
+
+class InsertionError(Exception):
+    """挿入方式が前面のウィンドウに入力できなかったことを表す。"""
+
+
+if sys.platform == "win32":
+    from ctypes import wintypes
+
+    class _MOUSEINPUT(ctypes.Structure):
+        _fields_ = [
+            ("dx", wintypes.LONG),
+            ("dy", wintypes.LONG),
+            ("mouseData", wintypes.DWORD),
+            ("dwFlags", wintypes.DWORD),
+            ("time", wintypes.DWORD),
+            ("dwExtraInfo", ctypes.c_size_t),
+        ]
+
+    class _KEYBDINPUT(ctypes.Structure):
+        _fields_ = [
+            ("wVk", wintypes.WORD),
+            ("wScan", wintypes.WORD),
+            ("dwFlags", wintypes.DWORD),
+            ("time", wintypes.DWORD),
+            ("dwExtraInfo", ctypes.c_size_t),
+        ]
+
+    class _INPUTUNION(ctypes.Union):
+        _fields_ = [("mi", _MOUSEINPUT), ("ki", _KEYBDINPUT)]
+
+    class _INPUT(ctypes.Structure):
+        _fields_ = [("type", wintypes.DWORD), ("union", _INPUTUNION)]
+
+    _user32 = ctypes.WinDLL("user32", use_last_error=True)
+    _user32.SendInput.argtypes = (wintypes.UINT, ctypes.POINTER(_INPUT), ctypes.c_int)
+    _user32.SendInput.restype = wintypes.UINT
+    _user32.GetForegroundWindow.restype = wintypes.HWND
+    _user32.GetClassNameW.argtypes = (wintypes.HWND, wintypes.LPWSTR, ctypes.c_int)
+    _user32.GetClipboardSequenceNumber.restype = wintypes.DWORD
+
+    def _key_event(vk=0, scan=0, flags=0):
+        event = _INPUT(type=INPUT_KEYBOARD)
+        event.union.ki = _KEYBDINPUT(wVk=vk, wScan=scan, dwFlags=flags, time=0, dwExtraInfo=0)
+        return event
+
+    def _send_input(events):
+        """キーイベントをまとめて1回のSendInputで送る。送れなかった場合（UIPIでブロックされたなど）はInsertionError。"""
+        if not events:
+            return
+        array = (_INPUT * len(events))(*events)
+        sent = _user32.SendInput(len(events), array, ctypes.sizeof(_INPUT))
+        if sent == 0:
+            raise InsertionError(f"SendInputが失敗しました (エラー {ctypes.get_last_error()})")
+        if sent < len(events):
+            print(f"警告: SendInputで送れたキーイベントが一部だけでした ({sent}/{len(events)})。")
+
+
+def foreground_window():
+    """前面のウィンドウを区別するキー（Windowsではウィンドウクラス名）を返す。"""
+    if sys.platform != "win32":
+        return DEFAULT_WINDOW
+    hwnd = _user32.GetForegroundWindow()
+    if not hwnd:
+        return DEFAULT_WINDOW
+    name = ctypes.create_unicode_buffer(256)
+    if not _user32.GetClassNameW(hwnd, name, len(name)):
+        return DEFAULT_WINDOW
+    return name.value
+
+
+def _clipboard_sequence():
+    """クリップボードの更新番号を返す（Windowsのみ。それ以外はNone）。"""
+    if sys.platform != "win32":
+        return None
+    return _user32.GetClipboardSequenceNumber()
+
+
+class UnicodeKeyBackend:
+    """Unicode文字をキー入力として直接送る。"""
+
+    name = "unicode"
+
+    def __init__(self):
+        self._controller = None
+
+    def _keyboard(self):
+        if self._controller is None:
+            from pynput import keyboard
+            self._controller = keyboard.Controller()
+        return self._controller
+
+    def insert(self, text):
+        start_time = time.perf_counter()
+        if sys.platform != "win32":
+            self._keyboard().type(text)
+            return time.perf_counter() - start_time
+        events = []
+        for line_index, line in enumerate(text.replace("\r\n", "\n").split("\n")):
+            if line_index:
+                events += [_key_event(vk=VK_RETURN), _key_event(vk=VK_RETURN, flags=KEYEVENTF_KEYUP)]
+            # BMP外の文字はサロゲートペアの2単位に分けて送る
+            encoded = line.encode("utf-16-le")
+            for i in range(0, len(encoded), 2):
+                code_unit = int.from_bytes(encoded[i:i + 2], "little")
+                events.append(_key_event(scan=code_unit, flags=KEYEVENTF_UNICODE))
+                events.append(_key_event(scan=code_unit, flags=KEYEVENTF_UNICODE | KEYEVENTF_KEYUP))
+        _send_input(events)
+        return time.perf_counter() - start_time
+
+    def delete(self, count):
+        if sys.platform != "win32":
+            from pynput import keyboard
+            for _ in range(count):
+                self._keyboard().tap(keyboard.Key.backspace)
+            return
+        _send_input([_key_event(vk=VK_BACK, flags=flags) for _ in range(count) for flags in (0, KEYEVENTF_KEYUP)])
+
+
+class ClipboardBackend:
+    """クリップボード経由でCtrl+Vで貼り付ける。元のクリップボードの内容は貼り付け後に復元する。"""
+
+    name = "clipboard"
+
+    def __init__(self):
+        import pyautogui
+        pyautogui.PAUSE = 0 # pyautoguiは操作ごとに既定で0.1秒待つため、待ちを無くす
+        self._lock = threading.Lock()
+        self._restore_timer = None
+        self._saved_text = None # 貼り付け前のクリップボードの内容（復元待ちの間は最初の内容を保持する）
+        self._copied_text = None # 最後にクリップボードにコピーしたテキスト
+
+    def insert(self, text):
+        import pyautogui
+        import pyperclip
+        with self._lock:
+            if self._restore_timer is not None:
+                # 前回の復元前に続けて貼り付ける場合は、前回保存した元の内容を引き続き復元対象にする
+                self._restore_timer.cancel()
+                self._restore_timer = None
+            else:
+                self._saved_text = self._paste()
+            # unicodeと比べるため、元の内容の保存を除き、コピーから貼り付けまでを計測する
+            start_time = time.perf_counter()
+            try:
+                sequence = _clipboard_sequence()
+                pyperclip.copy(text)
+                if not self._wait_until_copied(text, sequence):
+                    raise InsertionError("クリップボードへの書き込みが反映されませんでした")
+                self._copied_text = text
+                pyautogui.hotkey("ctrl", "v")
+            except Exception as e:
+                # 貼り付けずに終わる場合は、前回の復元待ちの分も含めて元の内容をすぐに戻す
+                # （コピーが遅れて反映された場合も、アプリのコピーしたテキストとして扱う）
+                if self._paste() == text:
+                    self._copied_text = text
+                self._write_back()
+                if isinstance(e, pyperclip.PyperclipException):
+                    raise InsertionError(f"クリップボードに書き込めませんでした: {e}") from e
+                raise
+            elapsed_s = time.perf_counter() - start_time
+            self._restore_timer = threading.Timer(CLIPBOARD_RESTORE_DELAY_S, self._restore)
+            self._restore_timer.daemon = True
+            self._restore_timer.start()
+        return elapsed_s
+
+    def delete(self, count):
+        import pyautogui
+        pyautogui.press("backspace", presses=count)
+
+    def _paste(self):
+        import pyperclip
+        try:
+            return pyperclip.paste()
+        except pyperclip.PyperclipException as e:
+            print(f"クリップボードの操作中にエラーが発生しました: {e}")
+            return None
+
+    def _wait_until_copied(self, text, sequence):
+        """
+        固定の待ち時間の代わりに、コピーが反映されるまで待つ。Windowsではクリップボードの更新番号が
+        sequenceから変わったことで判定し、貼り付け先のアプリと取り合いになるクリップボードのオープンを繰り返さない。
+        更新番号を使えない環境では、内容がtextになるまで読み直して確認する。
+        """
+        deadline = time.perf_counter() + CLIPBOARD_READY_TIMEOUT_S
+        while True:
+            if sequence is not None:
+                if _clipboard_sequence() != sequence:
+                    return True
+            elif self._paste() == text:
+                return True
+            if time.perf_counter() >= deadline:
+                return False
+            time.sleep(CLIPBOARD_POLL_INTERVAL_S if sequence is not None else CLIPBOARD_PASTE_POLL_INTERVAL_S)
+
+    def _restore(self):
+        """貼り付け後の待ち時間が過ぎたら、元の内容に戻す。"""
+        with self._lock:
+            if threading.current_thread() is not self._restore_timer:
+                return # 取り消される前に発火したタイマー（続けて貼り付けたため、新しいタイマーが復元する）
+            self._restore_timer = None
+            self._write_back()
+
+    def _write_back(self):
+        """
+        クリップボードがまだアプリのコピーしたテキストのままなら、保存した元の内容に戻す（または空にする）。
+        _lockを持った状態で呼ぶ。
+        """
+        import pyperclip
+        saved_text, copied_text = self._saved_text, self._copied_text
+        self._saved_text = self._copied_text = None
+        if self._paste() != copied_text:
+            return # ユーザーがその後にコピーした内容は上書きしない
+        try:
+            if app_config.get("clipboard_restore", True) and saved_text is not None:
+                pyperclip.copy(saved_text)
+            elif app_config.get("clear_clipboard_after_insert", False):
+                pyperclip.copy("")
+                print("クリップボードをクリアしました。")
+        except pyperclip.PyperclipException as e:
+            print(f"クリップボードの操作中にエラーが発生しました: {e}")
+
+
+class NullBackend:
+    """何も入力しない。"""
+
+    name = "null"
+
+    def insert(self, text):
+        return 0.0
+
+    def delete(self, count):
+        pass
+
+
+class RecordingBackend:
+    """入力の代わりに、挿入・削除の操作と結果のテキストを記録する。"""
+
+    name = "recording"
+
+    def __init__(self):
+        self.text = ""
+        self.operations = [] # ("insert", テキスト) または ("delete", 文字数)
+
+    def insert(self, text):
+        self.operations.append(("insert", text))
+        self.text += text
+        return 0.0
+
+    def delete(self, count):
+        self.operations.append(("delete", count))
+        self.text = self.text[:max(0, len(self.text) - count)]
+
+
+BACKEND_CLASSES = {
+    backend_class.name: backend_class
+    for backend_class in (UnicodeKeyBackend, ClipboardBackend, NullBackend, RecordingBackend)
+}
+
+
+def get_backend(name):
+    """方式名のバックエンドを返す（初回に作成する）。"""
+    if name not in _backends:
+        _backends[name] = BACKEND_CLASSES[name]()
+    return _backends[name]
+
+
+def candidate_backends(window):
+    """前面のウィンドウで使う方式の候補を、試す順に返す。"""
+    name = app_config.get("insertion_backend", "auto")
+    if name != "auto":
+        return [name]
+    name = app_config.get("insertion_window_backends", {}).get(window)
+    if name:
+        return [name]
+    failed = _failed.get(window, set())
+    candidates = [backend for backend in AUTO_BACKENDS if backend not in failed]
+    if not candidates:
+        # どの方式も失敗した場合は、記録をリセットして最初から試し直す
+        _failed.pop(window, None)
+        candidates = list(AUTO_BACKENDS)
+    # 計測済みの方式を速い順に使い、未計測の方式は失敗した場合の代わりにする。
+    # 計測済みの方式がすべて遅い場合にだけ、未計測の方式を先に試す
+    timings = {backend: _timings.get((window, backend)) for backend in candidates}
+    measured = [timing for timing in timings.values() if timing is not None]
+    try_unmeasured = bool(measured) and min(measured) > SLOW_INSERT_S
+    return sorted(candidates, key=lambda backend: (
+        (timings[backend] is None) != try_unmeasured,
+        timings[backend] or 0.0,
+        AUTO_BACKENDS.index(backend),
+    ))
+
+
+def _record_timing(window, name, seconds):
+    key = (window, name)
+    previous = _timings.get(key)
+    _timings[key] = seconds if previous is None else previous + (seconds - previous) * TIMING_SMOOTHING
+    metrics.record_insertion(name, seconds)
+
+
+def insert_text(text):
+    """
+    前面のウィンドウのカーソル位置にテキストを挿入し、使った方式名を返す。
+    方式が失敗した場合は、そのウィンドウでは使わないように記録して次の候補で挿入する。
+    """
+    global last_backend
+    if not text:
+        return None
+    window = foreground_window()
+    for name in candidate_backends(window):
+        try:
+            elapsed_s = get_backend(name).insert(text)
+        except Exception as e:
+            print(f"警告: 挿入方式'{name}'でテキストを挿入できませんでした ({e})。")
+            _failed.setdefault(window, set()).add(name)
+            continue
+        _record_timing(window, name, elapsed_s)
+        _window_backends[window] = name
+        last_backend = name
+        return name
+    print("エラー: どの挿入方式でもテキストを挿入できませんでした。")
+    return None
+
+
+def delete_chars(count):
+    """カーソル直前のcount文字を削除する（そのウィンドウで直前に挿入した方式を使う）。"""
+    if count <= 0:
+        return
+    window = foreground_window()
+    name = _window_backends.get(window) or candidate_backends(window)[0]
+    start_time = time.perf_counter()
+    get_backend(name).delete(count)
+    metrics.record_insertion(name, time.perf_counter() - start_time)
+
@@ -0,0 +1,271 @@
+import gc
+import os
+import time
+import numpy as np
+import ctranslate2
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+from config import app_config
+from audio_processor import SAMPLE_RATE
+from model_manager import ModelManager
+from startup_profile import get_rss_mb
+import decoding_profile
+
+# 文字起こしプロセスでのみインポートされる推論モジュール。
+# UIプロセスからはtorch/ctranslate2を読み込まないよう、このモジュールをインポートしないこと。
+
+# --- 定数 ---
+MODEL_SIZE = "small" # model_sizeが設定されていない場合のモデル
+COMPUTE_TYPE = "int8"
+BATCH_CLIP_MAX_S = 30.0 # バッチ推論に渡す1区間の最大長（Whisperの入力長）
+
+# --- グローバル変数 ---
+manager = None # 常駐しているモデルの管理（load_modelで作成）
+_on_model_loaded = None # バックグラウンドでモデルの読み込みが終わったときの通知先
+_float_buffer = np.empty(0, dtype=np.float32) # 文字起こし用に再利用するfloat32バッファ
+
+def is_cuda_available():
+    """CTranslate2からCUDAデバイスの有無を調べる（torchを読み込まない軽量な判定）。"""
+    try:
+        return ctranslate2.get_cuda_device_count() > 0
+    except Exception:
+        return False
+
+def get_cpu_threads():
+    """
+    CTranslate2のcpu_threadsを決める。cpu_threadsが0（自動）の場合、ワーカーが複数あれば
+    CPUコアをワーカー数で等分し、1つだけならCTranslate2の既定値(0)を使う。
+    """
+    cpu_threads = app_config.get("cpu_threads", 0)
+    worker_count = max(1, app_config.get("num_transcription_workers", 1))
+    if cpu_threads <= 0 and worker_count > 1:
+        cpu_threads = max(1, (os.cpu_count() or 1) // worker_count)
+    return max(0, cpu_threads)
+
+def to_float32_buffer(audio_data):
+    """int16音声を再利用バッファ上のfloat32([-1, 1))に変換し、そのビューを返す。"""
+    global _float_buffer
+    samples = audio_data.reshape(-1)
+    if len(_float_buffer) < len(samples):
+        _float_buffer = np.empty(max(len(samples), 2 * len(_float_buffer)), dtype=np.float32)
+    audio_float32 = _float_buffer[:len(samples)]
+    np.multiply(samples, 1.0 / 32768.0, out=audio_float32)
+    return audio_float32
+
+def model_spec(model_size=None):
+    """現在の設定（use_gpu, compute_type）で使うモデルの仕様 (モデルサイズ, デバイス, 計算精度) を返す。"""
+    device = "cpu"
+    if app_config.get("use_gpu", False):
+        if is_cuda_available():
+            device = "cuda"
+        else:
+            print("警告: 'use_gpu'がTrueですが、CUDAが利用できません。CPUにフォールバックします。")
+            # use_gpu設定は変更せず、このセッションのみCPUを使用する
+    compute_type = app_config.get("compute_type", COMPUTE_TYPE)
+    return (model_size or app_config.get("model_size") or MODEL_SIZE, device, compute_type)
+
+def fast_model_spec():
+    """短い発話に使う軽いモデルの仕様を返す。routing_fast_modelが空の場合はNone。"""
+    fast_model = app_config.get("routing_fast_model", "")
+    return model_spec(fast_model) if fast_model else None
+
+def _load_whisper(spec):
+    """仕様に従ってWhisperモデルを読み込み、ウォームアップまで行う。"""
+    model_size, device, compute_type = spec
+    model_options = {
+        "cpu_threads": get_cpu_threads(),
+        "num_workers": max(1, app_config.get("num_inter_workers", 1)),
+    }
+    print(f"Whisperモデル({model_size})をロードしています... (device={device}, compute_type={compute_type}, cpu_threads={model_options['cpu_threads']}, num_workers={model_options['num_workers']})")
+    try:
+        model = WhisperModel(model_size, device=device, compute_type=compute_type, **model_options)
+        print("モデルのロードが完了しました。")
+    except Exception as e:
+        print(f"エラー: モデルのロードに失敗しました。 {e}")
+        if device != "cuda":
+            raise e
+        print("CUDAでのモデルロードに失敗したため、CPUにフォールバックして再試行します。")
+        model = WhisperModel(model_size, device="cpu", compute_type=compute_type, **model_options)
+        print("CPUでのモデルロードが完了しました。")
+    warm_up(model)
+    return model
+
+def _notify_model_loaded(resident):
+    if _on_model_loaded:
+        _on_model_loaded(resident, manager.status())
+
+def load_model():
+    """設定されたモデルをロードする（ロード済みの場合は何もしない。unload_modelで解放した場合は読み込み直す）。"""
+    global manager
+    if manager is not None:
+        if not manager.loaded:
+            manager.reload()
+        return
+    manager = ModelManager(
+        _load_whisper,
+        max_models=app_config.get("max_resident_models", 2),
+        memory_budget_mb=app_config.get("model_memory_budget_mb", 0),
+        on_loaded=_notify_model_loaded,
+    )
+    manager.set_active(model_spec())
+    manager.set_fast(fast_model_spec())
+
+def unload_model():
+    """
+    常駐しているモデルをすべて解放し、{"models": 解放したモデル名のリスト, "model_memory_mb": 読み込み時に計測したメモリの合計,
+    "memory_mb": 解放の前後で減ったRSS} を返す（解放するモデルがなければNone）。
+    GPUのメモリはモデルの参照がなくなった時点でCTranslate2が解放する。
+    """
+    if manager is None:
+        return None
+    rss_before = get_rss_mb()
+    residents = manager.unload_all()
+    if not residents:
+        return None
+    gc.collect()
+    rss_after = get_rss_mb()
+    return {
+        "models": [resident.spec[0] for resident in residents],
+        "model_memory_mb": sum(resident.memory_mb or 0.0 for resident in residents),
+        "memory_mb": rss_before - rss_after if rss_before is not None and rss_after is not None else None,
+    }
+
+def set_model_loaded_callback(callback):
+    """バックグラウンドでモデルの読み込みが終わったときに呼ぶ関数 callback(resident, status) を設定する。"""
+    global _on_model_loaded
+    _on_model_loaded = callback
+
+def configure(changes):
+    """
+    設定の変更を反映する。モデルに関する設定が変わった場合は新しいモデルをバックグラウンドで読み込み、
+    読み込みが終わった時点で切り替える（それまでは今のモデルで文字起こしを続ける）。
+    """
+    app_config.update(changes)
+    load_model()
+    manager.max_models = max(1, app_config.get("max_resident_models", 2))
+    manager.memory_budget_mb = app_config.get("model_memory_budget_mb", 0)
+    spec = model_spec()
+    if not manager.set_active(spec):
+        print(f"モデル{spec}をバックグラウンドで読み込んでいます。完了までは現在のモデルを使用します。")
+    manager.set_fast(fast_model_spec())
+
+def warm_up(model, duration_s=1.0):
+    """無音で短い推論を行い、CTranslate2の初回実行コストを先に払っておく。"""
+    silence = np.zeros(int(SAMPLE_RATE * duration_s), dtype=np.float32)
+    segments, _ = model.transcribe(silence, beam_size=1, language=app_config["language"], vad_filter=False)
+    for _ in segments:
+        pass
+
+def warm_up_model(duration_s=1.0):
+    """モデルをロードする（ロード時にウォームアップも行う）。"""
+    load_model()
+
+def get_batched_pipeline(resident):
+    """faster-whisperのバッチ推論パイプラインを返す（モデルごとに初回のみ作成する）。"""
+    if "batched_pipeline" not in resident.cache:
+        resident.cache["batched_pipeline"] = BatchedInferencePipeline(model=resident.model)
+    return resident.cache["batched_pipeline"]
+
+def batched_clip_timestamps(speech_regions, total_samples):
+    """音声区間(秒)を、バッチ推論用に最長BATCH_CLIP_MAX_S秒の区間（サンプル単位）へ分割する。"""
+    max_samples = int(BATCH_CLIP_MAX_S * SAMPLE_RATE)
+    clips = []
+    for start_s, end_s in speech_regions:
+        start = int(start_s * SAMPLE_RATE)
+        end = min(int(end_s * SAMPLE_RATE), total_samples)
+        while start < end:
+            clips.append({"start": start, "end": min(start + max_samples, end)})
+            start += max_samples
+    return clips
+
+def transcribe_audio(audio_data, current_prompt="", speech_regions=None):
+    """音声を文字起こしし、テキストを返す。"""
+    segments = transcribe_segments(audio_data, current_prompt, speech_regions)
+    return "".join(text for _, _, text in segments)
+
+def transcribe_segments(audio_data, current_prompt="", speech_regions=None, should_stop=None, profile=None, rejected=None):
+    """
+    音声を文字起こしし、セグメントのリスト [(開始秒, 終了秒, テキスト), ...] を返す。
+    speech_regionsが渡され、use_frontend_vadが有効な場合は
+    その区間だけをclip_timestampsとしてデコードし、faster-whisper内蔵のSilero VADを省略する。
+    should_stopが渡された場合は、セグメントをデコードするたびに呼び出し、Trueを返したらそこで打ち切る
+    （セグメントは逐次デコードされるため、残りの区間の推論を省略できる）。
+    profileはデコード設定のプロファイル名（decoding_profile.PROFILES）で、省略時は設定のdecoding_profileを使う。
+    no_speech_probがspeech_gate_max_no_speech_probを超え、かつavg_logprobがspeech_gate_min_avg_logprobを下回る
+    セグメントは、無音や雑音に対する幻覚とみなして結果から除外する（rejectedにリストが渡されていれば、除外したセグメントを追加する）。
+    """
+    load_model()
+
+    if audio_data is None:
+        return []
+
+    use_frontend_vad = speech_regions is not None and app_config.get("use_frontend_vad", True)
+    if use_frontend_vad and not speech_regions:
+        print("音声区間が検出されなかったため、文字起こしを省略します。")
+        return []
+
+    audio_float32 = to_float32_buffer(audio_data)
+
+    audio_duration = len(audio_float32) / SAMPLE_RATE
+    batched_min_duration = app_config.get("batched_min_duration_s", 0)
+    use_batched = batched_min_duration > 0 and audio_duration >= batched_min_duration
+    resident = manager.route(
+        audio_duration,
+        app_config.get("routing_short_s", 3.0),
+        app_config.get("routing_latency_target_s", 0.5),
+    )
+
+    if use_batched:
+        # 長い発話は区間ごとにまとめてバッチ推論する
+        engine = get_batched_pipeline(resident)
+        vad_options = {"batch_size": app_config.get("batch_size", 8)}
+        if use_frontend_vad:
+            vad_options["vad_filter"] = False
+            vad_options["clip_timestamps"] = batched_clip_timestamps(speech_regions, len(audio_float32))
+        else:
+            vad_options["vad_filter"] = True
+    elif use_frontend_vad:
+        engine = resident.model
+        vad_options = {
+            "vad_filter": False,
+            "clip_timestamps": [t for region in speech_regions for t in region],
+        }
+    else:
+        engine = resident.model
+        vad_options = {"vad_filter": True}
+
+    profile = decoding_profile.resolve(profile or app_config.get("decoding_profile"))
+    print("文字起こしを開始します...")
+    start_time = time.time()
+    segments, info = engine.transcribe(
+        audio_float32,
+        language=app_config["language"],
+        initial_prompt=current_prompt,
+        **decoding_profile.decode_options(profile),
+        **vad_options
+    )
+
+    print(f"[DEBUG] Detected language: '{info.language}' with probability {info.language_probability:.2f}")
+    post_gate = app_config.get("speech_gate_enabled", True)
+    max_no_speech_prob = app_config.get("speech_gate_max_no_speech_prob", 0.6)
+    min_avg_logprob = app_config.get("speech_gate_min_avg_logprob", -1.0)
+    transcribed_segments = []
+    for segment in segments:
+        if post_gate and segment.no_speech_prob > max_no_speech_prob and segment.avg_logprob < min_avg_logprob:
+            print(f"発話でないとみなしたセグメントを除外しました: '{segment.text}' "
+                  f"(no_speech_prob: {segment.no_speech_prob:.2f}, avg_logprob: {segment.avg_logprob:.2f})")
+            if rejected is not None:
+                rejected.append((segment.start, segment.end, segment.text))
+        else:
+            transcribed_segments.append((segment.start, segment.end, segment.text))
+        if should_stop is not None and should_stop():
+            print("文字起こしを中断しました。")
+            break
+    end_time = time.time()
+    processing_time = end_time - start_time
+    resident.record(audio_duration, processing_time)
+    vad_name = "フロントエンド" if use_frontend_vad else "Silero"
+    if use_batched:
+        vad_name += ", バッチ推論"
+    print(f"文字起こし完了 (処理時間: {processing_time:.2f}秒, 音声: {audio_duration:.2f}秒, RTF: {processing_time / audio_duration:.2f}, VAD: {vad_name}, モデル: {resident.spec[0]}, デコード: {profile})")
+
+    return transcribed_segments
@@ -0,0 +1,719 @@
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from config import app_config
+from audio_processor import SAMPLE_RATE
+from shared_audio import SharedAudioRing
+from worker_pool import TranscriptionWorkerPool
+
+# 文字起こしプロセスのプールをローカルのサービスとして公開し、複数のクライアント
+# （トレイアプリ、バッチ処理、別のユーザーセッション）で1つの読み込み済みモデルを共有する（python main.py serve）。
+# 通信はlocalhostのTCPまたはUnixドメインソケットで、接続は使い続ける。
+# フレームは [種類 1バイト | メタ情報の長さ 4バイト | PCMの長さ 4バイト] のヘッダーに、
+# メタ情報（UTF-8のJSON）とPCM（リトルエンディアンのint16、16kHzモノラル）が続く。
+# サーバーは依頼をクライアントごとの待ち行列に入れ、ワーカーに空きができるたびにクライアントを順番に回って
+# 1件ずつ投入する（ラウンドロビン）。大量の依頼を送るクライアントがいても、他のクライアントの依頼は待たされない。
+# RemoteWorkerPoolはTranscriptionWorkerPoolと同じ呼び出し方でサーバーに依頼を送るクライアントで、
+# トレイアプリはサーバーが起動していればこれを使い、なければ自身で文字起こしプロセスを起動する。
+
+# --- 定数 ---
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("<BII") # 種類, メタ情報のバイト数, PCMのバイト数
+FRAME_HELLO = 1 # 接続時のあいさつ（クライアント→サーバー、サーバー→クライアント）
+FRAME_REQUEST = 2 # 文字起こしの依頼（メタ情報 + PCM）
+FRAME_RESULT = 3 # 文字起こしの結果
+FRAME_CONTROL = 4 # 状態通知（サーバー→クライアント）と、世代・設定の変更（クライアント→サーバー）
+PCM_DTYPE = np.dtype("<i2")
+MAX_META_BYTES = 1024 * 1024 # サーバーが受け付けるメタ情報の最大サイズ（PCMの上限は共有音声バッファの長さから決める）
+INFLIGHT_PER_WORKER = 1 # ワーカー1つあたりに同時に投入する依頼の数（残りはサーバーの待ち行列で順番を待つ）
+CONNECT_TIMEOUT_S = 2.0 # 接続とあいさつの待ち時間
+RECONNECT_INTERVAL_S = 2.0 # 接続が切れた後、再接続を試みる間隔
+LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+GENERATION_SLOTS = 32 # 推論中の依頼を世代で中断できるクライアントの数（超えた分は待ち行列の依頼だけを取り除く）
+DEFAULT_ADDRESS = "127.0.0.1:50750" # transcription_server_addressが空の場合にserve/clientが使うアドレス
+
+
+def parse_address(address):
+    """"host:port" または "unix:パス" を (アドレスファミリー, ソケットアドレス) に変換する。"""
+    if address.startswith("unix:"):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("この環境ではUnixドメインソケットを使用できません。")
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+def open_connection(address, timeout=None):
+    family, sock_address = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(sock_address)
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+def _json_default(value):
+    return value.item() # numpyのスカラー（VADの音声区間など）
+
+def send_frame(sock, frame_type, meta, pcm=None):
+    body = json.dumps(meta, ensure_ascii=False, default=_json_default).encode("utf-8")
+    payload = b"" if pcm is None else np.ascontiguousarray(pcm, dtype=PCM_DTYPE).reshape(-1).tobytes()
+    sock.sendall(HEADER.pack(frame_type, len(body), len(payload)) + body + payload)
+
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("接続が閉じられました。")
+        received += count
+    return buffer
+
+def recv_frame(sock, max_meta_bytes=None, max_pcm_bytes=None):
+    """
+    フレームを1つ受け取り、(種類, メタ情報, PCM（なければNone）) を返す。
+    ヘッダーのサイズが上限を超える場合は、本体を受け取らずにValueErrorにする（呼び出し側は接続を閉じる）。
+    """
+    frame_type, meta_size, pcm_size = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if (max_meta_bytes is not None and meta_size > max_meta_bytes) or (max_pcm_bytes is not None and pcm_size > max_pcm_bytes):
+        raise ValueError(f"フレームが大きすぎます (メタ情報 {meta_size}バイト, PCM {pcm_size}バイト)。")
+    meta = json.loads(recv_exact(sock, meta_size).decode("utf-8"))
+    pcm = np.frombuffer(recv_exact(sock, pcm_size), dtype=PCM_DTYPE) if pcm_size else None
+    return frame_type, meta, pcm
+
+def empty_result(seq, status):
+    """文字起こしをしなかった依頼の結果（ワーカーの結果と同じ項目）を作る。"""
+    return {
+        "seq": seq,
+        "worker_id": None,
+        "status": status,
+        "text": "",
+        "segments": [],
+        "audio_s": 0.0,
+        "processing_s": 0.0,
+        "dequeued_at": None,
+        "finished_at": None,
+        "rss_mb": None,
+    }
+
+
+class ClientConnection:
+    """サーバーに接続しているクライアント1つ分の接続と、処理待ちの依頼。"""
+
+    def __init__(self, server, sock, client_id, name):
+        self.server = server
+        self.sock = sock
+        self.client_id = client_id
+        self.name = name
+        self.pending = deque() # 処理待ちの依頼 (メタ情報, PCM)
+        self.generation = None # クライアントの録音セッションの世代（これより古い依頼は処理しない）
+        self.generation_slot = None # ワーカーと共有する世代の枠（空きがなければNone）
+        self.requests = 0
+        self.closed = False
+        self._send_lock = threading.Lock()
+
+    def send(self, frame_type, meta):
+        if self.closed:
+            return
+        try:
+            with self._send_lock:
+                send_frame(self.sock, frame_type, meta)
+        except OSError:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def serve(self):
+        """クライアントからのフレームを受け取り続ける（接続ごとのスレッドで実行する）。"""
+        try:
+            while True:
+                frame_type, meta, pcm = recv_frame(self.sock, MAX_META_BYTES, self.server.max_pcm_bytes)
+                if frame_type == FRAME_REQUEST:
+                    self.server.enqueue(self, meta, pcm)
+                elif frame_type == FRAME_CONTROL:
+                    self.server.handle_control(self, meta)
+        except (ConnectionError, OSError):
+            pass
+        except ValueError as e:
+            print(f"警告: クライアント{self.client_id}（{self.name}）から不正なフレームを受け取ったため、切断します。 {e}")
+        finally:
+            self.server.disconnect(self)
+
+
+class TranscriptionServer:
+    """文字起こしプロセスのプールを起動し、接続したクライアントからの依頼を公平に振り分ける。"""
+
+    def __init__(self, address, worker_count, engine="whisper", config_overrides=None):
+        self.address = address
+        self.output_queue = multiprocessing.Queue()
+        self.control_queue = multiprocessing.Queue()
+        self.ring = SharedAudioRing.create(int(app_config["shared_audio_buffer_s"] * SAMPLE_RATE))
+        self.pool = TranscriptionWorkerPool(
+            worker_count, self.output_queue, self.control_queue, self.ring, engine, config_overrides,
+            generation_slots=GENERATION_SLOTS,
+        )
+        self.engine = engine
+        self.max_inflight = self.pool.worker_count * INFLIGHT_PER_WORKER
+        # 1件の依頼の音声は共有音声バッファより長くならない
+        self.max_pcm_bytes = int(app_config["shared_audio_buffer_s"] * SAMPLE_RATE) * PCM_DTYPE.itemsize
+        self.clients = [] # 接続中のクライアント（ラウンドロビンの順）
+        self.inflight = {} # ワーカーに投入した依頼 (サーバーの連番 -> (クライアント, クライアントの連番, 共有バッファの位置))
+        self.ready_messages = {} # 準備完了のワーカーの通知（あとから接続したクライアントにも送る）
+        self.free_generation_slots = set(range(GENERATION_SLOTS))
+        self.next_seq = 0
+        self.next_client_id = 0
+        self._next_client = 0 # 次に依頼を取り出すクライアントの位置
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._listener = None
+
+    def start(self):
+        """待ち受けを開始してから文字起こしプロセスを起動する（アドレスが使用中ならOSErrorになる）。"""
+        family, sock_address = parse_address(self.address)
+        if family == socket.AF_INET and sock_address[0] not in LOOPBACK_HOSTS:
+            print(f"警告: {sock_address[0]} で待ち受けます。文字起こしサーバーには認証がないため、localhost以外は推奨しません。")
+        if family != socket.AF_INET and os.path.exists(sock_address):
+            os.unlink(sock_address) # 前回のサーバーが残したソケットファイル
+        self._listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET and sys.platform != "win32":
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self._listener.bind(sock_address)
+            self._listener.listen()
+        except OSError:
+            self._listener.close()
+            self.ring.close()
+            raise
+        self.pool.start()
+        self.pool.start_supervisor(app_config.get("worker_heartbeat_timeout_s", 10.0))
+        for target in (self._dispatch, self._collect_results, self._forward_control):
+            threading.Thread(target=target, daemon=True).start()
+        print(f"文字起こしサーバーを開始しました: {self.address} (ワーカー {self.pool.worker_count}個, エンジン: {self.engine})")
+
+    def serve_forever(self):
+        while not self._stop_event.is_set():
+            try:
+                sock, _ = self._listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._accept, args=(sock,), daemon=True).start()
+
+    def _accept(self, sock):
+        """あいさつを交わしてからクライアントを登録し、準備完了のワーカーを知らせる。"""
+        if self._stop_event.is_set():
+            sock.close()
+            return
+        try:
+            sock.settimeout(CONNECT_TIMEOUT_S)
+            frame_type, meta, _ = recv_frame(sock, MAX_META_BYTES, 0)
+            if frame_type != FRAME_HELLO or meta.get("version") != PROTOCOL_VERSION:
+                raise ConnectionError(f"対応していないクライアントです ({meta})。")
+            sock.settimeout(None)
+            if sock.family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            send_frame(sock, FRAME_HELLO, {
+                "version": PROTOCOL_VERSION,
+                "workers": self.pool.worker_count,
+                "engine": self.engine,
+            })
+        except (ConnectionError, OSError, ValueError) as e:
+            print(f"警告: クライアントとのあいさつに失敗しました。 {e}")
+            sock.close()
+            return
+        with self._condition:
+            client = ClientConnection(self, sock, self.next_client_id, meta.get("name", "client"))
+            self.next_client_id += 1
+            if self.free_generation_slots:
+                client.generation_slot = min(self.free_generation_slots)
+                self.free_generation_slots.discard(client.generation_slot)
+            self.clients.append(client)
+            ready_messages = list(self.ready_messages.values())
+        print(f"クライアント{client.client_id}（{client.name}）が接続しました。")
+        for message in ready_messages:
+            client.send(FRAME_CONTROL, message)
+        client.serve()
+
+    def disconnect(self, client):
+        with self._condition:
+            if client not in self.clients:
+                return
+            index = self.clients.index(client)
+            self.clients.remove(client)
+            if index < self._next_client:
+                self._next_client -= 1
+            dropped = len(client.pending)
+            client.pending.clear()
+            if client.generation_slot is not None:
+                self.free_generation_slots.add(client.generation_slot)
+        client.close()
+        print(f"クライアント{client.client_id}（{client.name}）が切断しました (処理待ちの{dropped}件を破棄, 処理済み {client.requests}件)。")
+
+    def enqueue(self, client, meta, pcm):
+        with self._condition:
+            if client.generation is None and meta.get("generation") is not None:
+                # 世代の通知を受け取るまでは、最初の依頼の世代を現在の世代とする
+                self._set_generation(client, meta["generation"])
+            client.pending.append((meta, pcm))
+            self._condition.notify()
+
+    def handle_control(self, client, message):
+        if message.get("type") == "generation":
+            # 録音を止めたクライアントの待ち行列から、古い世代の依頼を取り除く
+            with self._condition:
+                self._set_generation(client, message["generation"])
+                kept, stale = deque(), []
+                for meta, pcm in client.pending:
+                    if self._request_status(client, meta) == "cancelled":
+                        stale.append(meta)
+                    else:
+                        kept.append((meta, pcm))
+                client.pending = kept
+            for meta in stale:
+                client.send(FRAME_RESULT, empty_result(meta["seq"], "cancelled"))
+        elif message.get("type") == "configure":
+            # モデルの設定はすべてのクライアントで共有される
+            print(f"クライアント{client.client_id}が設定を変更しました: {message['config']}")
+            self.pool.broadcast(message)
+        elif message.get("type") == "preload":
+            # いずれかのクライアントが録音を始めたら、解放していたモデルを読み込み直す
+            self.pool.broadcast(message)
+
+    def _set_generation(self, client, generation):
+        """クライアントの世代を更新し、推論中の古い世代の依頼もワーカーが中断できるようにする（_conditionを保持して呼ぶ）。"""
+        client.generation = generation
+        if client.generation_slot is not None:
+            self.pool.set_generation(generation, client.generation_slot)
+
+    def _request_status(self, client, meta):
+        if client.generation is not None and meta.get("generation") is not None and meta["generation"] != client.generation:
+            return "cancelled"
+        if meta.get("deadline") is not None and time.monotonic() > meta["deadline"]:
+            return "expired"
+        return "ok"
+
+    def _next_request(self):
+        """待ち行列のあるクライアントを順番に回り、次の依頼を1件取り出す（_conditionを保持して呼ぶ）。"""
+        for step in range(len(self.clients)):
+            index = (self._next_client + step) % len(self.clients)
+            client = self.clients[index]
+            if client.pending:
+                self._next_client = (index + 1) % len(self.clients)
+                meta, pcm = client.pending.popleft()
+                return client, meta, pcm
+        return None
+
+    def _dispatch(self):
+        """ワーカーに空きがあれば、クライアントを順番に回って依頼を投入する。"""
+        while not self._stop_event.is_set():
+            with self._condition:
+                item = None
+                while not self._stop_event.is_set():
+                    if len(self.inflight) < self.max_inflight:
+                        item = self._next_request()
+                        if item is not None:
+                            break
+                    self._condition.wait()
+                if item is None:
+                    return
+                client, meta, pcm = item
+                status = self._request_status(client, meta)
+                if status == "ok":
+                    seq = self.next_seq
+                    self.next_seq += 1
+                    location = self.ring.write(pcm)
+                    self.inflight[seq] = (client, meta["seq"], location)
+            if status != "ok":
+                client.send(FRAME_RESULT, empty_result(meta["seq"], status))
+                continue
+            message = dict(meta, seq=seq)
+            if client.generation_slot is None:
+                message.pop("generation", None) # 世代の枠がないクライアントの依頼は、推論を始めたら中断しない
+            else:
+                message["generation_slot"] = client.generation_slot
+            if location is None:
+                message["audio"] = pcm
+            else:
+                message["offset"], message["length"] = location
+            self.pool.submit(message)
+
+    def _collect_results(self):
+        while True:
+            result = self.output_queue.get()
+            if result is None:
+                break
+            if not self.pool.complete(result):
+                continue
+            with self._condition:
+                client, client_seq, location = self.inflight.pop(result["seq"])
+                self._condition.notify()
+            if location is not None:
+                self.ring.release(location[0])
+            client.requests += 1
+            result["seq"] = client_seq
+            client.send(FRAME_RESULT, result)
+
+    def _forward_control(self):
+        """ワーカーからの状態通知を記録し、接続中のすべてのクライアントに転送する。"""
+        while True:
+            message = self.control_queue.get()
+            if message is None:
+                break
+            worker_id = message["worker_id"]
+            if message["type"] == "ready":
+                self.pool.mark_ready(worker_id)
+                print(f"文字起こしプロセス{worker_id}の準備が完了しました (モデルロード: {message['load_s']:.2f}秒)")
+            with self._condition:
+                if message["type"] == "ready":
+                    self.ready_messages[worker_id] = message
+                elif message["type"] == "restarted":
+                    self.ready_messages.pop(worker_id, None)
+                clients = list(self.clients)
+            for client in clients:
+                client.send(FRAME_CONTROL, message)
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        try:
+            # closeだけではaccept中のスレッドが起きず、もう1つ接続を受け付けてしまう
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._listener.close()
+        with self._condition:
+            clients = list(self.clients)
+            self._condition.notify_all()
+        for client in clients:
+            client.close()
+        self.pool.stop(timeout=timeout)
+        self.output_queue.put(None)
+        self.control_queue.put(None)
+        for line in self.pool.stats_lines():
+            print(f"[統計] {line}")
+        self.ring.close()
+        family, sock_address = parse_address(self.address)
+        if family != socket.AF_INET and os.path.exists(sock_address):
+            os.unlink(sock_address)
+
+
+class RemoteWorkerPool:
+    """
+    文字起こしサーバーに依頼を送るクライアント。TranscriptionWorkerPoolと同じ呼び出し方で使え、
+    結果はoutput_queueに、ワーカーの状態通知はcontrol_queueに届く。
+    依頼の音声は呼び出し側の共有バッファ（ring）から読んで送る。
+    接続が切れた場合は、処理中の依頼をstatus="failed"の結果で知らせて再接続を試みる。
+    start_supervisorで指定した時間内に再接続できなければ諦め、control_queueに"server_lost"を通知する
+    （呼び出し側は自身の文字起こしプロセスに切り替える）。
+    """
+
+    def __init__(self, address, output_queue, control_queue, ring, name="whisptype"):
+        self.address = address
+        self.output_queue = output_queue
+        self.control_queue = control_queue
+        self.ring = ring
+        self.name = name
+        self.worker_count = 1 # サーバーのワーカーの数（あいさつで受け取る）
+        self.ready_workers = set()
+        self.assigned = set() # 結果を待っている依頼の連番
+        self.stats = {"requests": 0, "audio_s": 0.0, "processing_s": 0.0}
+        self.generation = 0
+        self._sock = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock) # 結果を待っている依頼がなくなったら通知される
+        self._send_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._receiver = None
+        self.reconnect_timeout_s = 0.0 # 再接続を諦めるまでの時間（0の場合は諦めない）
+
+    @classmethod
+    def connect(cls, address, output_queue, control_queue, ring, name="whisptype"):
+        """サーバーに接続する。サーバーが起動していない場合はNoneを返す。"""
+        pool = cls(address, output_queue, control_queue, ring, name)
+        try:
+            pool._connect()
+        except (OSError, ConnectionError, ValueError):
+            return None
+        return pool
+
+    def _connect(self):
+        sock = open_connection(self.address, timeout=CONNECT_TIMEOUT_S)
+        try:
+            send_frame(sock, FRAME_HELLO, {"version": PROTOCOL_VERSION, "name": self.name, "pid": os.getpid()})
+            frame_type, meta, _ = recv_frame(sock)
+            if frame_type != FRAME_HELLO or meta.get("version") != PROTOCOL_VERSION:
+                raise ConnectionError(f"対応していないサーバーです ({meta})。")
+            sock.settimeout(None)
+        except Exception:
+            sock.close()
+            raise
+        self.worker_count = meta["workers"]
+        with self._lock:
+            self._sock = sock
+
+    def start(self):
+        self._receiver = threading.Thread(target=self._receive, daemon=True)
+        self._receiver.start()
+
+    def _receive(self):
+        while not self._stop_event.is_set():
+            try:
+                sock = self._sock
+                if sock is None:
+                    raise ConnectionError("接続していません。")
+                while True:
+                    frame_type, meta, _ = recv_frame(sock)
+                    if frame_type == FRAME_RESULT:
+                        self.output_queue.put(meta)
+                    elif frame_type == FRAME_CONTROL:
+                        self.control_queue.put(meta)
+            except (ConnectionError, OSError, ValueError):
+                pass
+            if self._stop_event.is_set():
+                return
+            self._on_disconnected()
+            disconnected_at = time.perf_counter()
+            while not self._stop_event.wait(RECONNECT_INTERVAL_S):
+                try:
+                    self._connect()
+                except (OSError, ConnectionError, ValueError):
+                    if self.reconnect_timeout_s > 0 and time.perf_counter() - disconnected_at > self.reconnect_timeout_s:
+                        self.control_queue.put({
+                            "type": "server_lost",
+                            "worker_id": None,
+                            "reason": f"文字起こしサーバー({self.address})に{self.reconnect_timeout_s:.0f}秒以上再接続できません",
+                        })
+                        return
+                    continue
+                print(f"文字起こしサーバー({self.address})に再接続しました。")
+                self._send(FRAME_CONTROL, {"type": "generation", "generation": self.generation})
+                break
+
+    def _on_disconnected(self):
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+            self._sock = None
+            self.ready_workers.clear()
+            failed = list(self.assigned)
+        for seq in failed:
+            self.output_queue.put(empty_result(seq, "failed"))
+        self.control_queue.put({
+            "type": "disconnected",
+            "worker_id": None,
+            "reason": f"文字起こしサーバー({self.address})との接続が切れました",
+            "failed": len(failed),
+        })
+
+    def _send(self, frame_type, meta, pcm=None):
+        """フレームを送る。接続していない・送れなかった場合はFalseを返す。"""
+        with self._lock:
+            sock = self._sock
+        if sock is None:
+            return False
+        try:
+            with self._send_lock:
+                send_frame(sock, frame_type, meta, pcm)
+        except OSError:
+            return False
+        return True
+
+    def mark_ready(self, worker_id):
+        with self._lock:
+            self.ready_workers.add(worker_id)
+
+    def set_generation(self, generation):
+        self.generation = generation
+        self._send(FRAME_CONTROL, {"type": "generation", "generation": generation})
+
+    def submit(self, message):
+        """依頼をサーバーに送る（TranscriptionWorkerPool.submitと同じ形式）。"""
+        meta = {key: value for key, value in message.items() if key not in ("audio", "offset", "length")}
+        if "audio" in message:
+            audio = message["audio"]
+        else:
+            audio = self.ring.read(message["offset"], message["length"])
+        with self._lock:
+            self.assigned.add(message["seq"])
+        if not self._send(FRAME_REQUEST, meta, audio):
+            # 接続が切れている。受信スレッドがすでに処理中の依頼を失敗として知らせた後かもしれないため、ここで知らせる
+            with self._lock:
+                failed = message["seq"] in self.assigned
+            if failed:
+                self.output_queue.put(empty_result(message["seq"], "failed"))
+        return 0
+
+    def complete(self, result):
+        with self._lock:
+            if result["seq"] not in self.assigned:
+                return False
+            self.assigned.discard(result["seq"])
+            if result.get("status", "ok") == "ok":
+                self.stats["requests"] += 1
+                self.stats["audio_s"] += result["audio_s"]
+                self.stats["processing_s"] += result["processing_s"]
+            if not self.assigned:
+                self._idle.notify_all()
+        return True
+
+    def stats_lines(self):
+        with self._lock:
+            stats = self.stats
+            rtf = stats["processing_s"] / stats["audio_s"] if stats["audio_s"] else 0.0
+            return [
+                f"サーバー({self.address}): {stats['requests']}件, 音声 {stats['audio_s']:.1f}秒, "
+                f"処理 {stats['processing_s']:.1f}秒, RTF {rtf:.2f}, 処理中 {len(self.assigned)}件"
+            ]
+
+    def broadcast(self, message):
+        """設定の変更などをサーバーに送る（サーバーのすべてのワーカーに適用される）。"""
+        self._send(FRAME_CONTROL, message)
+
+    def start_supervisor(self, heartbeat_timeout_s):
+        """
+        ワーカーの監視はサーバー側で行う。クライアント側では、接続が切れてからheartbeat_timeout_s秒以内に
+        再接続できなければサーバーが止まったとみなす。
+        """
+        self.reconnect_timeout_s = heartbeat_timeout_s
+
+    def stop(self, timeout=None):
+        """結果を待っている依頼がなくなるまで（最大timeout秒）待ってから、接続を閉じる。"""
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        with self._idle:
+            while self.assigned and self._sock is not None:
+                remaining = None if deadline is None else deadline - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._idle.wait(remaining)
+        self._stop_event.set()
+        with self._lock:
+            sock = self._sock
+            self._sock = None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        if self._receiver is not None:
+            self._receiver.join(timeout)
+
+
+def run_server(args):
+    """python main.py serve の処理を実行する。"""
+    address = args.address or app_config.get("transcription_server_address") or DEFAULT_ADDRESS
+    worker_count = args.workers or app_config["num_transcription_workers"]
+    config_overrides = {"num_transcription_workers": worker_count}
+    if args.model:
+        config_overrides["model_size"] = args.model
+    server = TranscriptionServer(address, worker_count, args.engine, config_overrides)
+    try:
+        server.start()
+    except OSError as e:
+        print(f"エラー: {address} で待ち受けられませんでした。 {e}")
+        return
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("文字起こしサーバーを終了します。")
+    finally:
+        server.stop(timeout=app_config.get("shutdown_timeout_s", 5.0))
+
+
+class StandInClient:
+    """
+    動作確認用のクライアント。WAVファイルをchunk_s秒ごとに区切ってサーバーに送り、結果と応答時間を表示する。
+    複数同時に動かすと、サーバーのクライアント間の振り分けを確認できる。
+    """
+
+    def __init__(self, client_index, address):
+        self.client_index = client_index
+        self.address = address
+        self.output_queue = queue.Queue()
+        self.control_queue = queue.Queue()
+        self.latencies = []
+        self.audio_s = 0.0
+
+    def run(self, chunks):
+        # 音声は依頼に直接入れて送るため、共有バッファは使わない
+        pool = RemoteWorkerPool.connect(
+            self.address, self.output_queue, self.control_queue, None, name=f"stand-in-{self.client_index}"
+        )
+        if pool is None:
+            raise ConnectionError(f"文字起こしサーバー({self.address})に接続できませんでした。")
+        pool.start()
+        try:
+            submitted_at = {}
+            for seq, chunk in enumerate(chunks):
+                submitted_at[seq] = time.perf_counter()
+                pool.submit({"seq": seq, "prompt": app_config.get("default_initial_prompt", ""),
+                             "speech_regions": None, "overlap_s": 0.0, "audio": chunk})
+            for _ in chunks:
+                result = self.output_queue.get()
+                pool.complete(result)
+                latency = time.perf_counter() - submitted_at[result["seq"]]
+                self.latencies.append(latency)
+                self.audio_s += result["audio_s"]
+                print(f"[クライアント{self.client_index}] #{result['seq']} ({result['status']}, "
+                      f"応答 {latency:.2f}秒, ワーカー{result['worker_id']}): {result['text']}")
+        finally:
+            pool.stop(timeout=CONNECT_TIMEOUT_S)
+
+
+def run_client(args):
+    """python main.py client の処理を実行する（サーバーの動作確認用）。"""
+    from benchmark import load_wav
+    from resampler import StreamingResampler
+
+    address = args.address or app_config.get("transcription_server_address") or DEFAULT_ADDRESS
+    chunk_samples = max(1, int(args.chunk_s * SAMPLE_RATE))
+    chunks = []
+    for path in args.wav_files:
+        samples, sample_rate = load_wav(path)
+        audio = StreamingResampler(sample_rate, SAMPLE_RATE, samples.shape[1]).process(samples).copy()
+        chunks.extend(audio[i:i + chunk_samples] for i in range(0, len(audio), chunk_samples))
+    if not chunks:
+        print("送信する音声がありません。")
+        return
+    clients = [StandInClient(index, address) for index in range(max(1, args.clients))]
+    errors = []
+
+    def run(client):
+        try:
+            client.run(chunks)
+        except ConnectionError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(client,)) for client in clients]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        print(f"エラー: {errors[0]}")
+        return
+    elapsed = time.perf_counter() - start_time
+    for client in clients:
+        print(f"[クライアント{client.client_index}] {len(client.latencies)}件, 音声 {client.audio_s:.1f}秒, "
+              f"応答 平均 {np.mean(client.latencies):.2f}秒 / 最大 {np.max(client.latencies):.2f}秒")
+    print(f"全体: {elapsed:.2f}秒")
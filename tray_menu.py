@@ -1,41 +1,56 @@
 import pystray
 from PIL import Image
 import os
-import sounddevice as sd
 from config import app_config, update_config
-from audio_processor import SAMPLE_RATE, CHANNELS
-
-def get_mic_device_menu():
-    """利用可能な入力デバイスのリストからpystrayのメニュー項目を生成する。"""
-    devices = sd.query_devices()
-    unique_input_devices = {}
-    for i, device in enumerate(devices):
-        try:
-            if device['max_input_channels'] > 0:
-                sd.check_input_settings(
-                    device=i,
-                    samplerate=SAMPLE_RATE,
-                    channels=CHANNELS
-                )
-                key = (device['name'], device['hostapi'])
-                if key not in unique_input_devices:
-                    hostapi_info = sd.query_hostapis(device['hostapi'])
-                    hostapi_name = hostapi_info.get('name', 'Unknown API')
-                    unique_input_devices[key] = {
-                        'name': device['name'],
-                        'index': i,
-                        'hostapi_name': hostapi_name
-                    }
-        except Exception:
-            pass
+import metrics
+import decoding_profile
 
+# --- トレイの状態表示 ---
+TRAY_STATUS_TEXT = {
+    "loading": "モデルを読み込み中...",
+    "ready": "準備完了",
+    "error": "モデルの読み込みに失敗しました",
+}
+tray_status = "loading"
+
+# --- モデルの選択肢 ---
+MODEL_SIZES = ["tiny", "base", "small", "medium", "large-v3"]
+COMPUTE_TYPES = ["int8", "float16", "float32"]
+INSERTION_BACKENDS = [
+    ("auto", "自動（速い方式を選ぶ）"),
+    ("unicode", "キー入力"),
+    ("clipboard", "クリップボード"),
+]
+DECODING_PROFILES = [("auto", "自動（負荷に応じて切り替える）")] + [
+    (name, decoding_profile.PROFILE_LABELS[name]) for name in decoding_profile.PROFILE_ORDER
+]
+_icon_images = {}
+
+def set_tray_status(icon, status):
+    """トレイアイコンの状態（loading/ready/error）を更新する。読み込み中はアイコンをグレー表示にする。"""
+    global tray_status
+    tray_status = status
+    icon.icon = _icon_images["ready" if status == "ready" else "inactive"]
+    icon.title = f"WhispType ({TRAY_STATUS_TEXT[status]})"
+    icon.update_menu()
+
+def get_mic_device_menu(device_registry, on_mic_change):
+    """キャッシュされた入力デバイスの一覧からpystrayのメニュー項目を生成する（デバイスの確認はバックグラウンドで行う）。"""
     menu_items = []
 
-    def create_action(value):
-        return lambda: update_config("mic_device_index", value)
+    def create_action(device):
+        return lambda: on_mic_change(device)
 
-    def create_checked_callback(value):
-        return lambda item: app_config["mic_device_index"] == value
+    def create_checked_callback(device):
+        def checked(item):
+            # mic_device_nameがない古い設定では、番号で一致を判定する
+            selected_name = app_config.get("mic_device_name", "")
+            if device is None:
+                return not selected_name and app_config["mic_device_index"] is None
+            if selected_name:
+                return selected_name == device["label"]
+            return app_config["mic_device_index"] == device["index"]
+        return checked
 
     menu_items.append(pystray.MenuItem(
         "デフォルト",
@@ -43,29 +58,105 @@ def get_mic_device_menu():
         checked=create_checked_callback(None)
     ))
 
-    if not unique_input_devices:
+    devices = device_registry.devices()
+    if devices is None:
+        menu_items.append(pystray.MenuItem(
+            "デバイスを検索中...",
+            None,
+            enabled=False
+        ))
+    elif not devices:
         menu_items.append(pystray.MenuItem(
             "利用可能なマイクがありません",
             None,
             enabled=False
         ))
     else:
-        sorted_devices = sorted(
-            unique_input_devices.values(), key=lambda d: d['name']
-        )
-        for device_info in sorted_devices:
-            index = device_info['index']
-            display_name = f"{device_info['name']} ({device_info['hostapi_name']})"
+        for device in devices:
             menu_items.append(pystray.MenuItem(
-                display_name,
-                create_action(index),
-                checked=create_checked_callback(index)
+                device["label"],
+                create_action(device),
+                checked=create_checked_callback(device)
             ))
-            
+
+    menu_items.append(pystray.Menu.SEPARATOR)
+    menu_items.append(pystray.MenuItem(
+        "デバイスを再検索",
+        lambda: device_registry.refresh(reinitialize=True)
+    ))
     return menu_items
 
-def create_tray_icon(listener):
+def get_metrics_menu():
+    """処理段階ごとの所要時間の統計を表示するメニュー項目を生成する。"""
+    lines = metrics.summary_lines()
+    if not lines:
+        return [pystray.MenuItem("まだ計測結果がありません", None, enabled=False)]
+    return [pystray.MenuItem(line, None, enabled=False) for line in lines]
+
+def get_model_menu(on_model_change):
+    """モデルのサイズ・計算精度・GPUの使用を切り替えるメニュー項目を生成する。"""
+    def create_action(key, value):
+        return lambda: on_model_change(key, value)
+
+    def create_checked_callback(key, value):
+        return lambda item: app_config.get(key) == value
+
+    size_items = [
+        pystray.MenuItem(size, create_action("model_size", size), checked=create_checked_callback("model_size", size), radio=True)
+        for size in MODEL_SIZES
+    ]
+    compute_items = [
+        pystray.MenuItem(compute_type, create_action("compute_type", compute_type), checked=create_checked_callback("compute_type", compute_type), radio=True)
+        for compute_type in COMPUTE_TYPES
+    ]
+    return [
+        pystray.MenuItem("モデルサイズ", pystray.Menu(*size_items)),
+        pystray.MenuItem("計算精度", pystray.Menu(*compute_items)),
+        pystray.MenuItem(
+            "GPUを使用",
+            lambda: on_model_change("use_gpu", not app_config.get("use_gpu", False)),
+            checked=lambda item: app_config.get("use_gpu", False),
+        ),
+    ]
+
+def get_insertion_menu():
+    """テキストの挿入方式を切り替えるメニュー項目を生成する。"""
+    def create_action(value):
+        return lambda: update_config("insertion_backend", value)
+
+    def create_checked_callback(value):
+        return lambda item: app_config.get("insertion_backend", "auto") == value
+
+    return [
+        pystray.MenuItem(label, create_action(value), checked=create_checked_callback(value), radio=True)
+        for value, label in INSERTION_BACKENDS
+    ]
+
+def get_decoding_menu():
+    """デコード設定（プロファイル）を切り替えるメニュー項目を生成する。自動の場合は現在のプロファイルも表示する。"""
+    def create_action(value):
+        return lambda: update_config("decoding_profile", value)
+
+    def create_checked_callback(value):
+        return lambda item: app_config.get("decoding_profile", decoding_profile.DEFAULT_PROFILE) == value
+
+    return [
+        pystray.MenuItem(label, create_action(value), checked=create_checked_callback(value), radio=True)
+        for value, label in DECODING_PROFILES
+    ] + [
+        pystray.Menu.SEPARATOR,
+        pystray.MenuItem(
+            lambda item: decoding_profile.status_line(),
+            None,
+            enabled=False,
+            visible=lambda item: app_config.get("decoding_profile") == "auto",
+        ),
+    ]
+
+def create_tray_icon(listener, on_model_change, device_registry, on_mic_change):
     icon_image = Image.open("whisp_type_icon.png")
+    _icon_images["ready"] = icon_image
+    _icon_images["inactive"] = icon_image.convert("LA").convert("RGBA")
 
     def on_quit():
         print("プログラムを終了します。")
@@ -74,16 +165,22 @@ def create_tray_icon(listener):
 
     icon = pystray.Icon(
         name="WhispType",
-        icon=icon_image,
-        title="WhispType",
+        icon=_icon_images["ready" if tray_status == "ready" else "inactive"],
+        title=f"WhispType ({TRAY_STATUS_TEXT[tray_status]})",
         menu=pystray.Menu(
+            pystray.MenuItem(lambda item: TRAY_STATUS_TEXT[tray_status], None, enabled=False),
+            pystray.MenuItem("処理時間の統計", pystray.Menu(get_metrics_menu)),
             pystray.MenuItem("設定", pystray.Menu(
                 pystray.MenuItem("言語", pystray.Menu(
                     pystray.MenuItem("日本語", lambda: update_config("language", "ja"), checked=lambda item: app_config["language"] == "ja"),
                     pystray.MenuItem("英語", lambda: update_config("language", "en"), checked=lambda item: app_config["language"] == "en")
                 )),
-                pystray.MenuItem("マイクデバイス", pystray.Menu(get_mic_device_menu)),
+                pystray.MenuItem("マイクデバイス", pystray.Menu(lambda: get_mic_device_menu(device_registry, on_mic_change))),
+                pystray.MenuItem("モデル", pystray.Menu(*get_model_menu(on_model_change))),
+                pystray.MenuItem("テキストの挿入方法", pystray.Menu(*get_insertion_menu())),
+                pystray.MenuItem("デコード設定", pystray.Menu(*get_decoding_menu())),
                 pystray.MenuItem("フィラー語リストを開く", lambda: os.startfile(app_config["filler_words_file"])),
+                pystray.MenuItem("置換辞書を開く", lambda: os.startfile(app_config["replacement_words_file"])),
             )),
             pystray.MenuItem("終了", on_quit)
         )
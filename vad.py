@@ -0,0 +1,141 @@
+import numpy as np
+
+# 音声区間検出(VAD)。
+# どの実装も process(samples) で「フレーム単位の音声 (n, frame_length)」と「各フレームが音声かどうか」を返す。
+
+# --- 定数 ---
+ENERGY_FLOOR_DB = -100.0 # 完全な無音のエネルギー(dBFS)
+MIN_SPEECH_DB = -55.0 # ノイズフロアに関係なく、これより小さいフレームは音声とみなさない
+LOUD_MARGIN_DB = 20.0 # ノイズフロアよりこれ以上大きければゼロ交差率に関係なく音声とみなす
+MAX_SPEECH_ZCR = 0.35 # これより高いゼロ交差率のフレームは雑音（ヒスノイズ等）とみなす
+ONSET_FRAMES = 2 # 発話開始と判定するのに必要な連続フレーム数
+NOISE_FLOOR_RISE = 0.02 # 非音声フレームでノイズフロアが上昇する速さ（フレームあたりの追従率）
+NOISE_FLOOR_RISE_IN_SPEECH = 0.002 # 音声中も定常雑音の増加にはゆっくり追従する
+NOISE_FLOOR_FALL = 0.5 # ノイズフロアより小さいフレームにはすばやく追従する
+
+
+class FrameBuffer:
+    """任意長のブロックを固定長フレームに分割し、端数は次回に持ち越す。"""
+
+    def __init__(self, frame_length):
+        self.frame_length = frame_length
+        self._remainder = np.empty(0, dtype=np.int16)
+
+    def split(self, samples):
+        if len(self._remainder):
+            samples = np.concatenate((self._remainder, samples))
+        frame_count = len(samples) // self.frame_length
+        used = frame_count * self.frame_length
+        self._remainder = samples[used:].copy()
+        return samples[:used].reshape(frame_count, self.frame_length)
+
+
+def frame_energy_db(frames):
+    """フレームごとのエネルギー(dBFS)を返す。"""
+    frames_float = frames.astype(np.float32) / 32768.0
+    energy = np.mean(frames_float * frames_float, axis=1)
+    return 10.0 * np.log10(energy + 1e-10)
+
+def frame_zero_crossing_rate(frames):
+    """フレームごとのゼロ交差率(0〜1)を返す。"""
+    signs = np.signbit(frames)
+    return np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (frames.shape[1] - 1)
+
+
+class EnergyThresholdVAD:
+    """固定のRMS閾値によるVAD（従来の判定方法）。"""
+
+    def __init__(self, sample_rate, frame_ms, threshold):
+        self.frame_length = int(sample_rate * frame_ms / 1000)
+        self.threshold_db = 20.0 * np.log10(threshold / 32768.0)
+        self._frame_buffer = FrameBuffer(self.frame_length)
+
+    def process(self, samples):
+        frames = self._frame_buffer.split(samples)
+        return frames, frame_energy_db(frames) > self.threshold_db
+
+
+class AdaptiveVAD:
+    """
+    フレーム単位のエネルギーとゼロ交差率、適応ノイズフロアによるVAD。
+    発話開始は「ノイズフロア + start_margin_db」、継続は「ノイズフロア + stop_margin_db」で判定する（ヒステリシス）。
+    """
+
+    def __init__(self, sample_rate, frame_ms, start_margin_db, stop_margin_db):
+        self.frame_length = int(sample_rate * frame_ms / 1000)
+        self.start_margin_db = start_margin_db
+        self.stop_margin_db = stop_margin_db
+        self.noise_floor_db = None
+        self.in_speech = False
+        self._onset_count = 0
+        self._frame_buffer = FrameBuffer(self.frame_length)
+
+    def _update_noise_floor(self, energy_db):
+        if self.noise_floor_db is None:
+            self.noise_floor_db = max(energy_db, ENERGY_FLOOR_DB)
+        elif energy_db < self.noise_floor_db:
+            self.noise_floor_db += (energy_db - self.noise_floor_db) * NOISE_FLOOR_FALL
+        else:
+            rise = NOISE_FLOOR_RISE_IN_SPEECH if self.in_speech else NOISE_FLOOR_RISE
+            self.noise_floor_db += (energy_db - self.noise_floor_db) * rise
+
+    def process(self, samples):
+        frames = self._frame_buffer.split(samples)
+        energies = frame_energy_db(frames)
+        zcrs = frame_zero_crossing_rate(frames)
+        flags = np.zeros(len(frames), dtype=bool)
+
+        for i in range(len(frames)):
+            energy_db = energies[i]
+            self._update_noise_floor(energy_db)
+            margin = energy_db - self.noise_floor_db
+            voiced = energy_db > MIN_SPEECH_DB and (zcrs[i] <= MAX_SPEECH_ZCR or margin >= LOUD_MARGIN_DB)
+
+            if self.in_speech:
+                self.in_speech = voiced and margin >= self.stop_margin_db
+            elif voiced and margin >= self.start_margin_db:
+                self._onset_count += 1
+                self.in_speech = self._onset_count >= ONSET_FRAMES
+            else:
+                self._onset_count = 0
+            if self.in_speech:
+                self._onset_count = 0
+            flags[i] = self.in_speech
+        return frames, flags
+
+
+def create_vad(config, sample_rate, silence_threshold):
+    """設定（vad_mode）に応じたVADを生成する。"""
+    frame_ms = config.get("vad_frame_ms", 20)
+    if config.get("vad_mode", "adaptive") == "energy":
+        return EnergyThresholdVAD(sample_rate, frame_ms, silence_threshold)
+    return AdaptiveVAD(
+        sample_rate,
+        frame_ms,
+        config.get("vad_start_margin_db", 12.0),
+        config.get("vad_stop_margin_db", 6.0),
+    )
+
+
+def speech_regions(speech_flags, frame_length, sample_rate, padding_s, merge_gap_s):
+    """
+    フレームごとの判定結果から、音声区間 [(開始秒, 終了秒), ...] を求める。
+    各区間の前後をpadding_sだけ広げ、間隔がmerge_gap_s未満の区間は1つにまとめる。
+    """
+    flags = np.asarray(speech_flags, dtype=np.int8)
+    if not flags.any():
+        return []
+    edges = np.diff(np.concatenate(([0], flags, [0])))
+    starts = np.flatnonzero(edges == 1) * frame_length / sample_rate
+    ends = np.flatnonzero(edges == -1) * frame_length / sample_rate
+    total_s = len(flags) * frame_length / sample_rate
+
+    regions = []
+    for start, end in zip(starts, ends):
+        start = max(0.0, start - padding_s)
+        end = min(total_s, end + padding_s)
+        if regions and start - regions[-1][1] < merge_gap_s:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+    return [(round(float(start), 3), round(float(end), 3)) for start, end in regions]
@@ -0,0 +1,215 @@
+import importlib
+import queue
+import threading
+import time
+from config import app_config
+import decoding_profile
+from audio_processor import SAMPLE_RATE
+from shared_audio import SharedAudioRing
+from startup_profile import get_rss_mb
+
+# 文字起こしプロセスのエントリポイント。
+# spawn方式ではこのモジュールが子プロセスで読み込まれるため、GUI関連のライブラリをインポートしないこと。
+
+# --- 定数 ---
+ENGINE_MODULES = {
+    "whisper": "transcriber", # faster-whisperによる文字起こし
+    "stub": "stub_transcriber", # モデルを使わない文字起こし（ベンチマーク用）
+}
+HEARTBEAT_INTERVAL_S = 1.0 # ハートビートの時刻を更新する間隔
+
+def beat_heartbeat(heartbeats, worker_id):
+    """プロセスが動いていることを示すため、共有メモリのハートビートの時刻を定期的に更新する。"""
+    while True:
+        heartbeats[worker_id] = time.monotonic()
+        time.sleep(HEARTBEAT_INTERVAL_S)
+
+def request_status(data, generation):
+    """依頼を処理する必要があれば"ok"、録音セッションが終わっていれば"cancelled"、期限を過ぎていれば"expired"を返す。"""
+    if (data.get("generation") is not None and generation is not None
+            and data["generation"] != generation[data.get("generation_slot", 0)]):
+        return "cancelled"
+    if data.get("deadline") is not None and time.monotonic() > data["deadline"]:
+        return "expired"
+    return "ok"
+
+def transcription_worker(worker_id, input_queue, output_queue, control_queue, shm_name, shm_capacity,
+                         engine="whisper", config_overrides=None, heartbeats=None, generation=None, progress=None):
+    """
+    Whisperモデルをロードし、音声データを文字起こしするプロセス。
+    起動直後にモデルのロードとウォームアップを行い、完了をcontrol_queueで通知する。
+    音声は共有メモリ上のリングバッファから (offset, length) で参照する。
+    engineで文字起こしエンジン（ENGINE_MODULESのキー）を、config_overridesで
+    このプロセスだけに適用する設定を指定できる。
+    heartbeatsとgenerationはワーカープールと共有する値で、heartbeats[worker_id]に生存確認の時刻を書き込み、
+    依頼のgenerationが現在の世代（generation[依頼のgeneration_slot]）と異なる場合や期限（deadline）を過ぎた場合は
+    文字起こしを省略・中断して、statusが"cancelled"または"expired"の空の結果を返す。
+    progress[worker_id]には推論中だけ、推論が最後に進んだ時刻（開始時とセグメントをデコードするたび）を書き込み、
+    推論していない間は0にする（ハートビートのスレッドは推論が止まっても動き続けるため、監視側はこれで推論の停止を見分ける）。
+    model_idle_unload_s秒間依頼が届かなければモデルを解放し、"preload"（録音の開始時に届く）か
+    次の依頼が届いた時点で読み込み直す。解放と読み込み直しはcontrol_queueで通知する。
+    """
+    print(f"Transcription worker process {worker_id} started.")
+    if heartbeats is not None:
+        threading.Thread(target=beat_heartbeat, args=(heartbeats, worker_id), daemon=True).start()
+    if config_overrides:
+        app_config.update(config_overrides)
+    ring = SharedAudioRing.attach(shm_name, shm_capacity)
+    try:
+        # 推論モジュール（faster_whisper/ctranslate2）はワーカープロセスでのみ読み込む
+        start_time = time.perf_counter()
+        engine_module = importlib.import_module(ENGINE_MODULES[engine])
+        load_model = engine_module.load_model
+        warm_up_model = engine_module.warm_up_model
+        transcribe_segments = engine_module.transcribe_segments
+
+        def notify_model_loaded(resident, status):
+            control_queue.put({
+                "type": "model_loaded",
+                "worker_id": worker_id,
+                "model": list(resident.spec),
+                "load_s": resident.load_s,
+                "memory_mb": resident.memory_mb,
+                "resident_models": status,
+            })
+
+        engine_module.set_model_loaded_callback(notify_model_loaded)
+        import_s = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        load_model()
+        load_s = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        warm_up_model()
+        warmup_s = time.perf_counter() - start_time
+        control_queue.put({
+            "type": "ready",
+            "worker_id": worker_id,
+            "import_s": import_s,
+            "load_s": load_s,
+            "warmup_s": warmup_s,
+            "rss_mb": get_rss_mb(),
+        })
+    except Exception as e:
+        control_queue.put({"type": "error", "worker_id": worker_id, "message": str(e)})
+        raise
+    model_loaded = True
+    last_used = time.perf_counter()
+
+    def reload_model(trigger):
+        start_time = time.perf_counter()
+        load_model()
+        control_queue.put({
+            "type": "model_reloaded",
+            "worker_id": worker_id,
+            "trigger": trigger, # "preload"（録音の開始）または"request"（依頼が先に届いた）
+            "load_s": time.perf_counter() - start_time,
+            "rss_mb": get_rss_mb(),
+        })
+
+    while True:
+        idle_unload_s = app_config.get("model_idle_unload_s", 0)
+        timeout = None
+        if model_loaded and idle_unload_s > 0:
+            timeout = max(0.0, last_used + idle_unload_s - time.perf_counter())
+        try:
+            data = input_queue.get(timeout=timeout)
+        except queue.Empty:
+            released = engine_module.unload_model()
+            if released is not None:
+                model_loaded = False
+                control_queue.put({
+                    "type": "model_unloaded",
+                    "worker_id": worker_id,
+                    "idle_s": time.perf_counter() - last_used,
+                    "rss_mb": get_rss_mb(),
+                    **released,
+                })
+            else:
+                last_used = time.perf_counter()
+            continue
+        if data is None:
+            break
+        last_used = time.perf_counter()
+        if data.get("type") == "configure":
+            # 録音を止めずに設定（モデルなど）を切り替える。モデルの読み込みはバックグラウンドで行う
+            # （解放していた場合はここで読み込み直す）
+            engine_module.configure(data["config"])
+            model_loaded = True
+            continue
+        if data.get("type") == "preload":
+            # 録音の開始時に届き、最初の発話を録音している間にモデルを読み込み直しておく
+            if not model_loaded:
+                reload_model("preload")
+                model_loaded = True
+            continue
+        dequeued_at = time.monotonic()
+        if "audio" in data:
+            # 共有バッファに空きがなかった場合はキュー経由で音声そのものが届く
+            audio_data = data["audio"]
+        else:
+            audio_data = ring.read(data["offset"], data["length"])
+
+        audio_s = len(audio_data) / SAMPLE_RATE
+        # 依頼にプロファイルがなければ（バッチ文字起こしなど）、設定のdecoding_profileを使う
+        profile = decoding_profile.resolve(data.get("profile") or app_config.get("decoding_profile"))
+        start_time = time.perf_counter()
+        status = request_status(data, generation)
+        rejected_segments = []
+        if status == "ok" and not model_loaded:
+            reload_model("request")
+            model_loaded = True
+            start_time = time.perf_counter() # 読み込み直した時間はRTFに含めない
+            status = request_status(data, generation)
+        if status == "ok":
+            stopped = []
+
+            def should_stop():
+                if progress is not None:
+                    progress[worker_id] = time.monotonic()
+                current = request_status(data, generation)
+                if current != "ok":
+                    stopped.append(current)
+                return current != "ok"
+
+            if progress is not None:
+                progress[worker_id] = time.monotonic()
+            try:
+                segments = transcribe_segments(
+                    audio_data, current_prompt=data["prompt"], speech_regions=data.get("speech_regions"),
+                    should_stop=should_stop, profile=profile, rejected=rejected_segments,
+                )
+            except Exception as e:
+                # プロセスは止めずに、この依頼だけを失敗として返す
+                print(f"エラー: 文字起こしプロセス{worker_id}で依頼#{data['seq']}の文字起こしに失敗しました: {e}")
+                status = "error"
+            finally:
+                if progress is not None:
+                    progress[worker_id] = 0.0
+            # デコードを打ち切った場合は、途中までの結果も使わない
+            if stopped:
+                status = stopped[0]
+        if status != "ok":
+            segments = []
+        if data.get("overlap_s"):
+            # 前のチャンクと重なっている先頭部分だけに収まるセグメントは、前のチャンクで文字起こし済み
+            segments = [segment for segment in segments if segment[1] > data["overlap_s"]]
+        finished_at = time.monotonic()
+        processing_s = time.perf_counter() - start_time
+        audio_data = None # 共有メモリのビューを解放する
+        last_used = time.perf_counter()
+        output_queue.put({
+            "seq": data["seq"],
+            "worker_id": worker_id,
+            "status": status, # "ok", "cancelled"（録音セッションの終了）, "expired"（期限切れ）, "error"（文字起こしの失敗）
+            "profile": profile,
+            "text": "".join(text for _, _, text in segments),
+            "segments": segments, # [(開始秒, 終了秒, テキスト), ...]（音声の先頭基準）
+            "rejected_segments": len(rejected_segments), # 推論後の判定で除外したセグメントの数
+            "audio_s": audio_s,
+            "processing_s": processing_s,
+            "dequeued_at": dequeued_at,
+            "finished_at": finished_at,
+            "rss_mb": get_rss_mb(),
+        })
+    ring.close()
+    print(f"Transcription worker process {worker_id} stopped.")
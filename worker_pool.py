@@ -0,0 +1,291 @@
+import multiprocessing
+import threading
+import time
+from config import app_config
+from worker import transcription_worker
+
+# --- 定数 ---
+SUPERVISE_INTERVAL_S = 1.0 # ワーカーの状態を確認する間隔
+DEADLINE_GRACE_S = 10.0 # 依頼の期限をこれだけ過ぎても結果が返らないワーカーは止まっているとみなす
+KILL_WAIT_S = 1.0 # terminateしてから強制終了するまで待つ時間
+STARTUP_GRACE_S = 30.0 # プロセスの起動直後（ハートビートのスレッドが動き出すまで）に応答がなくても待つ時間
+MAX_RESTARTS_BEFORE_READY = 3 # 準備完了にならないまま続けて再起動する回数の上限（モデルを読み込めない場合など）
+
+
+class TranscriptionWorkerPool:
+    """
+    文字起こしプロセスを複数起動し、依頼を最も空いているワーカーに振り分ける。
+    結果はすべてのワーカーで共通のoutput_queueに、状態通知はcontrol_queueに届く。
+    start_supervisorを呼ぶと、終了したワーカーやハートビートが途絶えたワーカー、推論が進まなくなったワーカー、依頼の期限を大きく過ぎたワーカーを
+    再起動する（再起動したワーカーはモデルを読み込んでから準備完了を通知する）。
+    処理中だった依頼には、status="failed"の結果をoutput_queueに入れて呼び出し側に知らせる。
+    準備完了にならないまま再起動を繰り返すワーカーは諦め、以降の依頼を振り分けない（すべて諦めた場合は依頼をすぐに失敗とする）。
+    """
+
+    def __init__(self, worker_count, output_queue, control_queue, ring, engine="whisper", config_overrides=None,
+                 generation_slots=1):
+        self.worker_count = max(1, worker_count)
+        self.engine = engine
+        self.config_overrides = dict(config_overrides or {})
+        self.output_queue = output_queue
+        self.control_queue = control_queue
+        self.ring = ring
+        self.input_queues = [None] * self.worker_count
+        self.processes = [None] * self.worker_count
+        self.ready_workers = set()
+        self.inflight = [0] * self.worker_count
+        self.assigned = {} # 処理中の依頼 (seq -> (worker_id, 期限))
+        self.restarts = [0] * self.worker_count
+        self.failed_starts = [0] * self.worker_count # 準備完了にならないまま再起動した回数
+        self.abandoned = set() # 再起動を諦めたワーカー
+        self.started_at = [0.0] * self.worker_count
+        self.stats = [{"requests": 0, "audio_s": 0.0, "processing_s": 0.0} for _ in range(self.worker_count)]
+        # ワーカーと共有する値: ハートビートの時刻、推論が最後に進んだ時刻（推論中でなければ0）と、
+        # 現在の録音セッションの世代
+        # （世代は依頼元ごとの枠に分けて持つ。依頼のgeneration_slotで枠を指定し、省略時は枠0）
+        self.heartbeats = multiprocessing.Array("d", self.worker_count, lock=False)
+        self.progress = multiprocessing.Array("d", self.worker_count, lock=False)
+        self.generation = multiprocessing.Array("i", max(1, generation_slots), lock=False)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def start(self):
+        for worker_id in range(self.worker_count):
+            self._start_worker(worker_id)
+
+    def _start_worker(self, worker_id):
+        """
+        ワーカーを起動し、その入力キューに切り替える。切り替えの時点でそのワーカーに振り分け済みだった依頼
+        （古いキューに入っていて新しいワーカーには届かない依頼）の連番のリストを返す。
+        """
+        input_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=transcription_worker,
+            args=(worker_id, input_queue, self.output_queue, self.control_queue,
+                  self.ring.name, self.ring.capacity, self.engine, self.config_overrides,
+                  self.heartbeats, self.generation, self.progress)
+        )
+        process.daemon = True
+        self.heartbeats[worker_id] = self.started_at[worker_id] = time.monotonic()
+        self.progress[worker_id] = 0.0
+        process.start()
+        with self._lock:
+            self.input_queues[worker_id] = input_queue
+            self.processes[worker_id] = process
+            return [seq for seq, (assigned_worker, _) in self.assigned.items() if assigned_worker == worker_id]
+
+    def mark_ready(self, worker_id):
+        with self._lock:
+            self.ready_workers.add(worker_id)
+            self.failed_starts[worker_id] = 0
+
+    def set_generation(self, generation, slot=0):
+        """
+        現在の録音セッションの世代を設定する。これより古い世代の依頼（generation_slotがslotのもの）は、
+        ワーカーが処理を省略・中断する。
+        """
+        self.generation[slot] = generation
+
+    def submit(self, message):
+        """
+        準備完了のワーカーのうち処理中の依頼が最も少ないワーカーに依頼を送り、そのworker_idを返す。
+        送れるワーカーがない（すべて再起動を諦めた）場合は、失敗の結果を入れてNoneを返す。
+        """
+        with self._lock:
+            candidates = sorted(self.ready_workers) or [i for i in range(self.worker_count) if i not in self.abandoned]
+            if not candidates:
+                self.assigned[message["seq"]] = (None, message.get("deadline"))
+                worker_id = input_queue = None
+            else:
+                worker_id = min(candidates, key=lambda i: self.inflight[i])
+                self.inflight[worker_id] += 1
+                self.assigned[message["seq"]] = (worker_id, message.get("deadline"))
+                input_queue = self.input_queues[worker_id]
+        if input_queue is None:
+            self._fail(None, [message["seq"]])
+            return None
+        input_queue.put(message)
+        return worker_id
+
+    def complete(self, result):
+        """
+        ワーカーからの結果を受け取ったときに、処理中の件数と統計を更新する。
+        再起動ですでに失敗として扱った依頼の結果が遅れて届いた場合はFalseを返す（呼び出し側は無視する）。
+        """
+        with self._lock:
+            entry = self.assigned.pop(result["seq"], None)
+            if entry is None:
+                return False
+            worker_id = entry[0]
+            if worker_id is None:
+                return True
+            self.inflight[worker_id] -= 1
+            if result.get("status", "ok") == "ok":
+                stats = self.stats[worker_id]
+                stats["requests"] += 1
+                stats["audio_s"] += result["audio_s"]
+                stats["processing_s"] += result["processing_s"]
+        return True
+
+    def stats_lines(self):
+        """ワーカーごとのスループット統計を表示用の文字列で返す。"""
+        lines = []
+        with self._lock:
+            for worker_id, stats in enumerate(self.stats):
+                rtf = stats["processing_s"] / stats["audio_s"] if stats["audio_s"] else 0.0
+                restarts = f", 再起動 {self.restarts[worker_id]}回" if self.restarts[worker_id] else ""
+                lines.append(
+                    f"ワーカー{worker_id}: {stats['requests']}件, 音声 {stats['audio_s']:.1f}秒, "
+                    f"処理 {stats['processing_s']:.1f}秒, RTF {rtf:.2f}, 処理中 {self.inflight[worker_id]}件{restarts}"
+                )
+        return lines
+
+    def broadcast(self, message):
+        """すべてのワーカーにメッセージ（設定の変更など）を送る。処理中の依頼のあとに処理される。"""
+        if message.get("type") == "configure":
+            # 再起動したワーカーにも同じ設定を適用する
+            with self._lock:
+                self.config_overrides.update(message["config"])
+        for input_queue in self.input_queues:
+            input_queue.put(message)
+
+    def start_supervisor(self, heartbeat_timeout_s):
+        """ワーカーを監視して再起動するスレッドを開始する。"""
+        threading.Thread(target=self._supervise, args=(heartbeat_timeout_s,), daemon=True).start()
+
+    def _supervise(self, heartbeat_timeout_s):
+        while not self._stop_event.wait(SUPERVISE_INTERVAL_S):
+            now = time.monotonic()
+            for worker_id in range(self.worker_count):
+                if worker_id in self.abandoned:
+                    continue
+                reason = self._failure_reason(worker_id, now, heartbeat_timeout_s)
+                if not reason or self._stop_event.is_set():
+                    continue
+                if worker_id not in self.ready_workers:
+                    self.failed_starts[worker_id] += 1
+                    if self.failed_starts[worker_id] > MAX_RESTARTS_BEFORE_READY:
+                        print(f"エラー: 文字起こしプロセス{worker_id}が準備完了にならないため、再起動を中止します ({reason})。")
+                        self.abandon(worker_id)
+                        continue
+                self.restart(worker_id, reason)
+
+    def _failure_reason(self, worker_id, now, heartbeat_timeout_s):
+        process = self.processes[worker_id]
+        if not process.is_alive():
+            return f"終了しました (終了コード {process.exitcode})"
+        # 起動直後はプロセスの初期化（モジュールの読み込み）が終わってハートビートが始まるまで待つ
+        last_beat = max(self.heartbeats[worker_id], self.started_at[worker_id] + STARTUP_GRACE_S)
+        if heartbeat_timeout_s > 0 and now - last_beat > heartbeat_timeout_s:
+            return f"{now - self.heartbeats[worker_id]:.0f}秒間応答していません"
+        # ハートビートは別のスレッドから届くため、推論が止まっていても途絶えない。推論が進んだ時刻で見分ける
+        stall_timeout_s = app_config.get("worker_stall_timeout_s", 120.0)
+        last_progress = self.progress[worker_id]
+        if stall_timeout_s > 0 and last_progress > 0 and now - last_progress > stall_timeout_s:
+            return f"{now - last_progress:.0f}秒間推論が進んでいません"
+        with self._lock:
+            overdue = [
+                seq for seq, (assigned_worker, deadline) in self.assigned.items()
+                if assigned_worker == worker_id and deadline is not None and now > deadline + DEADLINE_GRACE_S
+            ]
+        if overdue:
+            return f"依頼#{overdue[0]}の期限を{DEADLINE_GRACE_S:.0f}秒以上過ぎても結果を返しません"
+        return None
+
+    def restart(self, worker_id, reason):
+        """ワーカーを止めて起動し直し、処理中だった依頼を失敗として呼び出し側に知らせる。"""
+        print(f"警告: 文字起こしプロセス{worker_id}が{reason}。再起動します。")
+        with self._lock:
+            self.ready_workers.discard(worker_id)
+            self.restarts[worker_id] += 1
+        self._terminate(worker_id)
+        # 再起動の間にこのワーカーへ振り分けられた依頼も、キューの切り替えと同時に失敗として集める
+        failed = self._start_worker(worker_id)
+        self._fail(worker_id, failed)
+        self.control_queue.put({"type": "restarted", "worker_id": worker_id, "reason": reason, "failed": len(failed)})
+
+    def abandon(self, worker_id):
+        """ワーカーの再起動を諦める。以降の依頼は振り分けず、振り分け済みの依頼は失敗として知らせる。"""
+        with self._lock:
+            self.ready_workers.discard(worker_id)
+            self.abandoned.add(worker_id)
+            failed = [seq for seq, (assigned_worker, _) in self.assigned.items() if assigned_worker == worker_id]
+        self._terminate(worker_id)
+        self._fail(worker_id, failed)
+
+    def _fail(self, worker_id, seqs):
+        """依頼をstatus="failed"の結果として呼び出し側に知らせる（completeで処理中の件数が戻る）。"""
+        for seq in seqs:
+            self.output_queue.put({
+                "seq": seq,
+                "worker_id": worker_id,
+                "status": "failed",
+                "text": "",
+                "segments": [],
+                "audio_s": 0.0,
+                "processing_s": 0.0,
+                "dequeued_at": None,
+                "finished_at": None,
+                "rss_mb": None,
+            })
+
+    def _terminate(self, worker_id):
+        process = self.processes[worker_id]
+        if process.is_alive():
+            process.terminate()
+            process.join(KILL_WAIT_S)
+            if process.is_alive():
+                process.kill()
+                process.join(KILL_WAIT_S)
+        # 届かなかった依頼が残っていても、終了時にキューの書き込みを待たない
+        self.input_queues[worker_id].cancel_join_thread()
+
+    def stop(self, timeout=None):
+        """
+        ワーカーに終了を依頼し、待ち行列の依頼を処理し終えるまで待つ。
+        timeout秒以内に終了しないワーカーは強制終了する（Noneの場合は終了するまで待つ）。
+        """
+        self._stop_event.set()
+        for input_queue in self.input_queues:
+            input_queue.put(None)
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        for worker_id, process in enumerate(self.processes):
+            remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            process.join(remaining)
+            if process.is_alive():
+                print(f"警告: 文字起こしプロセス{worker_id}が時間内に終了しないため、強制終了します。")
+                self._terminate(worker_id)
+
+
+def wait_for_workers(pool, control_queue):
+    """
+    すべてのワーカーから準備完了か初期化の失敗が届くまで待ち、届いた準備完了の通知のリストを返す（バッチ処理やリプレイ用）。
+    それ以外の状態通知は読み捨てる。待ち終えた後は、再起動したワーカーが準備完了になるたびに依頼の振り分け先へ戻すスレッドを開始する。
+    """
+    pending = set(range(pool.worker_count))
+    ready = []
+    while pending:
+        message = control_queue.get()
+        if message["type"] not in ("ready", "error") or message["worker_id"] not in pending:
+            continue
+        pending.discard(message["worker_id"])
+        if message["type"] == "error":
+            print(f"エラー: 文字起こしプロセス{message['worker_id']}の初期化に失敗しました。 {message['message']}")
+            continue
+        pool.mark_ready(message["worker_id"])
+        ready.append(message)
+    threading.Thread(target=_follow_control, args=(pool, control_queue), daemon=True).start()
+    return ready
+
+def _follow_control(pool, control_queue):
+    while True:
+        try:
+            message = control_queue.get()
+        except (EOFError, OSError):
+            break # 終了時にキューが閉じられた
+        if message is None:
+            break
+        if message["type"] == "ready":
+            pool.mark_ready(message["worker_id"])
+        elif message["type"] == "server_lost":
+            print(f"エラー: 文字起こしサーバーとの接続が切れました ({message['reason']})。")